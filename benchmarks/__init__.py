@@ -0,0 +1,7 @@
+# benchmarks - قياسات أداء مسار التحميل بدون شبكة خارجية
+#
+#   python -m benchmarks.run [--only throughput,hooks,...] [--output results.json]
+#   python -m benchmarks.run --compare before.json after.json
+#
+# كل القياسات تعمل على خادم محلي (media_server) وحمولة yt-dlp ثابتة (fake_info)
+# لذلك النتائج قابلة للمقارنة بين تشغيل وآخر على نفس الجهاز.
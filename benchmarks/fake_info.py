@@ -0,0 +1,53 @@
+# fake_info.py - حمولة معلومات بصيغة yt-dlp بدل الاستخراج من موقع حقيقي
+
+import itertools
+
+_ids = itertools.count(1)
+
+# (height, vcodec, ext, tbr) كما تعرضها يوتيوب تقريباً
+VIDEO_LADDER = [
+    (144, 'avc1.4d400c', 'mp4', 100), (240, 'avc1.4d4015', 'mp4', 250), (360, 'avc1.4d401e', 'mp4', 500),
+    (480, 'avc1.4d401f', 'mp4', 900), (720, 'avc1.64001f', 'mp4', 2000), (1080, 'avc1.640028', 'mp4', 4000),
+    (144, 'vp9', 'webm', 80), (240, 'vp9', 'webm', 180), (360, 'vp9', 'webm', 350), (480, 'vp9', 'webm', 700),
+    (720, 'vp9', 'webm', 1500), (1080, 'vp9', 'webm', 3000), (1440, 'vp9', 'webm', 8000), (2160, 'vp9', 'webm', 16000),
+    (720, 'av01.0.05M.08', 'mp4', 1200), (1080, 'av01.0.08M.08', 'mp4', 2500),
+]
+AUDIO_LADDER = [('mp4a.40.5', 'm4a', 48), ('mp4a.40.2', 'm4a', 128), ('opus', 'webm', 70), ('opus', 'webm', 160)]
+
+def fake_info(video_url=None, audio_url=None, video_size=None, audio_size=None, duration=20, video_id=None):
+    """معلومات فيديو كاملة (سلم صيغ واقعي للفهرسة) مع requested_formats كما
+    يعيدها yt-dlp بعد حل 'bestvideo+bestaudio'؛ الصيغ المختارة تشير إلى الخادم المحلي"""
+    video_id = video_id or f"bench{next(_ids):06d}"
+    formats = []
+    for i, (height, vcodec, ext, tbr) in enumerate(VIDEO_LADDER):
+        formats.append({
+            'format_id': str(100 + i), 'ext': ext, 'height': height, 'width': height * 16 // 9,
+            'vcodec': vcodec, 'acodec': 'none', 'tbr': tbr, 'protocol': 'https',
+            'filesize': int(tbr * 1000 / 8 * duration), 'url': f"https://media.invalid/{video_id}/{100 + i}",
+        })
+    for i, (acodec, ext, abr) in enumerate(AUDIO_LADDER):
+        formats.append({
+            'format_id': str(200 + i), 'ext': ext, 'vcodec': 'none', 'acodec': acodec, 'abr': abr, 'tbr': abr,
+            'protocol': 'https', 'filesize': int(abr * 1000 / 8 * duration),
+            'url': f"https://media.invalid/{video_id}/{200 + i}",
+        })
+
+    info = {
+        'id': video_id,
+        'title': f"Benchmark {video_id}",
+        'extractor_key': 'Benchmark',
+        'webpage_url': f"https://media.invalid/watch/{video_id}",
+        'duration': duration,
+        'formats': formats,
+    }
+    requested = []
+    if video_url:
+        requested.append(dict(formats[5], url=video_url, protocol='http', filesize=video_size))
+    if audio_url:
+        requested.append(dict(formats[-3], url=audio_url, protocol='http', filesize=audio_size))
+    if len(requested) > 1:
+        info['requested_formats'] = requested
+    elif requested:
+        # صيغة واحدة: yt-dlp يضع حقولها في المستوى الأعلى
+        info.update(requested[0])
+    return info
@@ -0,0 +1,135 @@
+# media_server.py - خادم وسائط محلي بديل عن مواقع الفيديو أثناء القياس
+
+import os
+import random
+import subprocess
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MediaServer:
+    """خادم HTTP محلي يقدم ملفات اصطناعية مع دعم Range،
+    وزمن استجابة وعرض نطاق لكل اتصال قابلين للضبط"""
+    def __init__(self, latency=0.0, bandwidth=0, chunk_size=64 * 1024, host='127.0.0.1'):
+        self.latency = latency
+        # بايت/ثانية لكل اتصال (0 = بدون حد)
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.host = host
+        self.files = {}
+        self.requests = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def add_bytes(self, name, data):
+        self.files[name] = data
+        return self.url(name)
+
+    def add_synthetic(self, name, size, seed=0):
+        """محتوى عشوائي ثابت (نفس البذرة = نفس البايتات) حتى لا يستفيد أي ضغط"""
+        return self.add_bytes(name, random.Random(seed).randbytes(size))
+
+    def add_file(self, name, path):
+        with open(path, 'rb') as f:
+            return self.add_bytes(name, f.read())
+
+    def url(self, name):
+        return f"http://{self.host}:{self.port}/{name}"
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle(self):
+                # العميل يغلق اتصالات keep-alive عند الإلغاء أو انتهاء المقطع
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='bench-media-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handle(self, handler):
+        with self._lock:
+            self.requests += 1
+        data = self.files.get(handler.path.lstrip('/').split('?')[0])
+        if data is None:
+            handler.send_error(404)
+            return
+        if self.latency:
+            time.sleep(self.latency)
+
+        start, end = 0, len(data) - 1
+        range_header = handler.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first)
+            end = min(int(last), end) if last else end
+            handler.send_response(206)
+            handler.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+        else:
+            handler.send_response(200)
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.send_header('Content-Length', str(end - start + 1))
+        handler.end_headers()
+
+        # إرسال بقطع ثابتة مع توقيت يحقق عرض النطاق المطلوب لكل اتصال
+        started = time.perf_counter()
+        sent = 0
+        view = memoryview(data)
+        try:
+            for offset in range(start, end + 1, self.chunk_size):
+                chunk = view[offset:min(offset + self.chunk_size, end + 1)]
+                handler.wfile.write(chunk)
+                sent += len(chunk)
+                if self.bandwidth:
+                    ahead = sent / self.bandwidth - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self._lock:
+                self.bytes_served += sent
+
+def generate_media(ffmpeg, folder, seconds=20):
+    """وسائط حقيقية صغيرة للتحويل والدمج: فيديو بدون صوت وصوت m4a (moov في البداية)"""
+    os.makedirs(folder, exist_ok=True)
+    video = os.path.join(folder, 'video.mp4')
+    audio = os.path.join(folder, 'audio.m4a')
+    base = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi']
+    subprocess.run(base + ['-i', f'testsrc=size=640x360:rate=25:duration={seconds}',
+                           '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                           '-movflags', '+faststart', video], check=True)
+    subprocess.run(base + ['-i', f'sine=frequency=440:duration={seconds}',
+                           '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', audio], check=True)
+    return video, audio
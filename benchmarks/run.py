@@ -0,0 +1,337 @@
+# run.py - تشغيل القياسات وكتابة النتائج كـ JSON
+#
+#   python -m benchmarks.run                          كل القياسات إلى stdout
+#   python -m benchmarks.run --only hooks,throughput --output after.json
+#   python -m benchmarks.run --compare before.json after.json
+
+import argparse
+import contextlib
+import copy
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import engine
+from engine import (
+    DownloadEngine, DownloadListener, DownloadManager, FFmpegLocator, FormatIndex,
+    JobJournal, ProgressBus, ProgressTracker, TranscodeStage,
+)
+from benchmarks.fake_info import fake_info
+from benchmarks.media_server import MediaServer, generate_media
+
+MiB = 1024 ** 2
+
+class BenchEngine(DownloadEngine):
+    """المحرك الحقيقي مع حمولة ثابتة بدل حل الصيغ عبر yt-dlp (الرابط مفتاح في payloads)"""
+    def __init__(self, folder, payloads=None, listener=None):
+        super().__init__(
+            os.path.join(folder, 'downloads'), cache_folder=os.path.join(folder, 'cache'),
+            data_folder=os.path.join(folder, 'data'), listener=listener
+        )
+        self.payloads = payloads if payloads is not None else {}
+
+    def resolve_formats(self, url, format_string, download_id=None, info=None):
+        if url not in self.payloads:
+            return super().resolve_formats(url, format_string, download_id, info=info)
+        return copy.deepcopy(self.payloads[url])
+
+class BenchListener(DownloadListener):
+    def __init__(self):
+        self.finished = {}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def on_complete(self, download_id, title, path):
+        with self._lock:
+            self.finished[download_id] = time.perf_counter()
+
+    def on_error(self, download_id, title, message):
+        with self._lock:
+            self.errors.append(message)
+
+@contextlib.contextmanager
+def override(**values):
+    """تغيير ثوابت engine مؤقتاً (مثل USE_SEGMENTED_DOWNLOADS) ثم إرجاعها"""
+    previous = {name: getattr(engine, name) for name in values}
+    for name, value in values.items():
+        setattr(engine, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(engine, name, value)
+
+def summarize(samples, unit='s'):
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'runs': len(samples),
+        'unit': unit,
+    }
+
+def run_jobs(bench, urls, is_audio_only=False):
+    """تشغيل مهام متزامنة حتى النهاية؛ يعيد الزمن الكلي بالثواني"""
+    listener = BenchListener()
+    started = time.perf_counter()
+    for i, url in enumerate(urls):
+        bench.submit_download(url, 'bestaudio' if is_audio_only else 'bestvideo+bestaudio',
+                              f"job {i} {time.time_ns()}", is_audio_only, listener=listener)
+    bench.wait_until_idle()
+    elapsed = time.perf_counter() - started
+    if listener.errors:
+        raise RuntimeError(f"benchmark job failed: {listener.errors[0]}")
+    shutil.rmtree(bench.downloads_folder, ignore_errors=True)
+    return elapsed
+
+def bench_throughput(args, folder):
+    """تحميل ملف واحد من البداية للنهاية: مقسم متعدد الاتصالات مقابل اتصال واحد"""
+    size = int(args.size_mb * MiB)
+    results = {'size_bytes': size, 'latency': args.latency, 'connection_bandwidth': args.connection_bandwidth}
+    with MediaServer(latency=args.latency, bandwidth=args.connection_bandwidth) as server:
+        url = server.add_synthetic('blob.bin', size)
+        bench = BenchEngine(folder, {'blob': fake_info(video_url=url, video_size=size)})
+        for mode, segmented in (('segmented', True), ('single', False)):
+            with override(USE_SEGMENTED_DOWNLOADS=segmented):
+                samples = [run_jobs(bench, ['blob']) for _ in range(args.repeat)]
+            results[mode] = summarize(samples)
+            results[mode]['mib_per_s'] = size / MiB / results[mode]['median']
+    return results
+
+def bench_hooks(args, folder):
+    """كلفة استدعاء ProgressTracker.hook الواحد (يُستدعى لكل قطعة مستلمة)"""
+    calls = args.hook_calls
+    journal = JobJournal(os.path.join(folder, 'jobs'))
+    journal.record('bench-hook', url='bench')
+    results = {'calls': calls}
+    variants = {
+        'bare': ProgressTracker('bench-hook'),
+        'journal_and_bus': ProgressTracker('bench-hook', journal=journal, bus=ProgressBus()),
+    }
+    for name, tracker in variants.items():
+        samples = []
+        for _ in range(args.repeat):
+            tracker.start_part(existing_bytes=0)
+            d = {'status': 'downloading', 'downloaded_bytes': 0, 'total_bytes': calls * 1024}
+            started = time.perf_counter()
+            for i in range(calls):
+                d['downloaded_bytes'] = i * 1024
+                tracker.hook(d)
+            samples.append((time.perf_counter() - started) / calls * 1e9)
+        results[name] = summarize(samples, 'ns/call')
+    journal.remove('bench-hook')
+    return results
+
+def bench_concurrency(args, folder):
+    """معدل النقل الكلي مع 1..N مهام متزامنة وحد عرض نطاق لكل اتصال في الخادم"""
+    size = int(args.concurrency_size_mb * MiB)
+    levels = [n for n in (1, 2, 4, 8) if n <= args.max_jobs]
+    results = {'size_bytes': size, 'connection_bandwidth': args.concurrency_bandwidth, 'levels': {}}
+    saved = (DownloadManager.max_concurrent, DownloadManager.per_host_limit)
+    with MediaServer(latency=args.latency, bandwidth=args.concurrency_bandwidth) as server:
+        payloads = {}
+        for i in range(max(levels)):
+            url = server.add_synthetic(f'file{i}.bin', size, seed=i)
+            payloads[f'file{i}'] = fake_info(video_url=url, video_size=size)
+        bench = BenchEngine(folder, payloads)
+        try:
+            for n in levels:
+                DownloadManager.configure(max_concurrent=n, per_host_limit=n)
+                samples = [run_jobs(bench, [f'file{i}' for i in range(n)]) for _ in range(args.repeat)]
+                level = summarize(samples)
+                level['aggregate_mib_per_s'] = n * size / MiB / level['median']
+                results['levels'][str(n)] = level
+        finally:
+            DownloadManager.configure(max_concurrent=saved[0], per_host_limit=saved[1])
+    base = results['levels'][str(levels[0])]['aggregate_mib_per_s']
+    for n, level in results['levels'].items():
+        level['speedup'] = level['aggregate_mib_per_s'] / base
+    return results
+
+def bench_extraction(args, folder):
+    """زمن الاستخراج عبر yt-dlp (المستخرج العام على رابط محلي)، إصابة الذاكرة المؤقتة، وبناء فهرس الصيغ"""
+    results = {}
+    with MediaServer(latency=args.latency) as server:
+        url = server.add_synthetic('clip.mp4', 256 * 1024)
+        bench = BenchEngine(folder)
+        started = time.perf_counter()
+        bench.resolve_formats(url, 'best')
+        # يشمل استيراد yt_dlp وتهيئة المستخرجات لأول مرة
+        results['cold_seconds'] = time.perf_counter() - started
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            bench.resolve_formats(url, 'best')
+            samples.append(time.perf_counter() - started)
+        results['warm'] = summarize(samples)
+
+    info = fake_info(duration=600)
+    bench.metadata_cache.put(info['webpage_url'], info)
+    samples = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        for _ in range(1000):
+            bench.fetch_info(info['webpage_url'])
+        samples.append((time.perf_counter() - started) / 1000 * 1e6)
+    results['cache_hit'] = summarize(samples, 'us')
+
+    samples = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        for _ in range(200):
+            index = FormatIndex(info)
+            index.options('mp4')
+            index.options('mp3')
+            index.select(**FormatIndex.parse_policy('max 720p, prefer avc1'))
+        samples.append((time.perf_counter() - started) / 200 * 1e6)
+    results['format_index'] = summarize(samples, 'us')
+    return results
+
+def bench_transcode(args, folder):
+    """مدة ffmpeg للتحويل إلى mp3 وللدمج، ومهمة صوت كاملة بالبث مقابل الملف الوسيط"""
+    ffmpeg = FFmpegLocator.get()
+    video, audio = generate_media(ffmpeg, os.path.join(folder, 'media'), seconds=args.media_seconds)
+    results = {'media_seconds': args.media_seconds}
+    stage = TranscodeStage(workers=1)
+    commands = {
+        'mp3': TranscodeStage.mp3_command(audio),
+        'merge': TranscodeStage.merge_command([(video, {'acodec': 'none'}), (audio, {'vcodec': 'none'})]),
+    }
+    for name, command in commands.items():
+        samples = []
+        for i in range(args.repeat):
+            output = os.path.join(folder, f'out-{name}-{i}')
+            done = threading.Event()
+            outcome = {}
+            started = time.perf_counter()
+            stage.submit(f'bench-{name}-{i}', command, output,
+                         on_done=lambda task, state, error: (outcome.update(state=state, error=error), done.set()))
+            done.wait()
+            if outcome['state'] != 'done':
+                raise RuntimeError(f"ffmpeg {name} failed: {outcome['error']}")
+            samples.append(time.perf_counter() - started)
+            os.remove(output)
+        results[name] = summarize(samples)
+    stage.stop()
+
+    with MediaServer(latency=args.latency) as server:
+        url = server.add_file('audio.m4a', audio)
+        payload = fake_info(audio_url=url, audio_size=os.path.getsize(audio), duration=args.media_seconds)
+        bench = BenchEngine(folder, {'audio': payload})
+        for mode, streaming in (('audio_job_streaming', True), ('audio_job_two_stage', False)):
+            with override(STREAM_AUDIO_TRANSCODE=streaming):
+                samples = [run_jobs(bench, ['audio'], is_audio_only=True) for _ in range(args.repeat)]
+            results[mode] = summarize(samples)
+    return results
+
+BENCHMARKS = {
+    'throughput': bench_throughput,
+    'hooks': bench_hooks,
+    'concurrency': bench_concurrency,
+    'extraction': bench_extraction,
+    'transcode': bench_transcode,
+}
+
+def environment():
+    meta = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        meta['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                        cwd=os.path.dirname(os.path.abspath(engine.__file__))).stdout.strip() or None
+    except OSError:
+        meta['commit'] = None
+    try:
+        meta['yt_dlp'] = engine.yt_dlp.version.__version__
+    except Exception:
+        meta['yt_dlp'] = None
+    return meta
+
+def flatten(results, prefix=''):
+    """المقاييس الرقمية فقط بمفاتيح مثل 'throughput.segmented.median'"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(before_path, after_path):
+    with open(before_path, 'r', encoding='utf-8') as f:
+        before = flatten(json.load(f)['results'])
+    with open(after_path, 'r', encoding='utf-8') as f:
+        after = flatten(json.load(f)['results'])
+    changes = {}
+    for name in sorted(before.keys() & after.keys()):
+        if name.endswith(('.median', 'mib_per_s', 'speedup', 'cold_seconds')):
+            old, new = before[name], after[name]
+            changes[name] = {'before': old, 'after': new, 'change': (new - old) / old if old else None}
+    return changes
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description='Offline download path benchmarks')
+    parser.add_argument('--only', help=f"comma separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='print relative changes between two result files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.02, help='server response latency in seconds')
+    parser.add_argument('--size-mb', type=float, default=64, help='file size for the throughput benchmark')
+    parser.add_argument('--connection-bandwidth', type=int, default=0,
+                        help='bytes/s per server connection for the throughput benchmark (0 = unlimited)')
+    parser.add_argument('--concurrency-size-mb', type=float, default=16)
+    parser.add_argument('--concurrency-bandwidth', type=int, default=8 * MiB, help='bytes/s per server connection')
+    parser.add_argument('--max-jobs', type=int, default=8)
+    parser.add_argument('--hook-calls', type=int, default=100000)
+    parser.add_argument('--media-seconds', type=int, default=20)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    if args.compare:
+        print(json.dumps(compare(*args.compare), indent=2))
+        return 0
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise SystemExit(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    report = {'meta': environment(), 'config': vars(args), 'results': {}}
+    root = tempfile.mkdtemp(prefix='downloader-bench-')
+    try:
+        # كل تشغيل يحمّل نفس الملفات؛ فهرس المكتبة لا يجب أن يتخطاها
+        with override(DEDUP_MODE='off'):
+            for name in names:
+                print(f"running {name}...", file=sys.stderr, flush=True)
+                folder = os.path.join(root, name)
+                os.makedirs(folder)
+                started = time.perf_counter()
+                report['results'][name] = BENCHMARKS[name](args, folder)
+                report['results'][name]['wall_seconds'] = time.perf_counter() - started
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,389 @@
+# cli.py - واجهة سطر الأوامر ووضع الخدمة (بدون Toga)
+#
+#   python -m cli info URL
+#   python -m cli download URL [URL ...] [--format mp4|mp3|FORMAT_ID | --policy POLICY] [--name NAME]
+#   python -m cli batch URL [URL ...] [--format mp4|mp3]
+#   python -m cli daemon [--socket PATH]
+#
+# حدود عرض النطاق (خيارات عامة): --limit-rate 2M --job-rate 500K --rate-window 23:00-07:00=0
+# القرص (خيارات عامة): --min-free 500M --write-buffer 4M --fsync end|range|never
+# المقاييس: --metrics-port 9464 (http://127.0.0.1:9464/metrics) و --trace spans.jsonl
+#
+# في وضع الخدمة تُقرأ الأوامر كسطور JSON من stdin (أو من مقبس محلي)
+# وتُكتب الردود والأحداث كسطور JSON على stdout (أو لكل عميل متصل).
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent import futures
+
+from engine import (
+    AsyncRuntime, BandwidthGovernor, DiskPolicy, DownloadEngine, DownloadListener, DownloadManager, FormatIndex, Prefetcher,
+    YoutubeDLPool, DOWNLOADS_FOLDER, parse_rate,
+)
+
+logger = logging.getLogger(__name__)
+
+def resolve_format(choice, engine=None, info=None, policy=None):
+    """تحويل اختيار المستخدم (أو سياسة مثل 'max 720p, prefer avc1') إلى (format_id, is_audio_only)"""
+    if policy:
+        selected = engine.select_format(info, policy)
+        if selected is None:
+            raise ValueError(f"no format matches policy: {policy}")
+        return selected['format'], FormatIndex.parse_policy(policy)['audio_only']
+    if choice == 'mp3':
+        return 'bestaudio', True
+    if choice in (None, 'mp4'):
+        return 'bestvideo+bestaudio', False
+    return choice, False
+
+class ConsoleListener(DownloadListener):
+    """طباعة التقدم على stderr لوضع الأوامر المباشرة"""
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def _print(self, download_id, text):
+        with self._lock:
+            print(f"[{download_id[-12:]}] {text}", file=self.stream, flush=True)
+
+    def on_status(self, download_id, text):
+        self._print(download_id, text)
+
+    def on_progress(self, download_id, percent, speed, eta):
+        self._print(download_id, f"{percent} {speed} ETA {eta}")
+
+    def on_complete(self, download_id, title, path):
+        self._print(download_id, f"done: {path}")
+
+    def on_cancelled(self, download_id):
+        self.failed += 1
+        self._print(download_id, "cancelled")
+
+    def on_error(self, download_id, title, message):
+        self.failed += 1
+        self._print(download_id, f"failed: {message}")
+
+class JsonLinesListener(DownloadListener):
+    """إرسال أحداث المحرك كسطور JSON لكل المخرجات المسجلة"""
+    def __init__(self):
+        self._writers = []
+        self._lock = threading.Lock()
+
+    def add_writer(self, writer):
+        with self._lock:
+            self._writers.append(writer)
+
+    def remove_writer(self, writer):
+        with self._lock:
+            if writer in self._writers:
+                self._writers.remove(writer)
+
+    def emit(self, message, writer=None):
+        line = json.dumps(message, ensure_ascii=False) + '\n'
+        with self._lock:
+            targets = [writer] if writer else list(self._writers)
+            for target in targets:
+                try:
+                    target.write(line)
+                    target.flush()
+                except (OSError, ValueError):
+                    if target in self._writers:
+                        self._writers.remove(target)
+
+    def on_status(self, download_id, text):
+        self.emit({'event': 'status', 'id': download_id, 'text': text})
+
+    def on_progress(self, download_id, percent, speed, eta):
+        self.emit({'event': 'progress', 'id': download_id, 'percent': percent, 'speed': speed, 'eta': eta})
+
+    def on_complete(self, download_id, title, path):
+        self.emit({'event': 'complete', 'id': download_id, 'title': title, 'path': path})
+
+    def on_cancelled(self, download_id):
+        self.emit({'event': 'cancelled', 'id': download_id})
+
+    def on_error(self, download_id, title, message):
+        self.emit({'event': 'error', 'id': download_id, 'title': title, 'message': message})
+
+class SocketWriter:
+    """واجهة write/flush التي يتوقعها JsonLinesListener فوق asyncio.StreamWriter؛
+    الكتابة الفعلية تتم على خيط الحلقة"""
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, text):
+        if self.writer.is_closing():
+            raise OSError("connection closed")
+        AsyncRuntime.call_soon(self.writer.write, text.encode('utf-8'))
+
+    def flush(self):
+        pass
+
+class Daemon:
+    """خدمة طويلة التشغيل تستقبل أوامر JSON سطراً بسطر"""
+    def __init__(self, engine, listener):
+        self.engine = engine
+        self.listener = listener
+        self.stopping = threading.Event()
+        self.prefetcher = Prefetcher(engine)
+        # كل أمر coroutine على حلقة AsyncRuntime فلا تحجب الأوامر البطيئة قراءة التالية
+        self.pending = set()
+        self._lock = threading.Lock()
+
+    def dispatch(self, line, writer):
+        future = AsyncRuntime.spawn(self.handle_line(line, writer))
+        with self._lock:
+            self.pending.add(future)
+        future.add_done_callback(self._forget)
+
+    def _forget(self, future):
+        with self._lock:
+            self.pending.discard(future)
+
+    def drain(self):
+        """انتظار ردود كل الأوامر المستلمة"""
+        with self._lock:
+            pending = list(self.pending)
+        futures.wait(pending)
+
+    def serve_stream(self, reader, writer, detach=True):
+        """قراءة الأوامر حتى نهاية المدخل؛ detach=False يبقي المخرج مسجلاً لأحداث المهام اللاحقة"""
+        self.listener.add_writer(writer)
+        try:
+            for line in reader:
+                if self.stopping.is_set():
+                    break
+                line = line.strip()
+                if line:
+                    self.dispatch(line, writer)
+        finally:
+            if detach:
+                self.listener.remove_writer(writer)
+
+    def serve_socket(self, path):
+        AsyncRuntime.run(self._serve_socket(path))
+
+    async def _serve_socket(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self._serve_connection, path)
+        logger.info(f"Listening on {path}")
+        try:
+            while not self.stopping.is_set():
+                await asyncio.sleep(0.5)
+        finally:
+            server.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def _serve_connection(self, reader, writer):
+        stream = SocketWriter(writer)
+        self.listener.add_writer(stream)
+        try:
+            while not self.stopping.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').strip()
+                if line:
+                    self.dispatch(line, stream)
+        finally:
+            self.listener.remove_writer(stream)
+            writer.close()
+
+    async def handle_line(self, line, writer):
+        try:
+            request = json.loads(line)
+            reply = await self.handle(request)
+        except Exception as e:
+            request = {}
+            reply = {'ok': False, 'error': str(e)}
+        if 'req' in request:
+            reply['req'] = request['req']
+        self.listener.emit(reply, writer)
+
+    async def handle(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'download':
+            url = request['url']
+            info = await self.engine.fetch_info_async(url)
+            format_id, is_audio_only = resolve_format(request.get('format'), self.engine, info, request.get('policy'))
+            job = self.engine.submit_download(
+                info.get('webpage_url') or url, format_id, info.get('title', 'download'), is_audio_only,
+                request.get('name'), priority=request.get('priority', 0),
+                rate_limit=parse_rate(request['rate']) if request.get('rate') else None
+            )
+            return {'ok': True, 'id': job.download_id, 'title': info.get('title')}
+        if cmd == 'batch':
+            _, is_audio_only = resolve_format(request.get('format'))
+            batch = self.engine.start_batch(request.get('text') or request['url'], is_audio_only)
+            await batch.task
+            return {'ok': True, 'queued': batch.resolved, 'failed': batch.failed}
+        if cmd == 'prefetch':
+            # واجهة تعرض الرابط قبل طلب التحميل: {"cmd": "prefetch", "url": ...}
+            self.prefetcher.schedule(request['url'], delay=0)
+            return {'ok': True}
+        if cmd == 'info':
+            info = await self.engine.fetch_info_async(request['url'])
+            return {
+                'ok': True,
+                'title': info.get('title'),
+                'duration': info.get('duration'),
+                'formats': self.engine.format_options(info, request.get('type', 'mp4')),
+            }
+        if cmd == 'cancel':
+            return {'ok': self.engine.cancel_download(request['id'])}
+        if cmd in ('pause', 'resume'):
+            action = {
+                'pause': DownloadManager.pause_download,
+                'resume': DownloadManager.resume_download,
+            }[cmd]
+            action(request['id'])
+            return {'ok': True}
+        if cmd == 'limit':
+            # {"cmd": "limit", "rate": "1M"} للحد العام أو مع "id" لمهمة واحدة
+            rate = parse_rate(request.get('rate', 0))
+            if request.get('id'):
+                BandwidthGovernor.set_job_limit(request['id'], rate)
+            else:
+                BandwidthGovernor.configure(global_rate=rate)
+            return {'ok': True, 'bandwidth': BandwidthGovernor.stats()}
+        if cmd == 'status':
+            return {'ok': True, 'jobs': self.engine.list_jobs()}
+        if cmd == 'shutdown':
+            self.stopping.set()
+            return {'ok': True}
+        return {'ok': False, 'error': f"unknown command: {cmd}"}
+
+async def fetch_all(engine, urls):
+    """استخراج كل الروابط بالتوازي ضمن حد المنفذ؛ الاستثناء يُعاد مكان النتيجة"""
+    return await asyncio.gather(*(engine.fetch_info_async(url) for url in urls), return_exceptions=True)
+
+def run_info(engine, args):
+    for url, info in zip(args.urls, AsyncRuntime.run(fetch_all(engine, args.urls))):
+        if isinstance(info, Exception):
+            raise info
+        print(json.dumps({
+            'url': url,
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+            'formats': engine.format_options(info, 'mp3' if args.format == 'mp3' else 'mp4'),
+        }, ensure_ascii=False))
+    return 0
+
+def run_download(engine, args, listener):
+    for url, info in zip(args.urls, AsyncRuntime.run(fetch_all(engine, args.urls))):
+        try:
+            if isinstance(info, Exception):
+                raise info
+            format_id, is_audio_only = resolve_format(args.format, engine, info, args.policy)
+        except Exception as e:
+            logger.error(f"Failed to prepare {url}: {e}")
+            listener.failed += 1
+            continue
+        try:
+            engine.submit_download(info.get('webpage_url') or url, format_id, info.get('title', 'download'),
+                                   is_audio_only, args.name)
+        except OSError as e:
+            logger.error(f"Not downloading {url}: {e}")
+            listener.failed += 1
+    engine.wait_until_idle()
+    return 1 if listener.failed else 0
+
+def run_batch(engine, args, listener):
+    _, is_audio_only = resolve_format(args.format)
+    batch = engine.start_batch('\n'.join(args.urls), is_audio_only)
+    batch.wait()
+    engine.wait_until_idle()
+    return 1 if listener.failed or batch.failed else 0
+
+def run_daemon(engine, args, listener):
+    daemon = Daemon(engine, listener)
+    engine.resume_unfinished()
+    try:
+        if args.socket:
+            # الأحداث تصل لكل العملاء المتصلين
+            daemon.serve_socket(args.socket)
+        else:
+            # نهاية stdin تعني: أكمل المهام الحالية ثم اخرج
+            daemon.serve_stream(sys.stdin, sys.stdout, detach=False)
+            daemon.drain()
+            if not daemon.stopping.is_set():
+                engine.wait_until_idle()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.transcoder.stop()
+        engine.journal.flush()
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m cli', description='Headless video downloader')
+    parser.add_argument('-o', '--output', default=DOWNLOADS_FOLDER, help='downloads folder')
+    parser.add_argument('-j', '--jobs', type=int, help='maximum concurrent downloads')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--limit-rate', type=parse_rate, help='total bandwidth cap, e.g. 2M or 500K')
+    parser.add_argument('--job-rate', type=parse_rate, help='bandwidth cap for each download')
+    parser.add_argument('--rate-window', action='append', type=BandwidthGovernor.parse_profile, default=[],
+                        metavar='HH:MM-HH:MM=RATE', help='total cap during a time of day, e.g. 23:00-07:00=0 (repeatable)')
+    parser.add_argument('--min-free', type=parse_rate, help='disk space to always leave free, e.g. 500M')
+    parser.add_argument('--write-buffer', type=parse_rate, help='write buffer per connection, e.g. 4M')
+    parser.add_argument('--fsync', choices=DiskPolicy.FSYNC_POLICIES, help='when downloaded data is forced to disk')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve Prometheus metrics on 127.0.0.1:PORT')
+    parser.add_argument('--trace', metavar='FILE', help='append per-job phase spans as JSON lines')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    info = sub.add_parser('info', help='print title and available formats as JSON')
+    info.add_argument('urls', nargs='+')
+    info.add_argument('-f', '--format', default='mp4', choices=['mp4', 'mp3'])
+
+    download = sub.add_parser('download', help='download one or more videos')
+    download.add_argument('urls', nargs='+')
+    download.add_argument('-f', '--format', default='mp4', help='mp4, mp3 or a yt-dlp format id')
+    download.add_argument('-n', '--name', help='output file name (without extension)')
+    download.add_argument('-p', '--policy', help="format policy, e.g. 'best under 50 MB' or 'max 720p, prefer avc1'")
+
+    batch = sub.add_parser('batch', help='download playlists, channels or lists of links')
+    batch.add_argument('urls', nargs='+')
+    batch.add_argument('-f', '--format', default='mp4', choices=['mp4', 'mp3'])
+
+    daemon = sub.add_parser('daemon', help='accept JSON-lines jobs on stdin or a local socket')
+    daemon.add_argument('--socket', help='path of a Unix socket to listen on instead of stdin')
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+    if args.jobs:
+        DownloadManager.configure(max_concurrent=args.jobs)
+    BandwidthGovernor.configure(global_rate=args.limit_rate, per_job_rate=args.job_rate,
+                                profiles=args.rate_window or None)
+    DiskPolicy.configure(reserve_bytes=args.min_free, write_buffer_size=args.write_buffer, fsync_policy=args.fsync)
+
+    listener = JsonLinesListener() if args.command == 'daemon' else ConsoleListener()
+    engine = DownloadEngine(args.output, listener=listener)
+    engine.start_progress_ticker()
+    engine.start_metrics(args.metrics_port, args.trace)
+
+    try:
+        if args.command == 'info':
+            return run_info(engine, args)
+        if args.command == 'download':
+            return run_download(engine, args, listener)
+        if args.command == 'batch':
+            return run_batch(engine, args, listener)
+        return run_daemon(engine, args, listener)
+    finally:
+        AsyncRuntime.shutdown()
+        YoutubeDLPool.close_all()
+
+if __name__ == '__main__':
+    sys.exit(main())
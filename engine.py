@@ -0,0 +1,3627 @@
+# engine.py - منطق التحميل بدون واجهة (يُستخدم من Toga ومن سطر الأوامر)
+
+import threading
+import asyncio
+import functools
+import os
+import time
+import importlib
+import logging
+import re
+import tempfile
+import heapq
+import itertools
+import json
+import hashlib
+import subprocess
+import contextlib
+import copy
+import errno
+import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+# زمن استيراد كل وحدة ثقيلة (بالثواني) لتقرير بدء التشغيل
+IMPORT_TIMINGS = {}
+
+class LazyModule:
+    """وحدة تُستورد عند أول استخدام بدلاً من وقت تحميل التطبيق لتسريع البدء"""
+    def __init__(self, name, optional=False):
+        self._name = name
+        self._optional = optional
+        self._module = None
+        self._missing = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None and not self._missing:
+            with self._lock:
+                if self._module is None and not self._missing:
+                    started = time.perf_counter()
+                    try:
+                        module = importlib.import_module(self._name)
+                    except ImportError:
+                        if not self._optional:
+                            raise
+                        self._missing = True
+                        return None
+                    IMPORT_TIMINGS[self._name] = time.perf_counter() - started
+                    self._module = module
+        return self._module
+
+    def available(self):
+        return self.load() is not None
+
+    def __getattr__(self, attr):
+        module = self.load()
+        if module is None:
+            raise ImportError(f"optional module {self._name} is not installed")
+        return getattr(module, attr)
+
+yt_dlp = LazyModule('yt_dlp')
+imageio_ffmpeg = LazyModule('imageio_ffmpeg')
+requests = LazyModule('requests')
+sqlite3 = LazyModule('sqlite3')
+# Pillow اختيارية لتصغير الصور المصغرة قبل العرض
+PILImage = LazyModule('PIL.Image', optional=True)
+
+DOWNLOADS_FOLDER = os.path.join(os.path.expanduser('~'), 'Downloads')
+CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'downloader')
+DATA_FOLDER = os.path.join(os.path.expanduser('~'), '.local', 'share', 'downloader')
+# عدد مرات استئناف مهمة فاشلة قبل التخلي عنها
+MAX_RESUME_ATTEMPTS = 3
+# عمر المعلومات المستخرجة (بالثواني) الذي تُستخدم فيه روابط صيغها للتحميل مباشرة بدل استخراج جديد
+RESOLVED_INFO_MAX_AGE = 1800
+# التحميل المقسم للصيغ المباشرة: اتصالات لكل ملف وحد عام لكل التحميلات
+USE_SEGMENTED_DOWNLOADS = True
+SEGMENTED_CONNECTIONS = 4
+SEGMENTED_MAX_CONNECTIONS = 16
+# معدل إطارات عرض التقدم (تحديثات في الثانية لكل المهام معاً)
+PROGRESS_FPS = 5
+
+# حدود المجدول الافتراضية
+MAX_CONCURRENT_DOWNLOADS = 3
+MAX_DOWNLOADS_PER_HOST = 2
+# عمليات ffmpeg المتزامنة لمرحلة الدمج/التحويل (None = عدد أنوية المعالج)
+TRANSCODE_WORKERS = None
+MP3_BITRATE = '192k'
+# تحويل الصوت إلى mp3 أثناء التحميل بدل حفظ الملف الأصلي ثم قراءته مرة أخرى
+STREAM_AUDIO_TRANSCODE = True
+# ما يحدث عند طلب فيديو وصيغة موجودين في المكتبة: 'skip' يعيد الملف الموجود،
+# 'link' ينشئ رابطاً صلباً باسم جديد، 'off' يحمّل من جديد
+DEDUP_MODE = 'skip'
+# منفذ مقاييس Prometheus على localhost (0 = معطل) وملف تتبع JSON lines اختياري
+METRICS_PORT = 0
+TRACE_FILE = None
+# حدود عرض النطاق بالبايت/ثانية (0 = بدون حد)
+BANDWIDTH_LIMIT = 0
+BANDWIDTH_JOB_LIMIT = 0
+# عمال المنفذ المحدود للأعمال الحاجبة التي تطلبها الحلقة (استخراج yt-dlp، الصور المصغرة)
+BLOCKING_WORKERS = 8
+# الجلب المسبق للمعلومات عند ظهور رابط: مهلة الكتابة بالثواني وحد عمليات الاستخراج المتزامنة
+PREFETCH_DEBOUNCE = 0.4
+PREFETCH_MAX_ACTIVE = 2
+# جلسات yt-dlp المعاد استخدامها: الحد الأقصى، ثواني الخمول قبل الإغلاق، وعدد الاستخدامات قبل التجديد
+YTDL_POOL_SIZE = 12
+YTDL_SESSION_IDLE = 300
+YTDL_SESSION_MAX_USES = 200
+# ملف كوكيز بصيغة Netscape يُحمّل عند أول استخدام ويُحفظ عند الإغلاق (None = في الذاكرة فقط)
+COOKIE_FILE = None
+# مساحة حرة تبقى دائماً على القرص بعد حساب ما تحتاجه كل المهام المقبولة
+DISK_RESERVE_BYTES = 200 * 1024**2
+# ذاكرة الكتابة لكل اتصال (بدل كتابة كل قطعة شبكة على حدة)، ومتى يُفرض الحفظ على القرص:
+# 'end' عند اكتمال الملف، 'range' بعد كل نطاق قبل تسجيله في السجل، 'never' يُترك لنظام التشغيل
+WRITE_BUFFER_SIZE = 2 * 1024**2
+FSYNC_POLICY = 'end'
+
+class FFmpegLocator:
+    """مسار ffmpeg يُحل مرة واحدة لكل عملية ويُحفظ بين التشغيلات"""
+    cache_file = os.path.join(CACHE_FOLDER, 'ffmpeg.json')
+    _path = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        if cls._path:
+            return cls._path
+        with cls._lock:
+            if cls._path:
+                return cls._path
+            path = cls._load_cached()
+            if not path:
+                path = imageio_ffmpeg.get_ffmpeg_exe()
+                cls._save_cached(path)
+            cls._path = path
+            return path
+
+    @classmethod
+    def _load_cached(cls):
+        try:
+            with open(cls.cache_file, 'r', encoding='utf-8') as f:
+                path = json.load(f).get('path')
+        except (OSError, ValueError):
+            return None
+        # المسار المحفوظ قد يختفي بعد تحديث imageio-ffmpeg
+        if path and os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+        return None
+
+    @classmethod
+    def _save_cached(cls, path):
+        try:
+            os.makedirs(os.path.dirname(cls.cache_file), exist_ok=True)
+            with open(cls.cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'path': path}, f)
+        except OSError as e:
+            logger.error(f"Failed to cache ffmpeg location: {e}")
+
+def warm_up():
+    """استيراد الوحدات الثقيلة وحل مسار ffmpeg مسبقاً (في الخلفية بعد ظهور النافذة)"""
+    timings = {}
+    for module in (yt_dlp, requests, imageio_ffmpeg, PILImage):
+        try:
+            module.load()
+        except Exception as e:
+            logger.error(f"Failed to pre-import {module._name}: {e}")
+    started = time.perf_counter()
+    try:
+        FFmpegLocator.get()
+    except Exception as e:
+        logger.error(f"Failed to resolve ffmpeg: {e}")
+    timings['ffmpeg'] = time.perf_counter() - started
+    timings.update(IMPORT_TIMINGS)
+    return timings
+
+class StartupProfiler:
+    """قياس مراحل بدء التشغيل: الاستيراد، ظهور النافذة، والتسخين في الخلفية"""
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks[name] = time.perf_counter() - self.started
+
+    def report(self, warm_up_timings=None):
+        return {
+            'marks_ms': {name: round(value * 1000, 1) for name, value in self.marks.items()},
+            'lazy_imports_ms': {name: round(value * 1000, 1) for name, value in (warm_up_timings or IMPORT_TIMINGS).items()},
+        }
+
+    def save(self, path, warm_up_timings=None):
+        report = self.report(warm_up_timings)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        except OSError as e:
+            logger.error(f"Failed to save startup report: {e}")
+        return report
+
+class Metrics:
+    """مقاييس زمنية لكل مرحلة بصيغة Prometheus النصية، مع سجل تتبع اختياري
+    (JSON lines) يكتب مساراً لكل مرحلة من كل مهمة"""
+    PREFIX = 'downloader_'
+    SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    # من 64 KiB/s حتى 128 MiB/s
+    RATE_BUCKETS = tuple(64 * 1024 * 2 ** i for i in range(12))
+    HELP = {
+        'extraction_seconds': 'Metadata extraction latency (info = fetch_info, resolve = format resolution)',
+        'thumbnail_seconds': 'Thumbnail fetch latency by cache result',
+        'queue_wait_seconds': 'Time a download waited in the scheduler queue',
+        'time_to_first_byte_seconds': 'Time from starting a file download to its first received chunk',
+        'download_seconds': 'Network time per downloaded file',
+        'throughput_bytes_per_second': 'Average throughput per downloaded file',
+        'transcode_seconds': 'ffmpeg merge/conversion duration',
+        'downloaded_bytes_total': 'Bytes received from the network',
+        'jobs_total': 'Finished jobs by result',
+        'metadata_cache_hits_total': 'fetch_info calls answered from the metadata cache',
+    }
+
+    _histograms = {}
+    _counters = {}
+    _gauges = {}
+    _lock = threading.Lock()
+    _trace = None
+    _server = None
+
+    @classmethod
+    def observe(cls, name, value, **labels):
+        buckets = cls.RATE_BUCKETS if name.endswith('_per_second') else cls.SECONDS_BUCKETS
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = cls._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @classmethod
+    def inc(cls, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            cls._counters[key] = cls._counters.get(key, 0) + value
+
+    @classmethod
+    def register_gauge(cls, name, help_text, read):
+        """read() يعيد قيمة أو قاموساً {labels_tuple: قيمة}؛ يُقرأ عند كل طلب فقط"""
+        cls._gauges[name] = (help_text, read)
+
+    @classmethod
+    def record_span(cls, name, started, finished, download_id=None, attrs=None, **labels):
+        """تسجيل مرحلة منتهية: في المدرج التكراري <name>_seconds وفي ملف التتبع"""
+        duration = max(0.0, finished - started)
+        cls.observe(f"{name}_seconds", duration, **labels)
+        if cls._trace is not None:
+            event = {'ts': round(started, 6), 'span': name, 'duration': round(duration, 6)}
+            if download_id:
+                event['job'] = download_id
+            event.update(labels)
+            event.update(attrs or {})
+            line = json.dumps(event, ensure_ascii=False) + '\n'
+            with cls._lock:
+                if cls._trace is not None:
+                    cls._trace.write(line)
+        return duration
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name, download_id=None, **labels):
+        """قياس كتلة كود كمرحلة؛ الحقول المضافة إلى القاموس المُعاد تُكتب في التتبع"""
+        attrs = {}
+        started = time.time()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs.setdefault('error', str(e)[:200])
+            raise
+        finally:
+            cls.record_span(name, started, time.time(), download_id, attrs, **labels)
+
+    @classmethod
+    def open_trace(cls, path):
+        """تفعيل سجل التتبع (إلحاق بالملف، سطر JSON لكل مرحلة)"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with cls._lock:
+            if cls._trace is not None:
+                cls._trace.close()
+            cls._trace = open(path, 'a', encoding='utf-8', buffering=1)
+
+    @classmethod
+    def close_trace(cls):
+        with cls._lock:
+            if cls._trace is not None:
+                cls._trace.close()
+                cls._trace = None
+
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        items = list(labels) + list(extra or [])
+        if not items:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+    @classmethod
+    def render(cls):
+        """كل المقاييس بصيغة Prometheus النصية (الإصدار 0.0.4)"""
+        lines = []
+        with cls._lock:
+            histograms = {key: dict(value, counts=list(value['counts'])) for key, value in cls._histograms.items()}
+            counters = dict(cls._counters)
+        for kind, series in (('histogram', histograms), ('counter', counters)):
+            for name in sorted({key[0] for key in series}):
+                full = cls.PREFIX + name
+                lines.append(f"# HELP {full} {cls.HELP.get(name, name)}")
+                lines.append(f"# TYPE {full} {kind}")
+                for (metric, labels), value in sorted(series.items()):
+                    if metric != name:
+                        continue
+                    if kind == 'counter':
+                        lines.append(f"{full}{cls._format_labels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value['buckets'], value['counts']):
+                        cumulative += count
+                        lines.append(f"{full}_bucket{cls._format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{full}_bucket{cls._format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{full}_sum{cls._format_labels(labels)} {value['sum']}")
+                    lines.append(f"{full}_count{cls._format_labels(labels)} {value['count']}")
+        for name, (help_text, read) in sorted(cls._gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logger.error(f"Failed to read gauge {name}: {e}")
+                continue
+            full = cls.PREFIX + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} gauge")
+            for labels, number in (value.items() if isinstance(value, dict) else [((), value)]):
+                lines.append(f"{full}{cls._format_labels(labels)} {number}")
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def serve(cls, port=METRICS_PORT, host='127.0.0.1'):
+        """خادم HTTP محلي يعرض /metrics في خيط خلفي؛ يعيد المنفذ الفعلي"""
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = cls.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        with cls._lock:
+            if cls._server is None:
+                cls._server = ThreadingHTTPServer((host, port), Handler)
+                cls._server.daemon_threads = True
+                threading.Thread(target=cls._server.serve_forever, name='metrics-server', daemon=True).start()
+                logger.info(f"Serving metrics on http://{host}:{cls._server.server_port}/metrics")
+            return cls._server.server_port
+
+class AsyncRuntime:
+    """حلقة asyncio واحدة للتنسيق: حلقة Toga في الواجهة أو حلقة خاصة على خيط واحد
+    في سطر الأوامر. الأعمال الحاجبة فقط (yt-dlp، ffmpeg، القرص) تمر عبر منفذ بعدد عمال محدود،
+    وكل تحديثات الواجهة تُنفذ على خيط الحلقة بترتيب طلبها"""
+    max_workers = BLOCKING_WORKERS
+
+    _loop = None
+    _own_thread = None
+    _executor = None
+    # مفتاح -> Future لعمل حاجب جارٍ؛ لا يُلمس إلا من خيط الحلقة
+    _inflight = {}
+    # الحلقة تحتفظ بمراجع ضعيفة للمهام فقط
+    _tasks = set()
+    _lock = threading.Lock()
+
+    @classmethod
+    def bind(cls, loop):
+        """استخدام حلقة موجودة (حلقة Toga) بدل إنشاء حلقة خاصة"""
+        with cls._lock:
+            previous, thread = cls._loop, cls._own_thread
+            cls._loop, cls._own_thread = loop, None
+        if thread is not None and previous is not loop:
+            previous.call_soon_threadsafe(previous.stop)
+        return loop
+
+    @classmethod
+    def loop(cls):
+        """الحلقة المربوطة، أو حلقة خاصة على خيط 'async-runtime' عند أول استخدام"""
+        with cls._lock:
+            if cls._loop is None or cls._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                cls._own_thread = threading.Thread(target=loop.run_forever, name='async-runtime', daemon=True)
+                cls._own_thread.start()
+                cls._loop = loop
+            return cls._loop
+
+    @classmethod
+    def in_loop(cls):
+        try:
+            return asyncio.get_running_loop() is cls._loop
+        except RuntimeError:
+            return False
+
+    @classmethod
+    def call_soon(cls, func, *args):
+        """تنفيذ func على خيط الحلقة؛ آمن من أي خيط"""
+        loop = cls.loop()
+        if cls.in_loop():
+            return loop.call_soon(func, *args)
+        return loop.call_soon_threadsafe(func, *args)
+
+    @classmethod
+    def spawn(cls, coro):
+        """تشغيل coroutine على الحلقة؛ يعيد Task من داخل الحلقة أو concurrent Future من خيط آخر"""
+        loop = cls.loop()
+        if cls.in_loop():
+            future = loop.create_task(cls._tracked(coro))
+        else:
+            future = asyncio.run_coroutine_threadsafe(cls._tracked(coro), loop)
+        # مهمة أُلغيت قبل أول خطوة لا تصل إلى coro؛ إغلاقه يمنع تحذير "never awaited"
+        future.add_done_callback(lambda f: f.cancelled() and coro.close())
+        return future
+
+    @classmethod
+    def run(cls, coro, timeout=None):
+        """انتظار نتيجة coroutine من خيط خارج الحلقة (سطر الأوامر)"""
+        if cls.in_loop():
+            raise RuntimeError("AsyncRuntime.run() would block the event loop")
+        return cls.spawn(coro).result(timeout)
+
+    @classmethod
+    def executor(cls):
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.max_workers, thread_name_prefix='blocking')
+            return cls._executor
+
+    @classmethod
+    async def run_blocking(cls, func, *args, **kwargs):
+        """تنفيذ عمل حاجب في المنفذ المحدود دون حجب الحلقة"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls.executor(), functools.partial(func, *args, **kwargs))
+
+    @classmethod
+    async def single_flight(cls, key, func, *args, **kwargs):
+        """مثل run_blocking لكن الطلبات المتزامنة بنفس المفتاح تشترك في تنفيذ واحد؛
+        إلغاء أحد المنتظرين لا يلغي التنفيذ المشترك"""
+        future = cls._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(cls.run_blocking(func, *args, **kwargs))
+            cls._inflight[key] = future
+
+            def forget(done):
+                if cls._inflight.get(key) is done:
+                    del cls._inflight[key]
+                # قراءة الاستثناء حتى لا تُسجل كـ "never retrieved" إذا ألغي كل المنتظرين
+                if not done.cancelled():
+                    done.exception()
+            future.add_done_callback(forget)
+        return await asyncio.shield(future)
+
+    @classmethod
+    def shutdown(cls):
+        """إيقاف المنفذ والحلقة الخاصة (حلقة Toga يوقفها التطبيق نفسه)"""
+        with cls._lock:
+            executor, cls._executor = cls._executor, None
+            loop, thread = cls._loop, cls._own_thread
+            cls._loop = cls._own_thread = None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if thread is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=2)
+
+    @classmethod
+    async def _tracked(cls, coro):
+        task = asyncio.current_task()
+        cls._tasks.add(task)
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background task failed: {e}")
+            raise
+        finally:
+            cls._tasks.discard(task)
+
+class DownloadJob:
+    """مهمة تحميل واحدة داخل طابور المجدول"""
+    def __init__(self, download_id, target, args=(), priority=0, url=None):
+        self.download_id = download_id
+        self.target = target
+        self.args = args
+        self.priority = priority
+        self.url = url
+        self.host = (urlparse(url).hostname or '') if url else ''
+        self.state = 'queued'
+        self.cancelled = False
+        self.thread = None
+        self.created_at = time.time()
+        self.started_at = None
+        # الحدث مضبوط = يعمل، غير مضبوط = متوقف مؤقتاً
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+
+class DownloadManager:
+    """مدير التحميل: طابور أولويات يعمل عليه عدد محدود من العمال
+    مع حد عام للتحميلات المتزامنة وحد لكل مضيف"""
+    max_concurrent = MAX_CONCURRENT_DOWNLOADS
+    per_host_limit = MAX_DOWNLOADS_PER_HOST
+    host_limits = {}
+
+    _jobs = {}
+    _queue = []
+    _counter = itertools.count()
+    _condition = threading.Condition()
+    _workers = []
+    _running = 0
+    _running_per_host = {}
+
+    @classmethod
+    def configure(cls, max_concurrent=None, per_host_limit=None, host_limits=None):
+        with cls._condition:
+            if max_concurrent is not None:
+                cls.max_concurrent = max(1, int(max_concurrent))
+            if per_host_limit is not None:
+                cls.per_host_limit = max(1, int(per_host_limit))
+            if host_limits is not None:
+                cls.host_limits = dict(host_limits)
+            cls._ensure_workers()
+            cls._condition.notify_all()
+
+    @classmethod
+    def submit(cls, download_id, target, args=(), priority=0, url=None):
+        """إضافة مهمة إلى الطابور؛ الأولوية الأعلى تبدأ أولاً"""
+        job = DownloadJob(download_id, target, args, priority, url)
+        with cls._condition:
+            cls._jobs[download_id] = job
+            cls._push(job)
+            cls._ensure_workers()
+            cls._condition.notify_all()
+        return job
+
+    @classmethod
+    def cancel_download(cls, download_id):
+        with cls._condition:
+            job = cls._jobs.get(download_id)
+            if not job:
+                return
+            job.cancelled = True
+            # فك التوقف المؤقت حتى يرى الخطاف طلب الإلغاء
+            job.resume_event.set()
+            if job.started_at is None:
+                job.state = 'cancelled'
+                del cls._jobs[download_id]
+            cls._condition.notify_all()
+
+    @classmethod
+    def pause_download(cls, download_id):
+        with cls._condition:
+            job = cls._jobs.get(download_id)
+            if job and job.state in ('queued', 'running'):
+                job.state = 'paused'
+                job.resume_event.clear()
+
+    @classmethod
+    def resume_download(cls, download_id):
+        with cls._condition:
+            job = cls._jobs.get(download_id)
+            if not job or job.state != 'paused':
+                return
+            job.resume_event.set()
+            if job.started_at is None:
+                job.state = 'queued'
+                cls._push(job)
+                cls._condition.notify_all()
+            else:
+                job.state = 'running'
+
+    @classmethod
+    def should_cancel(cls, download_id):
+        job = cls._jobs.get(download_id)
+        return job.cancelled if job else False
+
+    @classmethod
+    def is_paused(cls, download_id):
+        job = cls._jobs.get(download_id)
+        return bool(job) and not job.resume_event.is_set()
+
+    @classmethod
+    def wait_if_paused(cls, download_id):
+        """يُستدعى من خيط التحميل ويحجبه طالما المهمة متوقفة مؤقتاً"""
+        job = cls._jobs.get(download_id)
+        if job:
+            job.resume_event.wait()
+
+    @classmethod
+    def get_job(cls, download_id):
+        return cls._jobs.get(download_id)
+
+    @classmethod
+    def queue_position(cls, download_id):
+        """عدد المهام المنتظرة قبل هذه المهمة، أو None إذا لم تعد في الطابور"""
+        with cls._condition:
+            job = cls._jobs.get(download_id)
+            if not job or job.started_at is not None:
+                return None
+            key = (-job.priority, job.created_at)
+            return sum(1 for other in cls._jobs.values()
+                       if other.state == 'queued' and other.started_at is None
+                       and (-other.priority, other.created_at) < key)
+
+    @classmethod
+    def has_pending_downloads(cls):
+        with cls._condition:
+            return any(job.state in ('queued', 'running', 'paused') for job in cls._jobs.values())
+
+    @classmethod
+    def wait_until_idle(cls, timeout=None):
+        """انتظار انتهاء كل المهام المجدولة؛ يعيد False عند انتهاء المهلة"""
+        deadline = None if timeout is None else time.time() + timeout
+        with cls._condition:
+            while any(job.state in ('queued', 'running', 'paused') for job in cls._jobs.values()):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                cls._condition.wait(remaining)
+        return True
+
+    @classmethod
+    def list_jobs(cls):
+        with cls._condition:
+            return [{
+                'id': job.download_id,
+                'url': job.url,
+                'state': job.state,
+                'priority': job.priority,
+            } for job in cls._jobs.values()]
+
+    @classmethod
+    def get_active_downloads(cls):
+        with cls._condition:
+            return {download_id: job.thread for download_id, job in cls._jobs.items() if job.thread is not None}
+
+    @classmethod
+    def _push(cls, job):
+        heapq.heappush(cls._queue, (-job.priority, next(cls._counter), job.download_id))
+
+    @classmethod
+    def _host_limit(cls, host):
+        return cls.host_limits.get(host, cls.per_host_limit)
+
+    @classmethod
+    def _ensure_workers(cls):
+        cls._workers = [w for w in cls._workers if w.is_alive()]
+        while len(cls._workers) < cls.max_concurrent:
+            worker = threading.Thread(target=cls._worker_loop, name=f"download-worker-{len(cls._workers)}", daemon=True)
+            cls._workers.append(worker)
+            worker.start()
+
+    @classmethod
+    def _next_job_locked(cls):
+        if cls._running >= cls.max_concurrent:
+            return None
+        skipped = []
+        job = None
+        while cls._queue:
+            entry = heapq.heappop(cls._queue)
+            candidate = cls._jobs.get(entry[2])
+            # مدخلات قديمة لمهام ملغاة أو بدأت أو متوقفة تُهمل
+            if candidate is None or candidate.state != 'queued' or candidate.started_at is not None:
+                continue
+            if cls._running_per_host.get(candidate.host, 0) >= cls._host_limit(candidate.host):
+                skipped.append(entry)
+                continue
+            job = candidate
+            break
+        for entry in skipped:
+            heapq.heappush(cls._queue, entry)
+        return job
+
+    @classmethod
+    def _worker_loop(cls):
+        while True:
+            with cls._condition:
+                job = cls._next_job_locked()
+                while job is None:
+                    cls._condition.wait()
+                    job = cls._next_job_locked()
+                job.state = 'running'
+                job.started_at = time.time()
+                job.thread = threading.current_thread()
+                cls._running += 1
+                cls._running_per_host[job.host] = cls._running_per_host.get(job.host, 0) + 1
+            Metrics.record_span('queue_wait', job.created_at, job.started_at, job.download_id)
+
+            final_state = 'done'
+            try:
+                job.target(*job.args)
+            except Exception as e:
+                logger.error(f"Download job {job.download_id} failed: {e}")
+                final_state = 'failed'
+            finally:
+                with cls._condition:
+                    job.state = 'cancelled' if job.cancelled else final_state
+                    job.thread = None
+                    cls._running -= 1
+                    cls._running_per_host[job.host] -= 1
+                    if not cls._running_per_host[job.host]:
+                        del cls._running_per_host[job.host]
+                    cls._jobs.pop(job.download_id, None)
+                    cls._condition.notify_all()
+
+class BandwidthGovernor:
+    """محدد عرض النطاق على مستوى العملية لكل مهام DownloadManager: دلو رموز لكل مهمة
+    بمعدل يُحسب بالتقسيم العادل للحد العام بين المهام النشطة، مع حد لكل مهمة
+    وجداول حسب وقت اليوم (مثلاً بدون حد ليلاً)"""
+    global_rate = BANDWIDTH_LIMIT
+    per_job_rate = BANDWIDTH_JOB_LIMIT
+    profiles = []
+    # مهمة لم تستهلك شيئاً خلال هذه المدة (متوقفة أو في مرحلة الدمج) تترك حصتها للبقية
+    idle_after = 2.0
+    burst_seconds = 0.5
+
+    _jobs = {}
+    _job_limits = {}
+    _lock = threading.Lock()
+    _allocated_at = 0
+
+    @classmethod
+    def configure(cls, global_rate=None, per_job_rate=None, profiles=None):
+        """المعدلات بالبايت/ثانية و 0 تعني بدون حد؛ profiles: ['HH:MM-HH:MM=RATE', ...]"""
+        with cls._lock:
+            if global_rate is not None:
+                cls.global_rate = max(0, int(global_rate))
+            if per_job_rate is not None:
+                cls.per_job_rate = max(0, int(per_job_rate))
+            if profiles is not None:
+                cls.profiles = [cls.parse_profile(p) if isinstance(p, str) else tuple(p) for p in profiles]
+            cls._allocated_at = 0
+
+    @staticmethod
+    def parse_profile(text):
+        """'23:00-07:00=0' إلى (دقيقة البداية، دقيقة النهاية، المعدل)"""
+        match = re.fullmatch(r'\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\S+)\s*', text)
+        if not match:
+            raise ValueError(f"invalid bandwidth profile: {text}")
+        h1, m1, h2, m2, rate = match.groups()
+        return int(h1) * 60 + int(m1), int(h2) * 60 + int(m2), parse_rate(rate)
+
+    @classmethod
+    def set_job_limit(cls, download_id, rate):
+        with cls._lock:
+            if rate:
+                cls._job_limits[download_id] = int(rate)
+            else:
+                cls._job_limits.pop(download_id, None)
+            cls._allocated_at = 0
+
+    @classmethod
+    def release(cls, download_id):
+        with cls._lock:
+            cls._jobs.pop(download_id, None)
+            cls._job_limits.pop(download_id, None)
+            cls._allocated_at = 0
+
+    @classmethod
+    def current_global_rate(cls, now=None):
+        """الحد العام الساري الآن بعد تطبيق جداول وقت اليوم"""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in cls.profiles:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return cls.global_rate
+
+    @classmethod
+    def consume(cls, download_id, num_bytes):
+        """احتساب بايتات مستلمة وحجب الخيط حتى تسمح حصة المهمة بها؛ يعيد مدة الانتظار"""
+        now = time.monotonic()
+        with cls._lock:
+            job = cls._jobs.get(download_id)
+            if job is None:
+                job = cls._jobs[download_id] = {'tokens': 0.0, 'updated': now, 'rate': 0, 'last_seen': now}
+                cls._allocated_at = 0
+            job['last_seen'] = now
+            if now - cls._allocated_at >= 0.25:
+                cls._allocate(now)
+            rate = job['rate']
+            if not rate:
+                job['tokens'] = 0.0
+                job['updated'] = now
+                return 0
+            job['tokens'] = min(rate * cls.burst_seconds, job['tokens'] + (now - job['updated']) * rate)
+            job['updated'] = now
+            job['tokens'] -= num_bytes
+            delay = -job['tokens'] / rate if job['tokens'] < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'global_rate': cls.current_global_rate(),
+                'jobs': {download_id: job['rate'] for download_id, job in cls._jobs.items()},
+            }
+
+    @classmethod
+    def _job_cap(cls, download_id):
+        return cls._job_limits.get(download_id) or cls.per_job_rate or None
+
+    @classmethod
+    def _allocate(cls, now):
+        """تقسيم عادل (max-min): المهام ذات الحد الأقل تأخذه والباقي يُوزع على البقية"""
+        cls._allocated_at = now
+        active = [(download_id, job) for download_id, job in cls._jobs.items()
+                  if now - job['last_seen'] < cls.idle_after]
+        global_rate = cls.current_global_rate()
+        if not global_rate:
+            for download_id, job in active:
+                job['rate'] = cls._job_cap(download_id) or 0
+            return
+        active.sort(key=lambda item: cls._job_cap(item[0]) or float('inf'))
+        remaining = global_rate
+        for i, (download_id, job) in enumerate(active):
+            share = remaining / (len(active) - i)
+            cap = cls._job_cap(download_id)
+            job['rate'] = max(1, int(min(cap, share) if cap else share))
+            remaining -= job['rate']
+
+class InsufficientDiskSpace(OSError):
+    """المساحة الحرة لا تكفي للمهمة مع ما حجزته المهام الأخرى"""
+    def __init__(self, needed, available=None):
+        message = f"Not enough disk space: need {format_bytes(needed)}"
+        if available is not None:
+            message += f", {format_bytes(max(0, available))} available"
+        super().__init__(message)
+        self.errno = errno.ENOSPC
+        self.needed = needed
+        self.available = available
+
+class DiskPolicy:
+    """سياسة القرص لكل المهام: قبول المهمة فقط إذا كفت المساحة الحرة لها ولكل المهام
+    المنتظرة والجارية (بدل فشل غامض بعد تحميل مئات الميغابايت)، وإعدادات الكتابة
+    (حجم الذاكرة المؤقتة وسياسة fsync)"""
+    reserve_bytes = DISK_RESERVE_BYTES
+    write_buffer_size = WRITE_BUFFER_SIZE
+    fsync_policy = FSYNC_POLICY
+    FSYNC_POLICIES = ('never', 'end', 'range')
+    # الملفات التي تكتبها مهمة بجانب المسار المحجوز
+    SUFFIXES = ('', '.part', '.segments.part', '.transcode.part')
+
+    _jobs = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, reserve_bytes=None, write_buffer_size=None, fsync_policy=None):
+        if fsync_policy is not None and fsync_policy not in cls.FSYNC_POLICIES:
+            raise ValueError(f"fsync policy must be one of {', '.join(cls.FSYNC_POLICIES)}")
+        with cls._lock:
+            if reserve_bytes is not None:
+                cls.reserve_bytes = max(0, int(reserve_bytes))
+            if write_buffer_size is not None:
+                cls.write_buffer_size = max(64 * 1024, int(write_buffer_size))
+            if fsync_policy is not None:
+                cls.fsync_policy = fsync_policy
+
+    @classmethod
+    def admit(cls, download_id, folder, needed, paths=()):
+        """حجز needed بايت للمهمة على قرص folder أو رفع InsufficientDiskSpace؛
+        استدعاء ثانٍ لنفس المهمة (بعد معرفة الحجم الدقيق) يستبدل الحجز الأول"""
+        if not needed:
+            return
+        os.makedirs(folder, exist_ok=True)
+        with cls._lock:
+            device = os.stat(folder).st_dev
+            free = shutil.disk_usage(folder).free
+            committed = sum(cls._outstanding(job) for other_id, job in cls._jobs.items()
+                            if other_id != download_id and job['device'] == device)
+            # ما كُتب سابقاً لهذه المهمة (استئناف) مخصوم من المساحة الحرة أصلاً
+            outstanding = max(0, needed - cls._allocated(paths))
+            available = free - committed - cls.reserve_bytes
+            if outstanding > available:
+                Metrics.inc('disk_admission_rejected_total')
+                raise InsufficientDiskSpace(outstanding, available)
+            cls._jobs[download_id] = {'device': device, 'bytes': needed, 'paths': list(paths)}
+
+    @classmethod
+    def release(cls, download_id):
+        with cls._lock:
+            cls._jobs.pop(download_id, None)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'jobs': len(cls._jobs),
+                'reserved_bytes': sum(job['bytes'] for job in cls._jobs.values()),
+                'outstanding_bytes': sum(cls._outstanding(job) for job in cls._jobs.values()),
+            }
+
+    @classmethod
+    def _outstanding(cls, job):
+        return max(0, job['bytes'] - cls._allocated(job['paths']))
+
+    @classmethod
+    def _allocated(cls, paths):
+        total = 0
+        for path in paths:
+            for suffix in cls.SUFFIXES:
+                try:
+                    stat = os.stat(path + suffix)
+                except OSError:
+                    continue
+                # st_blocks يشمل المحجوز مسبقاً بـ fallocate وليس الحجم الظاهري لملف متفرق
+                total += stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+        return total
+
+def preallocate(fd, size):
+    """حجز size بايت فعلياً للملف لتقليل التجزئة (خاصة على ذاكرة الهواتف)؛
+    نفاد المساحة يرفع InsufficientDiskSpace قبل تحميل أي بايت"""
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise InsufficientDiskSpace(size) from e
+        # نظام ملفات لا يدعم الحجز
+        return False
+
+class OutputWriter:
+    """كتابة تسلسلية بذاكرة كبيرة إلى ملف محجوز مسبقاً بالحجم المتوقع؛
+    عند الإغلاق يُقص الملف إلى ما كُتب فعلاً ويُحفظ حسب DiskPolicy.fsync_policy"""
+    def __init__(self, path, expected_size=None):
+        self.path = path
+        self.written = 0
+        self._file = open(path, 'wb', buffering=DiskPolicy.write_buffer_size)
+        try:
+            preallocate(self._file.fileno(), expected_size)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def write(self, data):
+        self._file.write(data)
+        self.written += len(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._file.flush()
+            self._file.truncate(self.written)
+            if DiskPolicy.fsync_policy != 'never':
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+class YoutubeDLSession:
+    """نسخة YoutubeDL طويلة العمر داخل YoutubeDLPool مع خيارات المهمة الحالية"""
+    _MISSING = object()
+
+    def __init__(self, ydl, key):
+        self.ydl = ydl
+        self.key = key
+        self.uses = 0
+        self.idle_since = time.monotonic()
+        self.hooks = []
+        self._saved = {}
+        self._selectors = {}
+        # خطاف واحد دائم يمرر الأحداث لخطافات المهمة المستعيرة حالياً
+        ydl.add_progress_hook(self._dispatch)
+
+    def _dispatch(self, d):
+        for hook in self.hooks:
+            hook(d)
+
+    def apply(self, overrides, progress_hooks=None):
+        params = self.ydl.params
+        self._saved = {name: params.get(name, self._MISSING) for name in overrides}
+        params.update(overrides)
+        if 'format' in overrides:
+            # yt-dlp يبني محدِّد الصيغة مرة واحدة عند الإنشاء
+            self._saved[None] = self.ydl.format_selector
+            self.ydl.format_selector = self.selector(overrides['format'])
+        self.hooks = list(progress_hooks or [])
+
+    def restore(self):
+        params = self.ydl.params
+        for name, value in self._saved.items():
+            if name is None:
+                self.ydl.format_selector = value
+            elif value is self._MISSING:
+                params.pop(name, None)
+            else:
+                params[name] = value
+        self._saved = {}
+        self.hooks = []
+
+    def selector(self, spec):
+        if spec in (None, '-') or callable(spec):
+            return spec
+        if spec not in self._selectors:
+            self._selectors[spec] = self.ydl.build_format_selector(spec)
+        return self._selectors[spec]
+
+    def close(self):
+        try:
+            self.ydl.close()
+        except Exception as e:
+            logger.error(f"Failed to close yt-dlp session: {e}")
+
+class YoutubeDLPool:
+    """جلسات YoutubeDL مشتركة بدل نسخة جديدة لكل استخراج أو تحميل: المستخرجات المهيأة
+    واتصالات keep-alive تبقى، وجرة كوكيز واحدة لكل الجلسات (ولجلسة requests في التحميل المقسم).
+    كل جلسة تُستعار حصرياً، وخيارات المهمة تُطبق عند الاستعارة وتُعاد عند الإرجاع"""
+    BASE_PARAMS = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'socket_timeout': 30}
+    # خيارات تُقرأ مرة واحدة عند إنشاء النسخة (الشبكة والترويسات)؛ اختلافها يعني جلسة منفصلة
+    INIT_PARAMS = ('http_headers', 'proxy', 'socket_timeout', 'source_address', 'nocheckcertificate',
+                   'impersonate', 'cookiefile', 'cookiesfrombrowser', 'compat_opts')
+    max_sessions = YTDL_POOL_SIZE
+    idle_timeout = YTDL_SESSION_IDLE
+    max_uses = YTDL_SESSION_MAX_USES
+
+    # الجلسات الخاملة بترتيب الإرجاع؛ الأحدث يُستعار أولاً لأن اتصالاته ما زالت مفتوحة
+    _idle = []
+    _busy = 0
+    _created = 0
+    _reused = 0
+    _cookiejar = None
+    _condition = threading.Condition()
+
+    @classmethod
+    def configure(cls, max_sessions=None, idle_timeout=None, max_uses=None):
+        with cls._condition:
+            if max_sessions is not None:
+                cls.max_sessions = max(1, int(max_sessions))
+            if idle_timeout is not None:
+                cls.idle_timeout = idle_timeout
+            if max_uses is not None:
+                cls.max_uses = max(1, int(max_uses))
+            cls._condition.notify_all()
+
+    @classmethod
+    def cookiejar(cls):
+        with cls._condition:
+            if cls._cookiejar is None:
+                cls._cookiejar = yt_dlp.cookies.load_cookies(COOKIE_FILE, None, None)
+            return cls._cookiejar
+
+    @classmethod
+    @contextlib.contextmanager
+    def session(cls, progress_hooks=None, **overrides):
+        """with YoutubeDLPool.session(format='best', noplaylist=True) as ydl: ..."""
+        init = {name: value for name, value in overrides.items() if name in cls.INIT_PARAMS}
+        session = cls._checkout(init)
+        session.apply({name: value for name, value in overrides.items() if name not in init}, progress_hooks)
+        healthy = False
+        try:
+            yield session.ydl
+            healthy = True
+        except (Exception, GeneratorExit):
+            # أخطاء الاستخراج والتحميل (والإلغاء عبر الخطاف) لا تفسد الجلسة
+            healthy = True
+            raise
+        finally:
+            session.restore()
+            cls._checkin(session, healthy)
+
+    @classmethod
+    def stats(cls):
+        with cls._condition:
+            return {'idle': len(cls._idle), 'busy': cls._busy, 'created': cls._created, 'reused': cls._reused}
+
+    @classmethod
+    def close_all(cls):
+        """إغلاق الجلسات الخاملة وحفظ الكوكيز (عند الخروج)"""
+        with cls._condition:
+            idle, cls._idle = cls._idle, []
+            jar = cls._cookiejar
+        for session in idle:
+            session.close()
+        if jar is not None and COOKIE_FILE:
+            try:
+                jar.save()
+            except OSError as e:
+                logger.error(f"Failed to save cookies: {e}")
+
+    @classmethod
+    def _checkout(cls, init):
+        key = tuple(sorted((name, repr(value)) for name, value in init.items()))
+        stale = []
+        try:
+            with cls._condition:
+                while True:
+                    now = time.monotonic()
+                    stale += [s for s in cls._idle if now - s.idle_since > cls.idle_timeout]
+                    cls._idle = [s for s in cls._idle if s not in stale]
+                    for index in range(len(cls._idle) - 1, -1, -1):
+                        if cls._idle[index].key == key:
+                            cls._busy += 1
+                            cls._reused += 1
+                            return cls._idle.pop(index)
+                    if cls._busy + len(cls._idle) < cls.max_sessions:
+                        break
+                    if cls._idle:
+                        # الحد ممتلئ بجلسات خاملة بخيارات أخرى: نغلق الأقدم لنفسح مكاناً
+                        stale.append(cls._idle.pop(0))
+                        break
+                    cls._condition.wait()
+                cls._busy += 1
+                cls._created += 1
+        finally:
+            for session in stale:
+                session.close()
+
+        # إنشاء النسخة خارج القفل لأنه يحمّل المستخرجات
+        try:
+            ydl = yt_dlp.YoutubeDL(dict(cls.BASE_PARAMS, **init))
+            if 'cookiefile' not in init and 'cookiesfrombrowser' not in init:
+                ydl.cookiejar = cls.cookiejar()
+        except BaseException:
+            with cls._condition:
+                cls._busy -= 1
+                cls._condition.notify()
+            raise
+        return YoutubeDLSession(ydl, key)
+
+    @classmethod
+    def _checkin(cls, session, healthy):
+        session.uses += 1
+        session.idle_since = time.monotonic()
+        keep = healthy and session.uses < cls.max_uses
+        with cls._condition:
+            cls._busy -= 1
+            if keep:
+                cls._idle.append(session)
+            cls._condition.notify()
+        if not keep:
+            session.close()
+
+class MetadataCache:
+    """ذاكرة تخزين مؤقت على مستويين لمعلومات الفيديو:
+    LRU محدودة في الذاكرة + مخزن على القرص بمدة صلاحية وحد للحجم"""
+    # حقول كبيرة لا تحتاجها الواجهة
+    HEAVY_FIELDS = ('automatic_captions', 'subtitles', 'heatmap', 'requested_subtitles')
+    # معاملات تتبع لا تغيّر المحتوى
+    TRACKING_PARAMS = ('si', 'feature', 'pp', 'fbclid', 'gclid')
+    YOUTUBE_ID_RE = re.compile(r'(?:youtu\.be/|youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/))([\w-]{11})')
+
+    def __init__(self, folder, memory_size=64, ttl=3600, max_disk_bytes=50 * 1024**2):
+        self.folder = folder
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def normalize_key(cls, url):
+        """مفتاح موحد: معرّف الفيديو ليوتيوب، أو الرابط بعد تنظيفه لغيره"""
+        url = url.strip()
+        match = cls.YOUTUBE_ID_RE.search(url)
+        parts = urlparse(url)
+        if match:
+            # رابط فيديو داخل قائمة يعطي القائمة كاملة من fetch_info، فلا يشارك مفتاح الفيديو وحده
+            playlist = dict(parse_qsl(parts.query)).get('list')
+            return f"Youtube:{match.group(1)}" + (f"&list={playlist}" if playlist else '')
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                       if not k.startswith('utm_') and k not in cls.TRACKING_PARAMS)
+        path = parts.path.rstrip('/') or '/'
+        return urlunparse((parts.scheme.lower(), parts.netloc.lower(), path, '', urlencode(query), ''))
+
+    @staticmethod
+    def info_keys(info):
+        keys = []
+        if info.get('extractor_key') and info.get('id'):
+            keys.append(f"{info['extractor_key']}:{info['id']}")
+        if info.get('webpage_url'):
+            keys.append(MetadataCache.normalize_key(info['webpage_url']))
+        return keys
+
+    def get(self, url):
+        key = self.normalize_key(url)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if entry:
+                del self._memory[key]
+
+        info, expires_at = self._read_disk(key, now)
+        with self._lock:
+            if info is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, info, expires_at)
+        return info
+
+    def put(self, url, info, ttl=None):
+        info = {k: v for k, v in info.items() if k not in self.HEAVY_FIELDS}
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        keys = [self.normalize_key(url)]
+        keys += [k for k in self.info_keys(info) if k not in keys]
+        with self._lock:
+            for key in keys:
+                self._remember(key, info, expires_at)
+        # المحتوى يُكتب مرة واحدة تحت المفتاح الأساسي، وباقي المفاتيح مجرد إحالات
+        canonical = (self.info_keys(info) or keys)[0]
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            self._write_atomic(self._path(canonical), json.dumps({'expires_at': expires_at, 'info': info}))
+            alias = json.dumps({'expires_at': expires_at, 'alias': canonical})
+            for key in keys:
+                if key != canonical:
+                    self._write_atomic(self._path(key), alias)
+            self._evict_disk()
+        except (OSError, TypeError, ValueError) as e:
+            logger.error(f"Failed to persist metadata cache: {e}")
+
+    def invalidate(self, url):
+        key = self.normalize_key(url)
+        with self._lock:
+            self._memory.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
+
+    def _remember(self, key, info, expires_at):
+        self._memory[key] = (expires_at, info)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _read_disk(self, key, now, follow_alias=True):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None, 0
+        if data.get('expires_at', 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None, 0
+        if 'alias' in data:
+            if not follow_alias:
+                return None, 0
+            return self._read_disk(data['alias'], now, follow_alias=False)
+        try:
+            # تحديث وقت التعديل ليعكس آخر استخدام عند الإخلاء
+            os.utime(path)
+        except OSError:
+            pass
+        return data.get('info'), data['expires_at']
+
+    @staticmethod
+    def _write_atomic(path, payload):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+    def _evict_disk(self):
+        """حذف الأقدم استخداماً حتى يعود حجم المجلد تحت الحد"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith('.json'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total <= self.max_disk_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class FormatIndex:
+    """فهرس صيغ يُبنى مرة واحدة لكل استخراج: مرتب ومنزوع التكرار حسب الدقة/الترميز/معدل البت،
+    مع أفضل مرشح لكل فئة وحجم تقديري من tbr × المدة عند غياب filesize"""
+    CODEC_ALIASES = {'vp09': 'vp9', 'hev1': 'hevc', 'hvc1': 'hevc', 'h264': 'avc1', 'h265': 'hevc'}
+    # ترميزات تُدمج في MP4 دون إعادة ترميز
+    MP4_VIDEO_CODECS = ('avc1', 'hevc', 'av01')
+    MP4_AUDIO_CODECS = ('mp4a',)
+    POLICY_RE = {
+        'max_height': re.compile(r'max\s*(\d+)p'),
+        'max_size': re.compile(r'(?:under|below|max)\s*([\d.]+)\s*(k|m|g)i?b', re.IGNORECASE),
+        'prefer_codec': re.compile(r'prefer\s+([\w.]+)'),
+    }
+
+    def __init__(self, info):
+        self.duration = info.get('duration') or 0
+        self.formats = info.get('formats') or []
+        self.videos = []
+        self.audios = []
+        self.muxed = []
+        video_buckets = {}
+        audio_buckets = {}
+        self._by_id = {}
+        self._selected = {}
+        for f in self.formats:
+            entry = self._entry(f)
+            if entry is None:
+                continue
+            self._by_id[entry['format_id']] = entry
+            if entry['kind'] == 'video':
+                key = (entry['height'], entry['vcodec'])
+                if key not in video_buckets or self._rank(entry) > self._rank(video_buckets[key]):
+                    video_buckets[key] = entry
+            elif entry['kind'] == 'audio':
+                key = (entry['acodec'], round(entry['abr'] or 0))
+                if key not in audio_buckets or self._rank(entry) > self._rank(audio_buckets[key]):
+                    audio_buckets[key] = entry
+            else:
+                self.muxed.append(entry)
+        self.videos = sorted(video_buckets.values(), key=lambda e: (e['height'], self._codec_score(e), self._rank(e)), reverse=True)
+        self.audios = sorted(audio_buckets.values(), key=lambda e: (e['abr'] or 0, self._rank(e)), reverse=True)
+        self.muxed.sort(key=lambda e: ((e['height'] or 0), self._rank(e)), reverse=True)
+
+    @classmethod
+    def codec_family(cls, codec):
+        if not codec or codec == 'none':
+            return None
+        family = codec.split('.')[0].lower()
+        return cls.CODEC_ALIASES.get(family, family)
+
+    def _entry(self, f):
+        vcodec = self.codec_family(f.get('vcodec'))
+        acodec = self.codec_family(f.get('acodec'))
+        height = f.get('height') or 0
+        # صيغ HLS والتحميل المباشر كثيراً ما تأتي بدون vcodec؛ الدقة وحدها تكفي لاعتبارها فيديو
+        if height > 0 and (vcodec or f.get('vcodec') is None):
+            kind = 'muxed' if acodec else 'video'
+        elif acodec and (f.get('abr') or f.get('tbr')):
+            kind = 'audio'
+        else:
+            return None
+        bitrate = f.get('tbr') or ((f.get('vbr') or 0) + (f.get('abr') or 0)) or None
+        size = f.get('filesize') or f.get('filesize_approx')
+        estimated = not f.get('filesize')
+        if not size and bitrate and self.duration:
+            size = int(bitrate * 1000 / 8 * self.duration)
+        return {
+            'format_id': f['format_id'],
+            'kind': kind,
+            'height': height,
+            'fps': f.get('fps') or 0,
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'abr': f.get('abr') or (bitrate if kind == 'audio' else None),
+            'tbr': bitrate or 0,
+            'ext': f.get('ext'),
+            'protocol': f.get('protocol'),
+            'size': size,
+            'size_estimated': estimated,
+        }
+
+    @staticmethod
+    def _rank(entry):
+        # الأعلى إطارات ثم معدل بت، والحجم المعروف أفضل من التقديري
+        return (entry['fps'], entry['tbr'], not entry['size_estimated'])
+
+    def _codec_score(self, entry, prefer=None):
+        if prefer and entry['vcodec'] == prefer:
+            return 2
+        return 1 if entry['vcodec'] in self.MP4_VIDEO_CODECS else 0
+
+    @staticmethod
+    def size_label(size, estimated):
+        if not size:
+            return ''
+        return f" ({'~' if estimated else ''}{size / 1024**2:.1f} MB)"
+
+    @staticmethod
+    def download_spec(format_id, audio_only=False):
+        """محدِّد yt-dlp الذي يُحمّل به اختيار المستخدم فعلاً"""
+        if audio_only:
+            # الصوت يُحمّل كما هو ثم يُحوَّل إلى mp3 في مرحلة التحويل
+            return format_id if format_id != 'bestaudio' else 'bestaudio/best'
+        if format_id == 'bestvideo+bestaudio':
+            return 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+        return format_id
+
+    def selected_formats(self, spec):
+        """الصيغ التي سيختارها yt-dlp بهذا المحدِّد من الصيغ المستخرجة (بدون شبكة)، أو []"""
+        if spec not in self._selected:
+            selected = []
+            if self.formats:
+                ctx = {
+                    'formats': self.formats,
+                    'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in self.formats),
+                    'incomplete_formats': all(f.get('vcodec') == 'none' for f in self.formats)
+                    or all(f.get('acodec') == 'none' for f in self.formats),
+                }
+                try:
+                    with YoutubeDLPool.session() as ydl:
+                        chosen = next(iter(ydl.build_format_selector(spec)(ctx)), None)
+                except Exception as e:
+                    logger.info(f"Could not evaluate format selector {spec!r}: {e}")
+                    chosen = None
+                if chosen:
+                    selected = chosen.get('requested_formats') or [chosen]
+            self._selected[spec] = selected
+        return self._selected[spec]
+
+    def format_size(self, f):
+        """filesize من yt-dlp، وإلا تقدير الفهرس من tbr × المدة"""
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size:
+            size = (self._by_id.get(f.get('format_id')) or {}).get('size')
+        return size
+
+    def estimate_size(self, format_id, audio_only=False):
+        """الحجم المتوقع بالبايت لما سيُحمّل بهذا الاختيار (مجموع الأجزاء عند الدمج)، أو None إذا كان مجهولاً"""
+        selected = self.selected_formats(self.download_spec(format_id, audio_only))
+        sizes = [self.format_size(f) for f in selected]
+        return sum(sizes) if sizes and all(sizes) else None
+
+    def best_audio(self, mp4_compatible=False):
+        for entry in self.audios:
+            if not mp4_compatible or entry['acodec'] in self.MP4_AUDIO_CODECS:
+                return entry
+        return self.audios[0] if self.audios else None
+
+    def options(self, format_type):
+        """قائمة الخيارات المعروضة للمستخدم: [{'text': ..., 'id': format_id}]"""
+        formats_list = []
+        if format_type == 'mp4':
+            # نفس المحدِّد الذي يُحمّل به هذا الخيار، لا أعلى دقة بأي ترميز
+            label = 'Best Quality (Video + Audio)' + self.size_label(self.estimate_size('bestvideo+bestaudio'), True)
+            formats_list.append({'text': label, 'id': 'bestvideo+bestaudio'})
+            # أفضل مرشح لكل دقة (مدمج ثم فيديو فقط)، مع تفضيل الترميز المتوافق مع MP4
+            best_per_height = {}
+            for prefix, entries in (('Video + Audio', self.muxed), ('Video Only', self.videos)):
+                for entry in entries:
+                    key = (entry['height'], prefix)
+                    if key not in best_per_height or \
+                            (self._codec_score(entry), self._rank(entry)) > (self._codec_score(best_per_height[key]), self._rank(best_per_height[key])):
+                        best_per_height[key] = entry
+            for (height, prefix), entry in sorted(best_per_height.items(), key=lambda item: (item[0][0], item[0][1] == 'Video + Audio'), reverse=True):
+                codec = f" {entry['vcodec']}" if entry['vcodec'] else ''
+                text = f"{prefix}: {height}p{codec}{self.size_label(entry['size'], entry['size_estimated'])}"
+                formats_list.append({'text': text, 'id': entry['format_id']})
+        elif format_type == 'mp3':
+            for entry in self.audios:
+                text = f"{round(entry['abr'])}kbps {entry['acodec']}{self.size_label(entry['size'], entry['size_estimated'])}"
+                formats_list.append({'text': text, 'id': entry['format_id']})
+            if not formats_list:
+                formats_list.append({'text': 'Best Audio', 'id': 'bestaudio'})
+        if not formats_list:
+            formats_list.append({'text': 'Default Quality', 'id': 'best'})
+        return formats_list
+
+    @classmethod
+    def parse_policy(cls, policy):
+        """'best under 50 MB' أو 'max 720p, prefer avc1' إلى معاملات select"""
+        policy = (policy or '').lower()
+        params = {}
+        match = cls.POLICY_RE['max_height'].search(policy)
+        if match:
+            params['max_height'] = int(match.group(1))
+        match = cls.POLICY_RE['max_size'].search(policy)
+        if match:
+            unit = {'k': 1024, 'm': 1024**2, 'g': 1024**3}[match.group(2).lower()]
+            params['max_size'] = int(float(match.group(1)) * unit)
+        match = cls.POLICY_RE['prefer_codec'].search(policy)
+        if match:
+            params['prefer_codec'] = cls.codec_family(match.group(1))
+        params['audio_only'] = 'audio' in policy or 'mp3' in policy
+        return params
+
+    def select(self, max_height=None, max_size=None, prefer_codec=None, audio_only=False):
+        """أفضل صيغة (أو فيديو+صوت) ضمن القيود؛ يعيد {'format': ..., 'size': ..., 'height': ...} أو None"""
+        if audio_only:
+            for entry in self.audios:
+                if max_size is None or (entry['size'] and entry['size'] <= max_size):
+                    return {'format': entry['format_id'], 'size': entry['size'], 'height': None}
+            return None
+
+        audio = self.best_audio(mp4_compatible=True)
+        candidates = []
+        for video in self.videos:
+            if max_height and video['height'] > max_height:
+                continue
+            # حجم مجهول لأي من الجزأين يجعل المجموع مجهولاً، لا حجم الجزء المعروف وحده
+            sizes = [video['size']] + ([audio['size']] if audio else [])
+            size = sum(sizes) if all(sizes) else None
+            fmt = f"{video['format_id']}+{audio['format_id']}" if audio else video['format_id']
+            candidates.append((video['height'], self._codec_score(video, prefer_codec), video['tbr'], fmt, size))
+        for muxed in self.muxed:
+            if max_height and muxed['height'] > max_height:
+                continue
+            candidates.append((muxed['height'], self._codec_score(muxed, prefer_codec), muxed['tbr'], muxed['format_id'], muxed['size']))
+        candidates.sort(reverse=True)
+        for height, _, _, fmt, size in candidates:
+            if max_size is None or (size and size <= max_size):
+                return {'format': fmt, 'size': size, 'height': height}
+        return None
+
+class ThumbnailCache:
+    """مسار الصور المصغرة: جلسة HTTP مشتركة، تخزين على القرص حسب المحتوى
+    بحد للحجم، إعادة تحقق شرطية، وتصغير اختياري لحجم العرض"""
+    EXTENSIONS = {'image/webp': '.webp', 'image/png': '.png', 'image/jpeg': '.jpg'}
+
+    def __init__(self, folder, max_bytes=30 * 1024**2, fresh_for=24 * 3600, timeout=10):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.timeout = timeout
+        self.index_path = os.path.join(folder, 'index.json')
+        self._lock = threading.Lock()
+        self._index = None
+        self._session = None
+
+    @property
+    def session(self):
+        # جلسة واحدة تعيد استخدام الاتصالات (keep-alive) بين الطلبات
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def fetch(self, url, size=None):
+        """إرجاع مسار محلي للصورة (مصغرة إلى size إن أمكن)، أو None عند الفشل"""
+        entry = self._lookup(url)
+        path = self._content_path(entry) if entry else None
+        if path and not os.path.exists(path):
+            entry, path = None, None
+
+        started = time.time()
+        if entry and time.time() - entry.get('checked_at', 0) < self.fresh_for:
+            self._touch(path)
+            Metrics.record_span('thumbnail', started, time.time(), result='cached')
+            return self._sized(path, size)
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 304 and entry:
+                    entry['checked_at'] = time.time()
+                    self._store(url, entry)
+                    self._touch(path)
+                    Metrics.record_span('thumbnail', started, time.time(), result='revalidated')
+                    return self._sized(path, size)
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+                digest, path = self._stream_to_disk(response, self.EXTENSIONS.get(content_type, '.jpg'))
+                entry = {
+                    'hash': digest,
+                    'ext': os.path.splitext(path)[1],
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'checked_at': time.time(),
+                }
+        except Exception as e:
+            logger.error(f"Failed to fetch thumbnail: {e}")
+            Metrics.record_span('thumbnail', started, time.time(), result='error')
+            # عند فشل الشبكة نعرض النسخة القديمة إن وجدت
+            return self._sized(path, size) if path else None
+
+        self._store(url, entry)
+        self._evict()
+        Metrics.record_span('thumbnail', started, time.time(), result='fetched')
+        return self._sized(path, size)
+
+    def _stream_to_disk(self, response, extension):
+        os.makedirs(self.folder, exist_ok=True)
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if chunk:
+                        hasher.update(chunk)
+                        f.write(chunk)
+            digest = hasher.hexdigest()
+            path = os.path.join(self.folder, digest + extension)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return digest, path
+
+    def _sized(self, path, size):
+        """نسخة مصغرة محفوظة بجانب الأصل؛ تتطلب Pillow وإلا يُعاد الأصل"""
+        if not size or not PILImage.available():
+            return path
+        width, height = size
+        base, _ = os.path.splitext(path)
+        sized_path = f"{base}_{width}x{height}.jpg"
+        if os.path.exists(sized_path):
+            self._touch(sized_path)
+            return sized_path
+        try:
+            with PILImage.open(path) as image:
+                image.thumbnail((width, height))
+                tmp_path = sized_path + '.tmp'
+                image.convert('RGB').save(tmp_path, 'JPEG', quality=85)
+            os.replace(tmp_path, sized_path)
+            return sized_path
+        except Exception as e:
+            logger.error(f"Failed to downscale thumbnail: {e}")
+            return path
+
+    def _content_path(self, entry):
+        return os.path.join(self.folder, entry['hash'] + entry.get('ext', '.jpg'))
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _lookup(self, url):
+        with self._lock:
+            entry = self._load_index().get(url)
+            return dict(entry) if entry else None
+
+    def _store(self, url, entry):
+        with self._lock:
+            self._load_index()[url] = entry
+            self._save_index()
+
+    def _save_index(self):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Failed to save thumbnail index: {e}")
+
+    def _evict(self):
+        """حذف الأقدم استخداماً حتى يعود حجم المجلد تحت الحد"""
+        with self._lock:
+            files = []
+            total = 0
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and entry.name != 'index.json' and not entry.name.endswith('.tmp'):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            if total <= self.max_bytes:
+                return
+            files.sort()
+            removed = set()
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    removed.add(os.path.basename(path))
+                except OSError:
+                    pass
+            index = self._load_index()
+            for url in [u for u, e in index.items() if e['hash'] + e.get('ext', '.jpg') in removed]:
+                del index[url]
+            self._save_index()
+
+class JobJournal:
+    """سجل دائم لمهام التحميل (سجل لكل مهمة) يسمح باستئنافها
+    من ملفات .part بعد إعادة تشغيل التطبيق أو انهياره"""
+    PARTIAL_SUFFIXES = ('.part', '.ytdl', '.segments.part', '.transcode.part')
+
+    def __init__(self, folder, write_interval=2.0):
+        self.folder = folder
+        self.write_interval = write_interval
+        self._records = {}
+        self._last_write = {}
+        self._lock = threading.Lock()
+
+    def record(self, download_id, **fields):
+        """إنشاء سجل المهمة أو تحديث حقوله وكتابته فوراً"""
+        with self._lock:
+            record = self._records.setdefault(download_id, {
+                'download_id': download_id,
+                'phase': 'download',
+                'bytes_done': 0,
+                'total_bytes': None,
+                'attempts': 0,
+                'created_at': time.time(),
+            })
+            record.update(fields)
+            self._write(record, sync=True)
+
+    def update_progress(self, download_id, bytes_done, total_bytes=None):
+        """تحديث عدد البايتات المحملة؛ الكتابة على القرص مقيدة بفاصل زمني"""
+        with self._lock:
+            record = self._records.get(download_id)
+            if not record:
+                return
+            record['bytes_done'] = bytes_done
+            if total_bytes:
+                record['total_bytes'] = total_bytes
+            now = time.time()
+            if now - self._last_write.get(download_id, 0) >= self.write_interval:
+                self._write(record)
+
+    def get(self, download_id):
+        with self._lock:
+            return dict(self._records.get(download_id) or {})
+
+    def flush(self):
+        """كتابة كل السجلات المعلقة (عند إغلاق التطبيق)"""
+        with self._lock:
+            for record in self._records.values():
+                self._write(record, sync=True)
+
+    def remove(self, download_id):
+        with self._lock:
+            self._records.pop(download_id, None)
+            self._last_write.pop(download_id, None)
+            try:
+                os.remove(self._path(download_id))
+            except OSError:
+                pass
+
+    def unfinished(self):
+        """تحميل كل السجلات الموجودة على القرص (مهام لم تكتمل)"""
+        records = []
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return records
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name), 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Skipping unreadable journal record {name}: {e}")
+                continue
+            with self._lock:
+                self._records[record['download_id']] = record
+            records.append(record)
+        records.sort(key=lambda r: r.get('created_at', 0))
+        return records
+
+    def _path(self, download_id):
+        return os.path.join(self.folder, hashlib.sha1(download_id.encode('utf-8')).hexdigest() + '.json')
+
+    def _write(self, record, sync=False):
+        record['updated_at'] = time.time()
+        path = self._path(record['download_id'])
+        tmp_path = path + '.tmp'
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(record, f)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._last_write[record['download_id']] = record['updated_at']
+        except OSError as e:
+            logger.error(f"Failed to write journal record: {e}")
+
+    @staticmethod
+    def discard_partial_files(final_path, intermediate_paths=()):
+        """حذف الملفات الجزئية لمهمة ملغاة: المسارات الوسيطة التي سجلتها المهمة بأسمائها
+        الدقيقة مع ملفات .part و .ytdl التابعة لها، ولا شيء غيرها من ملفات المستخدم"""
+        intermediates = [path for path in intermediate_paths if path and path != final_path]
+        candidates = list(intermediates)
+        for path in [final_path] + intermediates:
+            candidates += [path + suffix for suffix in JobJournal.PARTIAL_SUFFIXES]
+        for path in candidates:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
+
+class LibraryIndex:
+    """فهرس دائم (SQLite) للملفات المحملة: معرّف المستخرج + الصيغة إلى المسار والحجم
+    والبصمة، مع حجز ذري لأسماء الملفات ومطابقة تدريجية مع مجلد التحميلات"""
+    PARTIAL_SUFFIXES = ('.part', '.ytdl', '.tmp')
+    FINGERPRINT_BYTES = 1024**2
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.RLock()
+
+    @property
+    def db(self):
+        with self._lock:
+            if self._db is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # autocommit مع معاملات صريحة؛ WAL يسمح للواجهة والخدمة بمشاركة الفهرس
+                db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+                db.execute('PRAGMA journal_mode=WAL')
+                db.executescript("""
+                    CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY, folder TEXT NOT NULL, media_key TEXT, format_key TEXT,
+                        size INTEGER, mtime REAL, checksum TEXT, added_at REAL);
+                    CREATE INDEX IF NOT EXISTS files_media ON files (media_key, format_key);
+                    CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+                    CREATE TABLE IF NOT EXISTS reservations (path TEXT PRIMARY KEY, download_id TEXT, created_at REAL);
+                    CREATE TABLE IF NOT EXISTS name_counters (stem TEXT PRIMARY KEY, next INTEGER NOT NULL);
+                    CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime REAL);
+                """)
+                self._db = db
+            return self._db
+
+    @classmethod
+    def fingerprint(cls, path, size=None):
+        """بصمة سريعة: الحجم + أول وآخر 1 MiB (بدون قراءة الملف كاملاً)"""
+        size = os.path.getsize(path) if size is None else size
+        digest = hashlib.sha256(str(size).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read(cls.FINGERPRINT_BYTES))
+            if size > 2 * cls.FINGERPRINT_BYTES:
+                f.seek(-cls.FINGERPRINT_BYTES, os.SEEK_END)
+                digest.update(f.read(cls.FINGERPRINT_BYTES))
+        return digest.hexdigest()
+
+    def reserve(self, base_path, extension, download_id=None):
+        """حجز اسم غير مستخدم ذرياً: 'name.ext' أو 'name (N).ext' بعدّاد محفوظ لكل اسم
+        بدل تجربة الأسماء واحداً واحداً"""
+        stem = f"{base_path}.{extension}"
+        with self._lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                path = stem
+                if self._taken(db, path):
+                    row = db.execute('SELECT next FROM name_counters WHERE stem = ?', (stem,)).fetchone()
+                    counter = row[0] if row else 1
+                    path = f"{base_path} ({counter}).{extension}"
+                    # الملفات الموجودة قبل الفهرس (أو من برنامج آخر) قد تشغل الاسم التالي
+                    while self._taken(db, path):
+                        counter += 1
+                        path = f"{base_path} ({counter}).{extension}"
+                    db.execute('INSERT OR REPLACE INTO name_counters (stem, next) VALUES (?, ?)', (stem, counter + 1))
+                db.execute('INSERT INTO reservations (path, download_id, created_at) VALUES (?, ?, ?)',
+                           (path, download_id, time.time()))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return path
+
+    def release(self, download_id):
+        """إلغاء حجز اسم مهمة ملغاة"""
+        with self._lock:
+            self.db.execute('DELETE FROM reservations WHERE download_id = ?', (download_id,))
+
+    def add(self, path, media_key=None, format_key=None, download_id=None):
+        """تسجيل ملف مكتمل وتحويل حجز اسمه إلى مدخل في المكتبة"""
+        try:
+            stat = os.stat(path)
+            checksum = self.fingerprint(path, stat.st_size)
+        except OSError as e:
+            logger.error(f"Cannot index {path}: {e}")
+            return
+        with self._lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                    path, os.path.dirname(path), media_key, format_key,
+                    stat.st_size, stat.st_mtime, checksum, time.time()
+                ))
+                db.execute('DELETE FROM reservations WHERE path = ?', (path,))
+                if download_id:
+                    db.execute('DELETE FROM reservations WHERE download_id = ?', (download_id,))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def lookup(self, media_key, format_key):
+        """مسار نسخة موجودة وسليمة من نفس الفيديو والصيغة، أو None"""
+        with self._lock:
+            rows = self.db.execute(
+                'SELECT path, size, mtime FROM files WHERE media_key = ? AND format_key = ? ORDER BY added_at',
+                (media_key, format_key)
+            ).fetchall()
+            for path, size, mtime in rows:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                    continue
+                if stat.st_size == size:
+                    return path
+                # الملف استُبدل بمحتوى آخر: لم يعد نسخة من هذا الفيديو
+                self.db.execute('UPDATE files SET media_key = NULL, size = ?, mtime = ?, checksum = NULL WHERE path = ?',
+                                (stat.st_size, stat.st_mtime, path))
+        return None
+
+    def reconcile(self, folder, active_ids=None):
+        """مطابقة الفهرس مع المجلد فقط إذا تغير (mtime المجلد)، وإسقاط حجوزات
+        المهام التي لم تعد في السجل؛ يعيد عدد المدخلات التي تغيرت"""
+        changes = 0
+        with self._lock:
+            db = self.db
+            if active_ids is not None:
+                active = set(active_ids)
+                for path, download_id in db.execute('SELECT path, download_id FROM reservations').fetchall():
+                    if download_id not in active:
+                        db.execute('DELETE FROM reservations WHERE path = ?', (path,))
+                        changes += 1
+            try:
+                folder_mtime = os.stat(folder).st_mtime
+            except OSError:
+                return changes
+            row = db.execute('SELECT mtime FROM folders WHERE folder = ?', (folder,)).fetchone()
+            if row and row[0] == folder_mtime:
+                return changes
+
+            known = {path: (size, mtime) for path, size, mtime in
+                     db.execute('SELECT path, size, mtime FROM files WHERE folder = ?', (folder,))}
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if not entry.is_file() or entry.name.endswith(self.PARTIAL_SUFFIXES):
+                            continue
+                        stat = entry.stat()
+                        previous = known.pop(entry.path, None)
+                        if previous is None:
+                            # ملف لم ينزله التطبيق: يُسجل لحجز اسمه فقط
+                            db.execute('INSERT INTO files (path, folder, size, mtime, added_at) VALUES (?, ?, ?, ?, ?)',
+                                       (entry.path, folder, stat.st_size, stat.st_mtime, time.time()))
+                            changes += 1
+                        elif previous != (stat.st_size, stat.st_mtime):
+                            db.execute('UPDATE files SET size = ?, mtime = ?, checksum = NULL, '
+                                       'media_key = CASE WHEN size = ? THEN media_key END WHERE path = ?',
+                                       (stat.st_size, stat.st_mtime, stat.st_size, entry.path))
+                            changes += 1
+                for path in known:
+                    db.execute('DELETE FROM files WHERE path = ?', (path,))
+                    changes += 1
+                db.execute('INSERT OR REPLACE INTO folders (folder, mtime) VALUES (?, ?)', (folder, folder_mtime))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return changes
+
+    def stats(self):
+        with self._lock:
+            files, total = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+            reserved = self.db.execute('SELECT COUNT(*) FROM reservations').fetchone()[0]
+        return {'files': files, 'bytes': total, 'reserved': reserved}
+
+    @staticmethod
+    def _taken(db, path):
+        if db.execute('SELECT 1 FROM files WHERE path = ? UNION ALL SELECT 1 FROM reservations WHERE path = ?',
+                      (path, path)).fetchone():
+            return True
+        return os.path.lexists(path) or os.path.exists(path + '.part')
+
+class BatchIngestor:
+    """إدخال دفعي: تعداد قائمة تشغيل/قناة أو عدة روابط بالاستخراج المسطح،
+    ثم حل صيغ كل عنصر بالتوازي وتمريره للتحميل فور جاهزيته"""
+    LINK_RE = re.compile(r'https?://\S+')
+
+    def __init__(self, metadata_cache=None, max_workers=4, on_entry=None, on_error=None, on_done=None):
+        self.metadata_cache = metadata_cache
+        self.max_workers = max_workers
+        self.on_entry = on_entry
+        self.on_error = on_error
+        self.on_done = on_done
+        self.cancelled = threading.Event()
+        self.enumerated = 0
+        self.resolved = 0
+        self.failed = 0
+        self.enumeration_done = False
+        self.task = None
+        self.done = threading.Event()
+
+    @classmethod
+    def split_links(cls, text):
+        return cls.LINK_RE.findall(text or '')
+
+    def start(self, text):
+        links = self.split_links(text)
+        self.task = AsyncRuntime.spawn(self._run(links))
+        return len(links)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """انتظار نهاية التعداد والحل من خيط خارج الحلقة"""
+        return self.done.wait(timeout)
+
+    async def _run(self, links):
+        # حد للعناصر قيد الحل حتى لا يسبق التعداد العمال بمئات المهام
+        slots = asyncio.Semaphore(self.max_workers)
+        pending = set()
+        entries = self._enumerate(links)
+        try:
+            index = 0
+            while not self.cancelled.is_set():
+                # كل خطوة في المولد قد تطلب صفحة جديدة من القائمة عبر yt-dlp
+                entry_url = await AsyncRuntime.run_blocking(next, entries, None)
+                if entry_url is None:
+                    break
+                await slots.acquire()
+                if self.cancelled.is_set():
+                    slots.release()
+                    break
+                self.enumerated += 1
+                task = asyncio.ensure_future(self._resolve_in_slot(slots, entry_url, index))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                index += 1
+            self.enumeration_done = True
+            if pending:
+                await asyncio.gather(*pending)
+        except Exception as e:
+            logger.error(f"Batch enumeration failed: {e}")
+            if self.on_error:
+                self.on_error(None, e)
+        finally:
+            await AsyncRuntime.run_blocking(entries.close)
+            self.enumeration_done = True
+            if self.on_done:
+                self.on_done(self)
+            self.done.set()
+
+    async def _resolve_in_slot(self, slots, url, index):
+        try:
+            await AsyncRuntime.run_blocking(self._resolve, url, index)
+        finally:
+            slots.release()
+
+    def _enumerate(self, links):
+        """توليد روابط العناصر واحداً تلو الآخر دون انتظار اكتمال القائمة"""
+        with YoutubeDLPool.session(extract_flat='in_playlist') as ydl:
+            for link in links:
+                if self.cancelled.is_set():
+                    return
+                try:
+                    info = ydl.extract_info(link, download=False, process=False)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Failed to enumerate {link}: {e}")
+                    if self.on_error:
+                        self.on_error(link, e)
+                    continue
+                if info.get('_type') not in ('playlist', 'multi_video'):
+                    yield link
+                    continue
+                # entries قد تكون مولّداً كسولاً فيبدأ التحميل قبل انتهاء التعداد
+                for entry in info.get('entries') or []:
+                    if self.cancelled.is_set():
+                        return
+                    if not entry:
+                        continue
+                    entry_url = entry.get('webpage_url') or entry.get('url')
+                    if entry_url:
+                        yield entry_url
+
+    def _resolve(self, url, index):
+        if self.cancelled.is_set():
+            return
+        try:
+            info = self.metadata_cache.get(url) if self.metadata_cache else None
+            if info is None:
+                with YoutubeDLPool.session(noplaylist=True) as ydl:
+                    info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+                if info.get('_type') == 'playlist':
+                    raise ValueError("nested playlists are not supported in batch mode")
+                if self.metadata_cache:
+                    self.metadata_cache.put(url, info)
+            self.resolved += 1
+            if self.on_entry and not self.cancelled.is_set():
+                self.on_entry(info, index)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Failed to resolve {url}: {e}")
+            if self.on_error:
+                self.on_error(url, e)
+
+class Prefetcher:
+    """جلب مسبق تخميني للمعلومات والصورة المصغرة بمجرد ظهور رابط محتمل (الحافظة، اللصق، الكتابة)
+    حتى يكون الاستخراج منتهياً أو جارياً عند الضغط على تحميل. يُستدعى من خيط الحلقة فقط.
+    الكتابة تُؤجل بمهلة، والاستخراجات الجارية محدودة بـ max_active وآخر رابط فقط ينتظر دوره"""
+    # روابط قوائم التشغيل والقنوات تتطلب استخراجاً ثقيلاً فلا تُجلب تخمينياً
+    COLLECTION_RE = re.compile(r'[?&]list=|/playlist\b|/channel/|/c/|/user/|/@')
+
+    def __init__(self, engine, thumbnail_size=None, debounce=PREFETCH_DEBOUNCE, max_active=PREFETCH_MAX_ACTIVE):
+        self.engine = engine
+        self.thumbnail_size = thumbnail_size
+        self.debounce = debounce
+        self.max_active = max_active
+        self._timer = None
+        self._scheduled = None
+        self._waiting = None
+        self._active = {}
+
+    @classmethod
+    def candidate(cls, text):
+        """الرابط إذا كان النص رابطاً واحداً لفيديو، وإلا None"""
+        text = (text or '').strip()
+        links = BatchIngestor.split_links(text)
+        if len(links) != 1 or links[0] != text or cls.COLLECTION_RE.search(text):
+            return None
+        return text if urlparse(text).hostname else None
+
+    def schedule(self, text, delay=None):
+        """طلب جلب مسبق لما في النص؛ delay=None لمهلة الكتابة و 0 للصق أو الحافظة"""
+        url = self.candidate(text)
+        if url and url == self._scheduled and self._timer and delay is None:
+            return
+        self._cancel_timer()
+        if not url or url in self._active or url == self._waiting:
+            return
+        self._scheduled = url
+        loop = AsyncRuntime.loop()
+        self._timer = loop.call_later(self.debounce if delay is None else delay, self._start, url)
+
+    def cancel(self, keep=None):
+        """إيقاف كل جلب مسبق عدا keep (الرابط الذي طلب المستخدم تحميله)؛
+        الاستخراج الجاري في المنفذ يكمل ويملأ الذاكرة المؤقتة فقط"""
+        if keep is None or self._scheduled != keep:
+            self._cancel_timer()
+        if self._waiting != keep:
+            self._waiting = None
+        for url, task in list(self._active.items()):
+            if url != keep:
+                task.cancel()
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = None
+        self._scheduled = None
+
+    def _start(self, url):
+        self._timer = None
+        self._scheduled = None
+        if url in self._active:
+            return
+        if len(self._active) >= self.max_active:
+            # الرابط الأحدث يحل محل أي رابط منتظر
+            self._waiting = url
+            return
+        task = AsyncRuntime.spawn(self._run(url))
+        self._active[url] = task
+        # في رد النداء لا في _run: مهمة أُلغيت قبل أول خطوة لا تنفذ أي سطر من الـ coroutine
+        task.add_done_callback(functools.partial(self._finished, url))
+
+    def _finished(self, url, task):
+        if task.cancelled():
+            Metrics.inc('prefetch_cancelled_total')
+        if self._active.get(url) is task:
+            del self._active[url]
+        waiting, self._waiting = self._waiting, None
+        if waiting:
+            self._start(waiting)
+
+    async def _run(self, url):
+        Metrics.inc('prefetch_total')
+        try:
+            info = await self.engine.fetch_info_async(url)
+            # فهرس الصيغ جاهز قبل عرض قائمة الجودات
+            self.engine.format_index(info)
+            thumbnail_url = info.get('thumbnail')
+            if thumbnail_url:
+                await self.engine.fetch_thumbnail_async(thumbnail_url, size=self.thumbnail_size)
+        except asyncio.CancelledError:
+            Metrics.inc('prefetch_cancelled_total')
+        except Exception as e:
+            # الخطأ يظهر للمستخدم عند الطلب الفعلي فقط
+            logger.info(f"Prefetch of {url} failed: {e}")
+
+class SegmentedDownloadUnsupported(Exception):
+    """الخادم أو الصيغة لا تدعم التحميل المقسم؛ يجب الرجوع إلى yt-dlp"""
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(num_bytes) < 1024 or unit == 'GiB':
+            return f"{num_bytes:.2f}{unit}" if unit != 'B' else f"{num_bytes:.0f}B"
+        num_bytes /= 1024
+
+def parse_rate(text):
+    """'2M' أو '500K' أو '1.5MiB/s' إلى بايت/ثانية؛ 0 أو 'off' تعني بدون حد"""
+    text = str(text).strip().lower()
+    if text.endswith('/s'):
+        text = text[:-2]
+    if text in ('', 'off', 'none', 'unlimited'):
+        return 0
+    match = re.fullmatch(r'([\d.]+)\s*([kmg]?)(?:i?b)?', text)
+    if not match:
+        raise ValueError(f"invalid rate: {text}")
+    return int(float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2) or ' '))
+
+class SegmentedDownloader:
+    """تحميل مقسم متعدد الاتصالات لروابط الوسائط المباشرة (progressive / DASH):
+    تقسيم الملف إلى نطاقات بايت تُجلب بالتوازي وتُكتب في مكانها داخل ملف محجوز مسبقاً"""
+    # حد عام للاتصالات المفتوحة عبر كل التحميلات المقسمة
+    _connection_slots = threading.BoundedSemaphore(SEGMENTED_MAX_CONNECTIONS)
+    _session = None
+    _session_lock = threading.Lock()
+
+    def __init__(self, url, path, headers=None, connections=SEGMENTED_CONNECTIONS,
+                 min_segment=1024**2, max_segment=32 * 1024**2, target_segment_seconds=4.0,
+                 retries=5, chunk_size=256 * 1024, timeout=30, session=None,
+                 progress_hook=None, completed_ranges=None, on_range_done=None, is_paused=None):
+        self.url = url
+        self.path = path
+        self.headers = dict(headers or {})
+        self.connections = max(1, connections)
+        self.min_segment = min_segment
+        self.max_segment = max_segment
+        self.target_segment_seconds = target_segment_seconds
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = session or self.shared_session()
+        self.progress_hook = progress_hook
+        self.on_range_done = on_range_done
+        # is_paused() بدون حجب؛ الانتظار نفسه في progress_hook ويجب ألا يحدث داخل فتحة اتصال
+        self.is_paused = is_paused
+        self.completed_ranges = [list(r) for r in (completed_ranges or [])]
+        self.total_bytes = None
+        self.downloaded_bytes = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._error = None
+        self._aborted = threading.Event()
+        self._connection_speed = None
+        self._started_at = None
+
+    @classmethod
+    def shared_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=SEGMENTED_MAX_CONNECTIONS)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                # نفس كوكيز جلسات yt-dlp التي استخرجت روابط الصيغ
+                session.cookies = YoutubeDLPool.cookiejar()
+                cls._session = session
+            return cls._session
+
+    @staticmethod
+    def direct_format(info, format_id):
+        """الصيغة المطابقة إن كانت رابط HTTP مباشراً واحداً (ليست دمجاً أو محدِّداً)"""
+        if not info or any(c in format_id for c in '+/[]'):
+            return None
+        for f in info.get('formats') or []:
+            if f.get('format_id') == format_id and f.get('protocol') in ('http', 'https') and f.get('url'):
+                return f
+        return None
+
+    @classmethod
+    def set_connection_limit(cls, limit):
+        cls._connection_slots = threading.BoundedSemaphore(max(1, int(limit)))
+
+    def probe(self):
+        """طلب أول بايت فقط لمعرفة الحجم الكلي ودعم النطاقات"""
+        headers = dict(self.headers, Range='bytes=0-0')
+        with self.session.get(self.url, headers=headers, timeout=self.timeout, stream=True) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status_code != 206 or '/' not in content_range:
+                raise SegmentedDownloadUnsupported(f"no range support (HTTP {response.status_code})")
+            total = content_range.rsplit('/', 1)[1]
+            if not total.isdigit():
+                raise SegmentedDownloadUnsupported("unknown content length")
+            return int(total)
+
+    def download(self):
+        self.total_bytes = self.probe()
+        fd = self._open_preallocated(self.total_bytes)
+        try:
+            self._pending = self._missing_ranges(self.total_bytes)
+            self.downloaded_bytes = self.total_bytes - sum(end - start + 1 for start, end in self._pending)
+            self._started_at = time.time()
+            remaining = self.total_bytes - self.downloaded_bytes
+            count = min(self.connections, max(1, -(-remaining // self.min_segment)))
+            workers = [threading.Thread(target=self._worker, args=(fd,), name=f"segment-{i}", daemon=True)
+                       for i in range(count)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if self._error:
+                raise self._error
+            if DiskPolicy.fsync_policy != 'never':
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._report('finished')
+        return self.total_bytes
+
+    def abort(self):
+        self._aborted.set()
+
+    def _missing_ranges(self, total):
+        """النطاقات التي لم تُحمّل بعد (لاستئناف تحميل سابق)"""
+        missing = []
+        position = 0
+        for start, end in sorted(self.completed_ranges):
+            if start > position:
+                missing.append([position, start - 1])
+            position = max(position, end + 1)
+        if position < total:
+            missing.append([position, total - 1])
+        return missing
+
+    def _open_preallocated(self, total):
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        fd = os.open(self.path, flags, 0o644)
+        try:
+            if os.fstat(fd).st_size != total:
+                # النطاقات المسجلة تخص ملفاً بهذا الحجم بالضبط؛ ملف مفقود أو مقصوص يعني أن
+                # بياناتها ليست فيه، وتخطيها سينتج ملفاً مليئاً بالأصفار
+                if self.completed_ranges:
+                    logger.info(f"Partial file {self.path} does not match its journal, restarting download")
+                    self.completed_ranges = []
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, total)
+            preallocate(fd, total)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def _segment_size(self):
+        if self._connection_speed:
+            size = int(self._connection_speed * self.target_segment_seconds)
+        else:
+            size = self.total_bytes // (self.connections * 4)
+        return max(self.min_segment, min(self.max_segment, size))
+
+    def _next_range(self):
+        with self._lock:
+            if not self._pending or self._aborted.is_set():
+                return None
+            start, end = self._pending[0]
+            size = self._segment_size()
+            if end - start + 1 > size:
+                self._pending[0][0] = start + size
+                return start, start + size - 1
+            self._pending.pop(0)
+            return start, end
+
+    def _worker(self, fd):
+        try:
+            while True:
+                segment = self._next_range()
+                if segment is None:
+                    return
+                self._fetch_range(fd, *segment)
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            self._aborted.set()
+
+    def _fetch_range(self, fd, start, end):
+        position = start
+        attempts = 0
+        # قطع الشبكة تُجمع وتُكتب دفعة واحدة؛ البداية دائماً عند buffer_offset والنهاية عند position
+        buffer = bytearray()
+        buffer_offset = start
+        while position <= end:
+            if self._aborted.is_set():
+                return
+            if self.is_paused and self.is_paused():
+                # الخطاف يحجب هنا حتى الاستئناف، خارج الفتحة حتى لا تُحرم التحميلات الأخرى منها
+                self._report('downloading')
+                if self.is_paused():
+                    # خطاف لا يحجب (أو بدون خطاف)
+                    time.sleep(0.2)
+                continue
+            fetched_at = time.time()
+            fetched = 0
+            paused = False
+            try:
+                with self._connection_slots:
+                    headers = dict(self.headers, Range=f"bytes={position}-{end}")
+                    with self.session.get(self.url, headers=headers, timeout=self.timeout, stream=True) as response:
+                        if response.status_code != 206:
+                            # خادم تجاهل النطاق؛ الكتابة هنا ستفسد الملف
+                            raise SegmentedDownloadUnsupported(f"range request answered with HTTP {response.status_code}")
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            if self._aborted.is_set():
+                                return
+                            if not chunk:
+                                continue
+                            chunk = chunk[:end - position + 1]
+                            buffer += chunk
+                            position += len(chunk)
+                            if len(buffer) >= DiskPolicy.write_buffer_size:
+                                self._write_at(fd, buffer, buffer_offset)
+                                buffer_offset = position
+                                buffer.clear()
+                            fetched += len(chunk)
+                            if self.is_paused and self.is_paused():
+                                # إغلاق الاتصال وتحرير الفتحة؛ النطاق يكمل من position بعد الاستئناف
+                                with self._lock:
+                                    self.downloaded_bytes += len(chunk)
+                                paused = True
+                                break
+                            self._advance(len(chunk))
+                            if position > end:
+                                break
+                if position <= end and not paused:
+                    raise requests.exceptions.ChunkedEncodingError("connection closed before range was complete")
+            except requests.exceptions.RequestException as e:
+                attempts += 1
+                if attempts > self.retries:
+                    raise
+                logger.info(f"Retrying segment {position}-{end} ({attempts}/{self.retries}): {e}")
+                time.sleep(min(2 ** attempts, 15))
+            finally:
+                self._record_speed(fetched, time.time() - fetched_at)
+
+        self._write_at(fd, buffer, buffer_offset)
+        if DiskPolicy.fsync_policy == 'range':
+            # النطاق لا يُسجل في السجل قبل أن يصل فعلاً إلى القرص
+            os.fsync(fd)
+        with self._lock:
+            self.completed_ranges.append([start, end])
+        if self.on_range_done:
+            self.on_range_done(start, end)
+
+    def _write_at(self, fd, data, offset):
+        data = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+        else:
+            with self._write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+
+    def _record_speed(self, fetched, elapsed):
+        if fetched <= 0 or elapsed <= 0:
+            return
+        speed = fetched / elapsed
+        with self._lock:
+            # متوسط أسي لسرعة الاتصال الواحد يحدد حجم القطعة التالية
+            self._connection_speed = speed if self._connection_speed is None else 0.7 * self._connection_speed + 0.3 * speed
+
+    def _advance(self, count):
+        with self._lock:
+            self.downloaded_bytes += count
+        self._report('downloading')
+
+    def _report(self, status):
+        if not self.progress_hook:
+            return
+        d = {
+            'status': status,
+            'downloaded_bytes': self.downloaded_bytes,
+            'total_bytes': self.total_bytes,
+        }
+        try:
+            self.progress_hook(d)
+        except Exception as e:
+            # الإلغاء من الخطاف يوقف كل الاتصالات
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            self._aborted.set()
+            raise
+
+class TranscodeTask:
+    """مهمة دمج أو تحويل واحدة في طابور TranscodeStage"""
+    def __init__(self, download_id, command, output_path, duration=None, on_progress=None, on_done=None):
+        self.download_id = download_id
+        self.command = command
+        self.output_path = output_path
+        self.duration = duration
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.state = 'queued'
+        self.cancelled = False
+        self.process = None
+        self.percent = 0.0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+class TranscodeStage:
+    """مرحلة الدمج والتحويل منفصلة عن فتحات الشبكة: طابور خاص يعمل عليه
+    عدد من عمليات ffmpeg بقدر أنوية المعالج؛ الإلغاء يقتل عملية ffmpeg نفسها"""
+    def __init__(self, workers=TRANSCODE_WORKERS):
+        self.workers = max(1, workers or os.cpu_count() or 2)
+        self._queue = deque()
+        self._tasks = {}
+        self._threads = []
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    @staticmethod
+    def merge_command(inputs):
+        """دمج مسارات الفيديو والصوت بدون إعادة ترميز؛ inputs: [(path, format_dict)]"""
+        command = [FFmpegLocator.get(), '-y', '-loglevel', 'error']
+        for path, _ in inputs:
+            command += ['-i', path]
+        for i, (_, fmt) in enumerate(inputs):
+            if fmt.get('vcodec') != 'none':
+                command += ['-map', f'{i}:v:0?']
+            if fmt.get('acodec') != 'none':
+                command += ['-map', f'{i}:a:0?']
+        return command + ['-c', 'copy', '-f', 'mp4']
+
+    @staticmethod
+    def mp3_command(path, bitrate=MP3_BITRATE):
+        return [FFmpegLocator.get(), '-y', '-loglevel', 'error', '-i', path,
+                '-vn', '-c:a', 'libmp3lame', '-b:a', bitrate, '-f', 'mp3']
+
+    def submit(self, download_id, command, output_path, duration=None, on_progress=None, on_done=None):
+        """إضافة مهمة؛ on_progress(task) أثناء التشغيل و on_done(task, state, error) عند الانتهاء"""
+        task = TranscodeTask(download_id, command, output_path, duration, on_progress, on_done)
+        with self._condition:
+            self._tasks[download_id] = task
+            self._queue.append(task)
+            self._ensure_workers()
+            self._condition.notify_all()
+        return task
+
+    def cancel(self, download_id):
+        """إلغاء مهمة منتظرة أو قتل عملية ffmpeg الجارية؛ يعيد False إن لم تكن موجودة"""
+        with self._condition:
+            task = self._tasks.get(download_id)
+            if not task:
+                return False
+            task.cancelled = True
+            dequeued = task.state == 'queued'
+            if dequeued:
+                self._queue.remove(task)
+                del self._tasks[download_id]
+                task.state = 'cancelled'
+                self._condition.notify_all()
+            elif task.process is not None:
+                try:
+                    task.process.kill()
+                except OSError:
+                    pass
+        if dequeued:
+            self._finish(task, None)
+        return True
+
+    def get_task(self, download_id):
+        return self._tasks.get(download_id)
+
+    def has_pending(self):
+        with self._condition:
+            return bool(self._tasks)
+
+    def wait_until_idle(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def list_tasks(self):
+        with self._condition:
+            return [{
+                'id': task.download_id,
+                'state': task.state,
+                'percent': round(task.percent, 1),
+            } for task in self._tasks.values()]
+
+    def stop(self):
+        """قتل عمليات ffmpeg الجارية عند إغلاق التطبيق؛ السجل يبقى لاستئنافها لاحقاً"""
+        with self._condition:
+            self._stopping = True
+            self._queue.clear()
+            for task in self._tasks.values():
+                if task.process is not None:
+                    try:
+                        task.process.kill()
+                    except OSError:
+                        pass
+
+    def _ensure_workers(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker_loop, name=f"transcode-worker-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                task = self._queue.popleft()
+                task.state = 'running'
+                task.started_at = time.time()
+            error = None
+            try:
+                self._run(task)
+            except Exception as e:
+                error = str(e)
+            with self._condition:
+                task.state = 'cancelled' if task.cancelled else ('failed' if error else 'done')
+                task.process = None
+                task.finished_at = time.time()
+                stopping = self._stopping
+            # المهمة تبقى معلّقة حتى ينتهي on_done (حذف المدخلات وتحديث السجل)
+            if not stopping:
+                self._finish(task, error)
+            with self._condition:
+                self._tasks.pop(task.download_id, None)
+                self._condition.notify_all()
+
+    def _run(self, task):
+        tmp_path = task.output_path + '.transcode.part'
+        command = task.command + ['-progress', 'pipe:1', '-nostats', tmp_path]
+        with self._condition:
+            if task.cancelled:
+                return
+            task.process = subprocess.Popen(
+                command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                text=True, errors='replace'
+            )
+        process = task.process
+        try:
+            # ffmpeg يكتب سطور key=value كل نصف ثانية تقريباً
+            for line in process.stdout:
+                key, _, value = line.strip().partition('=')
+                if key == 'out_time_us' and task.duration and value.isdigit():
+                    task.percent = min(100.0, int(value) / (task.duration * 1e6) * 100)
+                    if task.on_progress:
+                        task.on_progress(task)
+            stderr = process.stderr.read()
+            returncode = process.wait()
+        finally:
+            process.stdout.close()
+            process.stderr.close()
+
+        if task.cancelled or returncode != 0:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            if task.cancelled:
+                return
+            raise RuntimeError(f"ffmpeg exited with code {returncode}: {stderr.strip()[-500:]}")
+        os.replace(tmp_path, task.output_path)
+        task.percent = 100.0
+
+    def _finish(self, task, error):
+        if task.on_done:
+            try:
+                task.on_done(task, task.state, error)
+            except Exception as e:
+                logger.error(f"Transcode callback failed for {task.download_id}: {e}")
+
+class TranscodePipe:
+    """عملية ffmpeg تقرأ المدخل من stdin وتكتب الناتج النهائي فقط (بدون ملف وسيط)"""
+    MP4_EXTENSIONS = ('m4a', 'mp4', 'mov', '3gp')
+
+    def __init__(self, command, output_path):
+        self.output_path = output_path
+        self.tmp_path = output_path + '.transcode.part'
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            command + [self.tmp_path], stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, stderr=self._stderr
+        )
+
+    @classmethod
+    def readable_from_pipe(cls, head, ext):
+        """ملفات mp4 تُقرأ من أنبوب فقط إذا سبق moov (أو moof المجزأ) بيانات mdat"""
+        if ext not in cls.MP4_EXTENSIONS:
+            return True
+        pos = 0
+        while pos + 8 <= len(head):
+            size = int.from_bytes(head[pos:pos + 4], 'big')
+            kind = head[pos + 4:pos + 8]
+            if kind in (b'moov', b'moof'):
+                return True
+            if kind == b'mdat':
+                return False
+            if size == 1:
+                size = int.from_bytes(head[pos + 8:pos + 16], 'big')
+            if size < 8:
+                return False
+            pos += size
+        return False
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            self.process.wait()
+            raise RuntimeError(f"ffmpeg stopped reading input: {self._error_text()}")
+
+    def finish(self):
+        """إغلاق المدخل وانتظار ffmpeg؛ الناتج يُنقل إلى مكانه فقط عند النجاح"""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            error = self._error_text()
+            self._cleanup()
+            raise RuntimeError(f"ffmpeg exited with code {returncode}: {error}")
+        os.replace(self.tmp_path, self.output_path)
+        self._stderr.close()
+
+    def abort(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        try:
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass
+        self.process.wait()
+        self._cleanup()
+
+    def _error_text(self):
+        self._stderr.seek(0)
+        return self._stderr.read().decode('utf-8', 'replace').strip()[-500:]
+
+    def _cleanup(self):
+        self._stderr.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+class ProgressSlot:
+    """حالة تقدم رقمية مدمجة لمهمة واحدة؛ تكتبها خطافات التحميل وتقرأها دورة العرض"""
+    __slots__ = ('download_id', 'downloaded', 'total', 'status', 'samples', 'last_sample', 'dirty')
+
+    def __init__(self, download_id, window):
+        self.download_id = download_id
+        self.downloaded = 0
+        self.total = None
+        self.status = 'downloading'
+        # حلقة عينات (الزمن، البايتات) لحساب سرعة ووقت متبقٍ منعّمين
+        self.samples = deque(maxlen=window)
+        self.last_sample = 0.0
+        self.dirty = True
+
+    def speed(self):
+        if len(self.samples) < 2:
+            return None
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else None
+
+    def eta(self, speed):
+        if not speed or not self.total:
+            return None
+        return max(0, int((self.total - self.downloaded) / speed))
+
+class ProgressBus:
+    """طبقة تجميع التقدم: الخطافات تحدّث خانات رقمية دون أي استدعاء للواجهة،
+    ودورة عرض واحدة بمعدل إطارات ثابت تقرأ كل الخانات المتغيرة دفعة واحدة"""
+    def __init__(self, fps=PROGRESS_FPS, window=20, sample_interval=0.25):
+        self.fps = fps
+        self.window = window
+        self.sample_interval = sample_interval
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def update(self, download_id, downloaded, total=None, status='downloading'):
+        slot = self._slots.get(download_id)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.setdefault(download_id, ProgressSlot(download_id, self.window))
+        now = time.monotonic()
+        if downloaded < slot.downloaded:
+            # ملف جديد ضمن نفس المهمة (فيديو ثم صوت)
+            slot.samples.clear()
+        slot.downloaded = downloaded
+        slot.total = total or slot.total
+        slot.status = status
+        if now - slot.last_sample >= self.sample_interval:
+            slot.samples.append((now, downloaded))
+            slot.last_sample = now
+        slot.dirty = True
+
+    def remove(self, download_id):
+        with self._lock:
+            self._slots.pop(download_id, None)
+
+    def active_count(self):
+        return len(self._slots)
+
+    def drain(self, only_dirty=True):
+        """لقطة لكل الخانات المتغيرة منذ آخر دورة: قائمة من dict بقيم رقمية"""
+        with self._lock:
+            slots = list(self._slots.values())
+        updates = []
+        for slot in slots:
+            if only_dirty and not slot.dirty:
+                continue
+            slot.dirty = False
+            speed = slot.speed()
+            updates.append({
+                'id': slot.download_id,
+                'status': slot.status,
+                'downloaded': slot.downloaded,
+                'total': slot.total,
+                'percent': 100.0 * slot.downloaded / slot.total if slot.total else None,
+                'speed': speed,
+                'eta': slot.eta(speed),
+            })
+        return updates
+
+    def total_speed(self):
+        with self._lock:
+            slots = list(self._slots.values())
+        return sum(slot.speed() or 0 for slot in slots)
+
+    @staticmethod
+    def format_update(update):
+        """تحويل القيم الرقمية إلى نصوص العرض (النسبة، السرعة، الوقت المتبقي)"""
+        percent = f"{update['percent']:.1f}%" if update['percent'] is not None else format_bytes(update['downloaded'])
+        speed = f"{format_bytes(update['speed'])}/s" if update['speed'] is not None else 'N/A'
+        eta = update['eta']
+        if eta is None:
+            eta_text = 'N/A'
+        elif eta >= 3600:
+            eta_text = f"{eta // 3600}:{eta % 3600 // 60:02d}:{eta % 60:02d}"
+        else:
+            eta_text = f"{eta // 60:02d}:{eta % 60:02d}"
+        return percent, speed, eta_text
+
+    def start_ticker(self, render):
+        """دورة عرض على حلقة AsyncRuntime للوضع بدون واجهة: يستدعي render(updates) بمعدل fps"""
+        loop = AsyncRuntime.loop()
+
+        def tick():
+            updates = self.drain()
+            if updates:
+                try:
+                    render(updates)
+                except Exception as e:
+                    logger.error(f"Progress render failed: {e}")
+            loop.call_later(1.0 / self.fps, tick)
+        AsyncRuntime.call_soon(tick)
+
+class ProgressTracker:
+    """تتبع تقدم التحميل"""
+    def __init__(self, download_id, journal=None, bus=None):
+        self.download_id = download_id
+        self.journal = journal
+        self.bus = bus
+        self._counted_bytes = None
+        self._part_started = None
+        self._part_received = 0
+        self._first_chunk = False
+        self._count_lock = threading.Lock()
+
+    def start_part(self, existing_bytes=None):
+        """بداية ملف جديد: البايتات الموجودة مسبقاً (استئناف) لا تُحتسب على حصة النطاق.
+        إذا لم يُعرف عددها يُعتبر أول تقرير من المنزِّل نقطة البداية"""
+        with self._count_lock:
+            self._counted_bytes = existing_bytes
+            self._part_started = time.time()
+            self._part_received = 0
+            self._first_chunk = True
+
+    def finish_part(self, name=None):
+        """تسجيل زمن الشبكة ومعدل النقل للملف الذي اكتمل"""
+        with self._count_lock:
+            started, received = self._part_started, self._part_received
+            self._part_started = None
+        if started is None:
+            return
+        duration = Metrics.record_span('download', started, time.time(), self.download_id,
+                                       {'bytes': received, 'file': name})
+        Metrics.inc('downloaded_bytes_total', received)
+        if received and duration > 0:
+            Metrics.observe('throughput_bytes_per_second', received / duration)
+        
+    def hook(self, d):
+        # الإيقاف المؤقت يحجب خيط التحميل هنا حتى الاستئناف
+        DownloadManager.wait_if_paused(self.download_id)
+
+        # التحقق من طلب الإلغاء
+        if DownloadManager.should_cancel(self.download_id):
+            raise Exception("Download cancelled by user")
+            
+        if d['status'] == 'downloading':
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            first_chunk_at = None
+            with self._count_lock:
+                if self._first_chunk:
+                    self._first_chunk = False
+                    first_chunk_at = self._part_started
+                if self._counted_bytes is None:
+                    received = 0
+                    self._counted_bytes = downloaded
+                else:
+                    received = max(0, downloaded - self._counted_bytes)
+                    self._counted_bytes = max(downloaded, self._counted_bytes)
+                    self._part_received += received
+            if first_chunk_at is not None:
+                Metrics.record_span('time_to_first_byte', first_chunk_at, time.time(), self.download_id)
+            if received:
+                BandwidthGovernor.consume(self.download_id, received)
+            if self.journal:
+                self.journal.update_progress(self.download_id, downloaded, total)
+            # كتابة أرقام فقط؛ العرض يتم في دورة واحدة لكل المهام
+            if self.bus:
+                self.bus.update(self.download_id, downloaded, total)
+        return True
+
+class DownloadListener:
+    """مستقبل أحداث المحرك؛ الواجهة الرسومية وسطر الأوامر يرثان منه.
+    تُستدعى الدوال من خيوط التحميل وليس من خيط الواجهة"""
+    def on_status(self, download_id, text):
+        pass
+
+    def on_progress(self, download_id, percent, speed, eta):
+        # تُستدعى من دورة عرض التقدم (start_progress_ticker) وليس من خطاف التحميل
+        pass
+
+    def on_complete(self, download_id, title, path):
+        pass
+
+    def on_cancelled(self, download_id):
+        pass
+
+    def on_error(self, download_id, title, message):
+        pass
+
+class DownloadEngine:
+    """منطق التحميل بدون واجهة: استخراج المعلومات، قوائم الصيغ،
+    الجدولة عبر DownloadManager، السجل الدائم والاستئناف"""
+    def __init__(self, downloads_folder=DOWNLOADS_FOLDER, cache_folder=CACHE_FOLDER,
+                 data_folder=DATA_FOLDER, listener=None):
+        self.downloads_folder = downloads_folder
+        self.listener = listener or DownloadListener()
+        self.metadata_cache = MetadataCache(os.path.join(cache_folder, 'metadata'))
+        self.thumbnail_cache = ThumbnailCache(os.path.join(cache_folder, 'thumbnails'))
+        self.journal = JobJournal(os.path.join(data_folder, 'jobs'))
+        self.library = LibraryIndex(os.path.join(data_folder, 'library.sqlite3'))
+        self.progress_bus = ProgressBus()
+        self.transcoder = TranscodeStage()
+        self._listeners = {}
+        self._format_indexes = OrderedDict()
+        self._format_lock = threading.Lock()
+
+    def start_progress_ticker(self):
+        """للوضع بدون واجهة: تمرير التقدم المجمّع إلى on_progress بمعدل إطارات ثابت"""
+        def render(updates):
+            for update in updates:
+                listener = self._listeners.get(update['id'], self.listener)
+                listener.on_progress(update['id'], *ProgressBus.format_update(update))
+        self.progress_bus.start_ticker(render)
+
+    def start_metrics(self, port=METRICS_PORT, trace_path=TRACE_FILE):
+        """تشغيل نقطة /metrics على localhost و/أو سجل التتبع؛ يعيد المنفذ أو None"""
+        Metrics.register_gauge('jobs', 'Current jobs by stage and state', self._job_states)
+        Metrics.register_gauge('ytdl_sessions', 'Pooled yt-dlp sessions by state', lambda: {
+            (('state', state),): count for state, count in YoutubeDLPool.stats().items() if state in ('idle', 'busy')
+        })
+        Metrics.register_gauge('disk_reserved_bytes', 'Disk space still to be written by admitted jobs',
+                               lambda: DiskPolicy.stats()['outstanding_bytes'])
+        Metrics.register_gauge('bandwidth_limit_bytes_per_second', 'Global bandwidth cap in effect (0 = unlimited)',
+                               BandwidthGovernor.current_global_rate)
+        if trace_path:
+            Metrics.open_trace(trace_path)
+        if port:
+            return Metrics.serve(port)
+        return None
+
+    def _job_states(self):
+        counts = {}
+        for stage, jobs in (('download', DownloadManager.list_jobs()), ('transcode', self.transcoder.list_tasks())):
+            for job in jobs:
+                key = (('stage', stage), ('state', job['state']))
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def fetch_info(self, url):
+        """معلومات الفيديو من الذاكرة المؤقتة أو باستخراج كامل"""
+        cached_info = self.metadata_cache.get(url)
+        if cached_info is not None:
+            Metrics.inc('metadata_cache_hits_total')
+            return cached_info
+
+        with Metrics.span('extraction', kind='info'), YoutubeDLPool.session(extract_flat=False) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        self.metadata_cache.put(url, info)
+        return info
+
+    async def fetch_info_async(self, url):
+        """fetch_info للحلقة: الاستخراج في المنفذ المحدود، وطلبات نفس الرابط المتزامنة تشترك فيه"""
+        return await AsyncRuntime.single_flight(('info', MetadataCache.normalize_key(url)), self.fetch_info, url)
+
+    async def fetch_thumbnail_async(self, url, size=None):
+        """مسار الصورة المصغرة المحلي (أو None) دون حجب الحلقة"""
+        return await AsyncRuntime.single_flight(('thumbnail', url, size), self.thumbnail_cache.fetch, url, size=size)
+
+    def format_index(self, info):
+        """فهرس الصيغ لهذا الاستخراج؛ يُبنى مرة واحدة ويُعاد استخدامه عند تبديل MP4/MP3"""
+        keys = MetadataCache.info_keys(info)
+        key = keys[0] if keys else id(info)
+        with self._format_lock:
+            index = self._format_indexes.get(key)
+            if index is None:
+                index = FormatIndex(info)
+                self._format_indexes[key] = index
+                while len(self._format_indexes) > 16:
+                    self._format_indexes.popitem(last=False)
+            else:
+                self._format_indexes.move_to_end(key)
+            return index
+
+    def format_options(self, info, format_type):
+        """قائمة الخيارات المعروضة للمستخدم: [{'text': ..., 'id': format_id}]"""
+        return self.format_index(info).options(format_type)
+
+    def select_format(self, info, policy):
+        """اختيار صيغة حسب سياسة نصية مثل 'best under 50 MB' أو 'max 720p, prefer avc1'"""
+        params = FormatIndex.parse_policy(policy)
+        return self.format_index(info).select(**params)
+
+    def submit_download(self, url, format_id, title='download', is_audio_only=False,
+                        custom_filename=None, priority=0, listener=None, download_id=None, output_path=None,
+                        rate_limit=None, info=None):
+        """جدولة تحميل وإرجاع DownloadJob؛ الأحداث تذهب إلى listener أو المستقبل الافتراضي.
+        rate_limit حد عرض النطاق لهذه المهمة بالبايت/ثانية. info معلومات مستخرجة مسبقاً تُعاد
+        معالجتها بدل استخراج ثانٍ. يرفع InsufficientDiskSpace فوراً إذا كان الحجم المتوقع
+        (من المعلومات المحفوظة) لا يتسع مع المهام الأخرى"""
+        download_id = download_id or f"{url}_{format_id}_{time.time()}"
+        DiskPolicy.admit(download_id, os.path.dirname(output_path) if output_path else self.downloads_folder,
+                         self.estimate_disk_usage(url, format_id, is_audio_only), paths=[output_path] if output_path else ())
+        if listener:
+            self._listeners[download_id] = listener
+        if rate_limit:
+            BandwidthGovernor.set_job_limit(download_id, rate_limit)
+        return DownloadManager.submit(
+            download_id,
+            self.run_download,
+            args=(url, format_id, custom_filename, download_id, title, is_audio_only, output_path, info),
+            priority=priority,
+            url=url
+        )
+
+    def estimate_disk_usage(self, url, format_id, is_audio_only=False):
+        """المساحة المتوقعة لمهمة قبل جدولتها من المعلومات المحفوظة (None إذا لم تُستخرج بعد)"""
+        info = self.metadata_cache.get(url)
+        if info is None:
+            return None
+        # نفس الصيغ التي سيختارها yt-dlp في run_download، ونفس قرار الدمج/التحويل بعدها
+        index = self.format_index(info)
+        requested = index.selected_formats(FormatIndex.download_spec(format_id, is_audio_only))
+        if not requested:
+            return None
+        sizes = [index.format_size(fmt) for fmt in requested]
+        if not all(sizes):
+            return None
+        transcode = len(requested) > 1 or (is_audio_only and requested[0].get('ext') != 'mp3') \
+            or (not is_audio_only and self.needs_remux(requested[0], 'mp4'))
+        streamed = is_audio_only and transcode and STREAM_AUDIO_TRANSCODE and self.can_stream(requested[0])
+        return self.disk_needed(sum(sizes), info.get('duration'), is_audio_only, transcode, streamed)
+
+    @staticmethod
+    def disk_needed(size, duration=None, is_audio_only=False, transcode=False, streamed=False):
+        """بايتات القرص لمهمة: المدخلات المحملة، وناتج الدمج/التحويل الذي يُكتب بجانبها حتى النهاية"""
+        if not size:
+            return None
+        output = 0
+        if transcode:
+            if is_audio_only and duration:
+                output = int(int(MP3_BITRATE.rstrip('kK')) * 1000 / 8 * duration)
+            else:
+                output = size
+        return output + (0 if streamed else size)
+
+    def cancel_download(self, download_id):
+        """إلغاء المهمة في أي مرحلة: الطابور، الشبكة أو الدمج/التحويل"""
+        if self.transcoder.cancel(download_id):
+            return True
+        if DownloadManager.get_job(download_id):
+            DownloadManager.cancel_download(download_id)
+            if not DownloadManager.get_job(download_id):
+                # أُلغيت قبل أن تبدأ
+                BandwidthGovernor.release(download_id)
+                DiskPolicy.release(download_id)
+            return True
+        return False
+
+    def is_active(self, download_id):
+        return bool(DownloadManager.get_job(download_id) or self.transcoder.get_task(download_id))
+
+    def has_pending(self):
+        return DownloadManager.has_pending_downloads() or self.transcoder.has_pending()
+
+    def wait_until_idle(self):
+        """انتظار انتهاء التحميلات ثم ما سلّمته من عمليات دمج وتحويل"""
+        while True:
+            DownloadManager.wait_until_idle()
+            self.transcoder.wait_until_idle()
+            if not self.has_pending():
+                return
+
+    def list_jobs(self):
+        return DownloadManager.list_jobs() + self.transcoder.list_tasks()
+
+    def start_batch(self, text, is_audio_only=False, listener=None, on_update=None):
+        """تعداد الروابط وجدولة كل عنصر للتحميل فور حل معلوماته"""
+        format_id = 'bestaudio' if is_audio_only else 'bestvideo+bestaudio'
+        notify = (lambda *args: on_update(batch)) if on_update else None
+
+        def on_entry(info, index):
+            url = info.get('webpage_url') or info.get('original_url')
+            title = info.get('title', 'download')
+            try:
+                # ترتيب القائمة محفوظ، والتحميلات الفردية تسبق الدفعة
+                self.submit_download(url, format_id, title, is_audio_only,
+                                     priority=-(index + 1), listener=listener, info=info)
+            except InsufficientDiskSpace as e:
+                # عنصر مرفوض يُحسب فشلاً للتحميل حتى يكتمل عدّ الدفعة عند المستقبل
+                (listener or self.listener).on_error(None, title, str(e))
+            if notify:
+                notify()
+
+        batch = BatchIngestor(self.metadata_cache, on_entry=on_entry, on_error=notify, on_done=notify)
+        batch.start(text)
+        return batch
+
+    def resume_unfinished(self):
+        """إعادة جدولة المهام غير المكتملة من السجل الدائم"""
+        resumed = 0
+        records = self.journal.unfinished()
+        try:
+            self.library.reconcile(self.downloads_folder, active_ids=[r['download_id'] for r in records])
+        except Exception as e:
+            logger.error(f"Library reconcile failed: {e}")
+        for record in records:
+            if record.get('attempts', 0) >= MAX_RESUME_ATTEMPTS:
+                logger.error(f"Giving up on {record.get('url')} after {record['attempts']} attempts")
+                self.journal.remove(record['download_id'])
+                self.library.release(record['download_id'])
+                continue
+            inputs = record.get('inputs')
+            if record.get('phase') in ('merge', 'transcode') and inputs and all(os.path.exists(p) for p, _ in inputs):
+                # التحميل اكتمل قبل الإغلاق: نكمل الدمج/التحويل فقط
+                self.start_transcode(
+                    record['download_id'], record.get('title', 'download'), inputs, record['output_path'],
+                    record.get('is_audio_only', False), record.get('duration')
+                )
+                resumed += 1
+                continue
+            try:
+                self.submit_download(
+                    record['url'], record['format_id'], record.get('title', 'download'),
+                    record.get('is_audio_only', False),
+                    download_id=record['download_id'], output_path=record['output_path']
+                )
+            except InsufficientDiskSpace as e:
+                # يبقى في السجل ويُعاد في التشغيل التالي بعد تحرير مساحة
+                logger.error(f"Not resuming {record.get('url')}: {e}")
+                continue
+            resumed += 1
+        if resumed:
+            logger.info(f"Resuming {resumed} unfinished download(s)")
+        return resumed
+
+    def get_unique_filename(self, base_path, extension, download_id=None):
+        """اسم غير مستخدم محجوز في فهرس المكتبة حتى لا تأخذه مهمة أخرى متزامنة"""
+        return self.library.reserve(base_path, extension, download_id)
+
+    def media_key(self, url, info=None):
+        """مفتاح الفيديو في المكتبة: extractor:id من المعلومات إن توفرت وإلا من الرابط"""
+        info = info or self.metadata_cache.get(url)
+        keys = MetadataCache.info_keys(info) if info else []
+        return keys[0] if keys else MetadataCache.normalize_key(url)
+
+    def reuse_existing(self, download_id, media_key, format_key, base_path, extension, title, listener,
+                       reserved_path=None):
+        """إنهاء المهمة فوراً إذا كان الفيديو بنفس الصيغة موجوداً في المكتبة"""
+        if DEDUP_MODE == 'off':
+            return False
+        existing = self.library.lookup(media_key, format_key)
+        if not existing:
+            return False
+        path = existing
+        if DEDUP_MODE == 'link':
+            target = reserved_path or self.get_unique_filename(base_path, extension, download_id)
+            try:
+                os.link(existing, target)
+                path = target
+            except OSError as e:
+                logger.info(f"Hard link failed, reusing {existing}: {e}")
+        if path == existing:
+            self.library.release(download_id)
+        else:
+            self.library.add(path, media_key, format_key, download_id)
+        self.journal.remove(download_id)
+        Metrics.inc('jobs_total', result='skipped')
+        listener.on_status(download_id, "Already downloaded")
+        listener.on_complete(download_id, title, path)
+        return True
+
+    def _complete(self, download_id, title, path, listener):
+        record = self.journal.get(download_id)
+        self.library.add(path, record.get('media_key'), record.get('format_key'), download_id)
+        self.journal.remove(download_id)
+        Metrics.inc('jobs_total', result='complete')
+        listener.on_complete(download_id, title, path)
+
+    def run_download(self, url, format_id, custom_filename, download_id, title, is_audio_only, output_path=None,
+                     info=None):
+        """مرحلة الشبكة لمهمة واحدة داخل عامل المجدول؛ الدمج والتحويل يُسلَّمان
+        إلى TranscodeStage حتى تتحرر فتحة التحميل فوراً"""
+        listener = self._listeners.get(download_id, self.listener)
+        progress_tracker = ProgressTracker(download_id, self.journal, self.progress_bus)
+        final_path = None
+        inputs = []
+        handed_off = False
+        try:
+            listener.on_status(download_id, "Downloading...")
+            os.makedirs(self.downloads_folder, exist_ok=True)
+            
+            base_name = custom_filename or re.sub(r'[<>:"/\\|?*]', '', title)
+
+            extension = 'mp3' if is_audio_only else 'mp4'
+            format_string = FormatIndex.download_spec(format_id, is_audio_only)
+            base_path = os.path.join(self.downloads_folder, base_name)
+            format_key = f"{extension}:{format_id}"
+            media_key = self.media_key(url)
+            if not output_path and self.reuse_existing(download_id, media_key, format_key, base_path,
+                                                       extension, title, listener):
+                return
+            # عند الاستئناف نستخدم نفس المسار حتى يكمل التحميل من ملف .part
+            final_path = output_path or self.get_unique_filename(base_path, extension, download_id)
+
+            self.journal.record(
+                download_id, url=url, format_id=format_id, format=format_string,
+                output_path=final_path, title=title, is_audio_only=is_audio_only,
+                media_key=media_key, format_key=format_key
+            )
+
+            info = self.resolve_formats(url, format_string, download_id, info=info)
+            resolved_key = self.media_key(url, info)
+            if resolved_key != media_key:
+                # الرابط لم يكن في الذاكرة المؤقتة: نعيد الفحص بالمعرّف الحقيقي قبل تحميل أي بايت
+                if not output_path and self.reuse_existing(download_id, resolved_key, format_key, base_path,
+                                                           extension, title, listener, reserved_path=final_path):
+                    return
+                self.journal.record(download_id, media_key=resolved_key)
+            requested = info.get('requested_formats') or [info]
+            needs_transcode = len(requested) > 1 or (is_audio_only and requested[0].get('ext') != 'mp3') \
+                or (not is_audio_only and self.needs_remux(requested[0], extension))
+            base, _ = os.path.splitext(final_path)
+            # المدخلات الوسيطة تحمل أسماء yt-dlp المعتادة (name.fID.ext)
+            inputs = [(f"{base}.f{fmt['format_id']}.{fmt.get('ext') or 'bin'}" if needs_transcode else final_path, fmt)
+                      for fmt in requested]
+            will_stream = is_audio_only and needs_transcode and STREAM_AUDIO_TRANSCODE and self.can_stream(requested[0])
+            sizes = [fmt.get('filesize') or fmt.get('filesize_approx') for fmt in requested]
+            if all(sizes):
+                # الأحجام الدقيقة بعد الحل: رفض المهمة الآن أرخص من فشلها بعد تحميل معظمها
+                DiskPolicy.admit(
+                    download_id, os.path.dirname(final_path),
+                    self.disk_needed(sum(sizes), info.get('duration'), is_audio_only, needs_transcode, will_stream),
+                    paths=[final_path] + [path for path, _ in inputs]
+                )
+            streamed = False
+            if will_stream:
+                streamed = self.stream_audio(requested[0], final_path, inputs[0][0], download_id, progress_tracker)
+                needs_transcode = not streamed
+                if not streamed:
+                    self.journal.record(download_id, parts_done=[inputs[0][0]])
+            if not streamed:
+                for part_path, fmt in inputs:
+                    self.download_part(info, fmt, part_path, download_id, progress_tracker)
+                
+            # التحقق إذا كان التحميل ملغى
+            if DownloadManager.should_cancel(download_id):
+                self._discard(download_id, final_path, [path for path, _ in inputs])
+                listener.on_cancelled(download_id)
+                return
+
+            if needs_transcode:
+                self.start_transcode(download_id, title, inputs, final_path, is_audio_only, info.get('duration'))
+                handed_off = True
+                return
+                
+            self._complete(download_id, title, final_path, listener)
+
+        except Exception as e:
+            if "cancelled" in str(e).lower():
+                # الإلغاء يحذف الملفات الجزئية فقط؛ الانقطاع يبقيها للاستئناف
+                if final_path:
+                    self._discard(download_id, final_path, [path for path, _ in inputs], keep_final=True)
+                else:
+                    self.journal.remove(download_id)
+                    Metrics.inc('jobs_total', result='cancelled')
+                listener.on_cancelled(download_id)
+            else:
+                error_msg = f"An error occurred:\n{str(e)}"
+                logger.error(error_msg)
+                Metrics.inc('jobs_total', result='failed')
+                if self.journal.get(download_id):
+                    attempts = self.journal.get(download_id).get('attempts', 0) + 1
+                    self.journal.record(download_id, attempts=attempts, last_error=str(e))
+                listener.on_error(download_id, title, error_msg)
+        finally:
+            self.progress_bus.remove(download_id)
+            BandwidthGovernor.release(download_id)
+            if not handed_off:
+                DiskPolicy.release(download_id)
+                self._listeners.pop(download_id, None)
+
+    def resolve_formats(self, url, format_string, download_id=None, info=None):
+        """حل محدِّد الصيغة إلى الصيغ المطلوبة بدون تحميل. معلومات فيديو مستخرجة حديثاً
+        (عناصر الدفعة) يُعاد اختيار صيغها فقط، وإلا استخراج كامل بروابط جديدة"""
+        if info is not None and info.get('_type', 'video') == 'video' and info.get('formats') \
+                and time.time() - info.get('epoch', 0) < RESOLVED_INFO_MAX_AGE:
+            info = copy.deepcopy(info)
+            # اختيار سابق (من fetch_info) لا يجب أن يبقى إذا اختار المحدد الجديد صيغة واحدة
+            info.pop('requested_formats', None)
+            info.pop('requested_downloads', None)
+            try:
+                with Metrics.span('extraction', download_id, kind='reuse'), \
+                        YoutubeDLPool.session(format=format_string, noplaylist=True) as ydl:
+                    return ydl.process_ie_result(info, download=False)
+            except Exception as e:
+                logger.info(f"Re-extracting {url}, stored info could not be reused: {e}")
+        with Metrics.span('extraction', download_id, kind='resolve'), \
+                YoutubeDLPool.session(format=format_string, noplaylist=True) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    @staticmethod
+    def needs_remux(fmt, extension):
+        """الصيغة الواحدة تمر بدمج -c copy (بدون إعادة ترميز) بدل مرحلة fixup في yt-dlp:
+        HLS يُكتب MPEG-TS، و DASH m4a حاوية مجزأة، أو حاوية تختلف عن امتداد الملف النهائي"""
+        return str(fmt.get('protocol') or '').startswith('m3u8') \
+            or fmt.get('container') == 'm4a_dash' or fmt.get('ext') != extension
+
+    @staticmethod
+    def can_stream(fmt):
+        """البث إلى ffmpeg ممكن لرابط HTTP مباشر واحد فقط (ليس HLS/DASH مجزأ)"""
+        return fmt.get('protocol') in ('http', 'https') and bool(fmt.get('url'))
+
+    def stream_audio(self, fmt, final_path, part_path, download_id, progress_tracker, retries=5):
+        """تحويل الصوت إلى mp3 أثناء التحميل: البايتات تُمرَّر إلى ffmpeg مباشرة ولا يُكتب
+        على القرص إلا الملف النهائي. يعيد False إذا كانت الحاوية لا تُقرأ من أنبوب
+        (mp4 بفهرس moov في آخره) وعندها تُحفظ البايتات في part_path للمسار العادي"""
+        session = SegmentedDownloader.shared_session()
+        headers = dict(fmt.get('http_headers') or {})
+        total = fmt.get('filesize')
+        progress_tracker.start_part(existing_bytes=0)
+        downloaded = 0
+        head = b''
+        pipe = None
+        part_file = None
+        write = None
+        attempt = 0
+        try:
+            while True:
+                # بعد انقطاع الاتصال نكمل من نفس البايت لأن ffmpeg ما زال ينتظر البقية
+                request_headers = dict(headers, Range=f'bytes={downloaded}-') if downloaded else headers
+                try:
+                    with session.get(fmt['url'], headers=request_headers, stream=True, timeout=30) as response:
+                        response.raise_for_status()
+                        if downloaded and response.status_code != 206:
+                            raise RuntimeError("Server does not support resuming the audio stream")
+                        length = response.headers.get('Content-Length')
+                        if total is None and length and length.isdigit():
+                            total = downloaded + int(length)
+                        for chunk in response.iter_content(256 * 1024):
+                            if not chunk:
+                                continue
+                            downloaded += len(chunk)
+                            if write is None:
+                                head += chunk
+                                if len(head) < 64 * 1024 and downloaded != total:
+                                    continue
+                                write, pipe, part_file = self._open_stream_sink(fmt, head, final_path, part_path)
+                                chunk, head = head, b''
+                            write(chunk)
+                            progress_tracker.hook({'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total})
+                    if total is None or downloaded >= total:
+                        break
+                    raise requests.exceptions.ConnectionError(f"Stream ended at {downloaded} of {total} bytes")
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+                    logger.info(f"Audio stream interrupted ({e}), reconnecting at byte {downloaded}")
+                    time.sleep(min(2 ** attempt, 10))
+
+            if write is None:
+                # ملف أصغر من حد الفحص
+                write, pipe, part_file = self._open_stream_sink(fmt, head, final_path, part_path)
+                write(head)
+            progress_tracker.finish_part(os.path.basename(fmt['url'].split('?')[0]))
+            if pipe:
+                # ما تبقى من عمل ffmpeg بعد وصول آخر بايت
+                with Metrics.span('transcode', download_id, kind='stream'):
+                    pipe.finish()
+                pipe = None
+                return True
+            part_file.close()
+            part_file = None
+            return False
+        finally:
+            # عند الإلغاء أو الخطأ: قتل ffmpeg وحذف الناتج الجزئي حتى لا يبقى mp3 مبتور
+            if pipe:
+                pipe.abort()
+            if part_file:
+                part_file.close()
+
+    @staticmethod
+    def _open_stream_sink(fmt, head, final_path, part_path):
+        if TranscodePipe.readable_from_pipe(head, fmt.get('ext')):
+            pipe = TranscodePipe(TranscodeStage.mp3_command('pipe:0'), final_path)
+            return pipe.write, pipe, None
+        logger.info("Audio container is not streamable, downloading before conversion")
+        part_file = OutputWriter(part_path, fmt.get('filesize'))
+        return part_file.write, None, part_file
+
+    def download_part(self, info, fmt, part_path, download_id, progress_tracker):
+        """تحميل صيغة واحدة إلى part_path: مقسماً إن أمكن وإلا عبر منزِّل yt-dlp"""
+        if part_path in self.journal.get(download_id).get('parts_done', []) and os.path.exists(part_path):
+            return
+        segments = self.journal.get(download_id).get('segments')
+        done_ranges = segments.get(part_path, []) if isinstance(segments, dict) else []
+        progress_tracker.start_part(existing_bytes=sum(end - start + 1 for start, end in done_ranges))
+        if not (USE_SEGMENTED_DOWNLOADS and self.download_segmented(fmt, part_path, download_id, progress_tracker)):
+            # yt-dlp يكمل من ملف .part إن وجد
+            partial = part_path + '.part'
+            progress_tracker.start_part(existing_bytes=os.path.getsize(partial) if os.path.exists(partial) else 0)
+            part_info = dict(info)
+            part_info.pop('requested_formats', None)
+            part_info.update(fmt)
+            with YoutubeDLPool.session(progress_hooks=[progress_tracker.hook], continuedl=True) as ydl:
+                success, _ = ydl.dl(part_path, part_info)
+            if not success:
+                raise RuntimeError(f"Download of format {fmt.get('format_id')} failed")
+        progress_tracker.finish_part(os.path.basename(part_path))
+        parts_done = self.journal.get(download_id).get('parts_done', [])
+        self.journal.record(download_id, parts_done=parts_done + [part_path])
+
+    def start_transcode(self, download_id, title, inputs, final_path, is_audio_only, duration=None):
+        """تسليم المدخلات المحملة إلى مرحلة الدمج/التحويل"""
+        listener = self._listeners.get(download_id, self.listener)
+        phase = 'transcode' if is_audio_only else 'merge'
+        if is_audio_only:
+            command = TranscodeStage.mp3_command(inputs[0][0])
+        else:
+            command = TranscodeStage.merge_command(inputs)
+        # حفظ المدخلات في السجل حتى يُستأنف التحويل مباشرة بعد إعادة التشغيل
+        self.journal.record(
+            download_id, phase=phase, duration=duration,
+            inputs=[[path, {k: fmt.get(k) for k in ('format_id', 'ext', 'vcodec', 'acodec')}] for path, fmt in inputs]
+        )
+        status = "Converting..." if is_audio_only else "Merging..."
+        listener.on_status(download_id, status)
+
+        def on_progress(task):
+            listener.on_status(download_id, f"{status} {task.percent:.0f}%")
+
+        def on_done(task, state, error):
+            paths = [path for path, _ in inputs]
+            if task.started_at:
+                Metrics.record_span('transcode', task.started_at, task.finished_at or time.time(), download_id,
+                                    {'state': state}, kind=phase)
+            try:
+                if state == 'done':
+                    for path in paths:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    self._complete(download_id, title, final_path, listener)
+                elif state == 'cancelled':
+                    self._discard(download_id, final_path, paths)
+                    listener.on_cancelled(download_id)
+                else:
+                    # المدخلات تبقى على القرص لإعادة المحاولة
+                    logger.error(f"Transcode failed for {download_id}: {error}")
+                    Metrics.inc('jobs_total', result='failed')
+                    attempts = self.journal.get(download_id).get('attempts', 0) + 1
+                    self.journal.record(download_id, attempts=attempts, last_error=error)
+                    listener.on_error(download_id, title, f"An error occurred:\n{error}")
+            finally:
+                DiskPolicy.release(download_id)
+                self._listeners.pop(download_id, None)
+
+        return self.transcoder.submit(download_id, command, final_path, duration, on_progress, on_done)
+
+    def _discard(self, download_id, final_path, paths=(), keep_final=False):
+        """حذف ملفات مهمة ملغاة وسجلها"""
+        record = self.journal.get(download_id)
+        # المسارات الوسيطة كما سجلتها المهمة فقط
+        paths = list(paths) + [path for path, _ in record.get('inputs') or []] + list(record.get('parts_done') or [])
+        if not keep_final and os.path.exists(final_path):
+            try:
+                os.remove(final_path)
+            except OSError:
+                pass
+        JobJournal.discard_partial_files(final_path, paths)
+        self.journal.remove(download_id)
+        self.library.release(download_id)
+        Metrics.inc('jobs_total', result='cancelled')
+
+    def download_segmented(self, fmt, part_path, download_id, progress_tracker):
+        """تحميل صيغة مباشرة واحدة عبر عدة اتصالات؛ يعيد False للرجوع إلى yt-dlp"""
+        if fmt.get('protocol') not in ('http', 'https') or not fmt.get('url'):
+            return False
+
+        segments_path = part_path + '.segments.part'
+        segments = self.journal.get(download_id).get('segments')
+        if not isinstance(segments, dict):
+            segments = {}
+
+        def on_range_done(start, end):
+            segments[part_path] = [list(r) for r in downloader.completed_ranges]
+            self.journal.record(download_id, segments=segments)
+
+        downloader = SegmentedDownloader(
+            fmt['url'], segments_path,
+            headers=fmt.get('http_headers'),
+            progress_hook=progress_tracker.hook,
+            completed_ranges=segments.get(part_path),
+            on_range_done=on_range_done,
+            is_paused=lambda: DownloadManager.is_paused(download_id)
+        )
+        try:
+            downloader.download()
+        except SegmentedDownloadUnsupported as e:
+            logger.info(f"Segmented download unavailable, using yt-dlp: {e}")
+            segments.pop(part_path, None)
+            self.journal.record(download_id, segments=segments)
+            try:
+                os.remove(segments_path)
+            except OSError:
+                pass
+            return False
+        
+        os.replace(segments_path, part_path)
+        return True
@@ -1,25 +1,32 @@
 # main.py (Toga - The Ultimate Control Version)
 
+import time
+# بداية قياس زمن التشغيل قبل أي استيراد ثقيل
+_startup_started = time.perf_counter()
+
 import toga
 from toga.style import Pack
 from toga.style.pack import COLUMN, ROW, CENTER
 from toga.colors import BLACK, WHITE, DODGERBLUE, LIGHTGRAY, BLUE, RED
 from toga.fonts import BOLD
-import threading
 import os
-import time
-import yt_dlp
-import imageio_ffmpeg
-import requests
 import sys
 import logging
-import re
-import tempfile
+import threading
+# yt_dlp و requests و imageio_ffmpeg تُستورد داخل engine عند أول استخدام فقط
+from engine import (
+    AsyncRuntime, DownloadEngine, DownloadListener, DownloadManager, BatchIngestor, Prefetcher, ProgressBus, StartupProfiler,
+    InsufficientDiskSpace, YoutubeDLPool,
+    DOWNLOADS_FOLDER, CACHE_FOLDER, warm_up, format_bytes,
+)
 
 # إعداد التسجيل للتصحيح
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+startup_profiler = StartupProfiler(_startup_started)
+startup_profiler.mark('imports')
+
 try:
     import pyperclip
 except ImportError:
@@ -33,82 +40,106 @@ except ImportError:
     PLYER_AVAILABLE = False
     notification = None
 
-DOWNLOADS_FOLDER = os.path.join(os.path.expanduser('~'), 'Downloads')
-
-class DownloadManager:
-    """مدير التحميل للتحكم في العمليات الخلفية"""
-    _active_downloads = {}
-    _cancel_flags = {}
-    
-    @classmethod
-    def add_download(cls, download_id, thread):
-        cls._active_downloads[download_id] = thread
-        cls._cancel_flags[download_id] = False
-        
-    @classmethod
-    def remove_download(cls, download_id):
-        if download_id in cls._active_downloads:
-            del cls._active_downloads[download_id]
-        if download_id in cls._cancel_flags:
-            del cls._cancel_flags[download_id]
-            
-    @classmethod
-    def cancel_download(cls, download_id):
-        if download_id in cls._cancel_flags:
-            cls._cancel_flags[download_id] = True
-            
-    @classmethod
-    def should_cancel(cls, download_id):
-        return cls._cancel_flags.get(download_id, False)
-            
-    @classmethod
-    def get_active_downloads(cls):
-        return cls._active_downloads
+class AppDownloadListener(DownloadListener):
+    """ربط أحداث المحرك بالواجهة؛ التحميل المعروض فقط يحدّث العناصر.
+    الأحداث تصل من خيوط العمال وتُنفذ على حلقة Toga عبر AsyncRuntime.call_soon"""
+    def __init__(self, app):
+        self.app = app
+
+    def is_current(self, download_id):
+        return self.app.current_download_id == download_id
 
-class ProgressTracker:
-    """تتبع تقدم التحميل"""
-    def __init__(self, app, download_id):
+    def on_status(self, download_id, text):
+        if self.is_current(download_id):
+            AsyncRuntime.call_soon(setattr, self.app.status_label, 'text', text)
+
+    def on_complete(self, download_id, title, path):
+        self.app.send_notification("Download Complete", f"'{title}' has been downloaded successfully")
+        if self.is_current(download_id):
+            self.app.show_success("Download Complete!")
+
+    def on_cancelled(self, download_id):
+        if self.is_current(download_id):
+            self.app.show_error("Download cancelled")
+
+    def on_error(self, download_id, title, message):
+        if self.is_current(download_id):
+            self.app.show_error(message)
+        else:
+            self.app.send_notification("Download Failed", f"'{title}' could not be downloaded")
+
+class BatchDownloadListener(DownloadListener):
+    """أحداث تحميلات الدفعة: عدّادات في batch_status_label وإشعار ملخص واحد عند انتهاء
+    الدفعة كلها، بدل إشعار لكل عنصر (أو نافذة حوار لكل عنصر بدون plyer)"""
+    def __init__(self, app):
         self.app = app
-        self.download_id = download_id
-        self.last_update = time.time()
-        
-    def hook(self, d):
-        # التحقق من طلب الإلغاء
-        if DownloadManager.should_cancel(self.download_id):
-            raise Exception("Download cancelled by user")
-            
-        if d['status'] == 'downloading':
-            # تحديث كل 0.3 ثانية لتجنب إبطاء الواجهة
-            current_time = time.time()
-            if current_time - self.last_update > 0.3:
-                percent = d.get('_percent_str', '0%').strip()
-                speed = d.get('_speed_str', 'N/A')
-                eta = d.get('_eta_str', 'N/A')
-                
-                # تنظيف النص من الأحرف غير الضرورية
-                percent = percent.replace('[download]', '').strip()
-                
-                # إرسال التحديث إلى الواجهة الرئيسية
-                self.app.main_thread_update(lambda p=percent, s=speed, e=eta: 
-                                          self.app.update_progress(p, s, e))
-                self.last_update = current_time
-        return True
+        self.batch = None
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.notified = False
+        self._lock = threading.Lock()
+
+    def on_complete(self, download_id, title, path):
+        with self._lock:
+            self.completed += 1
+        self.refresh()
+
+    def on_cancelled(self, download_id):
+        with self._lock:
+            self.cancelled += 1
+        self.refresh()
+
+    def on_error(self, download_id, title, message):
+        with self._lock:
+            self.failed += 1
+        self.refresh()
+
+    def refresh(self):
+        """تحديث سطر الحالة؛ آمنة من أي خيط"""
+        batch = self.batch
+        if batch is None:
+            return
+        with self._lock:
+            failed = self.failed + batch.failed
+            finished = batch.enumeration_done and self.completed + self.failed + self.cancelled >= batch.resolved
+            notify = finished and not self.notified
+            self.notified = self.notified or finished
+            state = "" if batch.enumeration_done else " (listing...)"
+            text = f"Queued {batch.resolved} of {batch.enumerated}{state}: {self.completed} downloaded, {failed} failed"
+            summary = f"{self.completed} downloaded, {failed} failed" + (f", {self.cancelled} cancelled" if self.cancelled else "")
+
+        def apply():
+            self.app.batch_status_label.text = text
+            if batch.enumeration_done:
+                self.app.batch_button.text = 'Download All'
+        AsyncRuntime.call_soon(apply)
+        if notify:
+            self.app.send_notification("Batch Finished", summary)
 
 class TogaDownloader(toga.App):
 
     def startup(self):
+        # كل التنسيق (الاستخراج، الصور، تحديثات الواجهة) على حلقة Toga نفسها
+        AsyncRuntime.bind(self.event_loop())
         self.main_box = toga.Box(style=Pack(direction=COLUMN, background_color=BLACK))
 
         # --- الشاشة الرئيسية ---
         title_label = toga.Label("Downloader", style=Pack(font_size=24, font_weight=BOLD, color=DODGERBLUE, text_align=CENTER, margin=20))
-        self.url_input = toga.TextInput(placeholder='Paste a link here...', style=Pack(flex=1, padding=5, background_color=LIGHTGRAY, color=BLACK))
+        self.url_input = toga.TextInput(placeholder='Paste a link here...', on_change=self.on_url_changed, style=Pack(flex=1, padding=5, background_color=LIGHTGRAY, color=BLACK))
         paste_button = toga.Button('Paste', on_press=self.paste_from_clipboard, style=Pack(width=80, padding=5))
         self.download_button_main = toga.Button('Download', on_press=self.go_to_download_screen, style=Pack(flex=1, padding=10, background_color=DODGERBLUE, color=WHITE, font_weight=BOLD))
         
         exit_button = toga.Button('Exit', on_press=self.exit_app, style=Pack(flex=1, padding=10, background_color='red', color=WHITE, font_weight=BOLD))
         
+        # التحميل الدفعي: قائمة تشغيل/قناة أو عدة روابط
+        self.batch_format = toga.Selection(items=['MP4', 'MP3'], style=Pack(width=80, padding=5))
+        self.batch_button = toga.Button('Download All', on_press=self.toggle_batch, style=Pack(flex=1, padding=5))
+        self.batch_status_label = toga.Label("", style=Pack(padding=5, text_align=CENTER, color=LIGHTGRAY))
+        batch_box = toga.Box(children=[self.batch_button, self.batch_format], style=Pack(direction=ROW, padding=5))
+        
         input_box = toga.Box(children=[self.url_input, paste_button], style=Pack(direction=ROW, padding=5))
-        self.main_screen_box = toga.Box(children=[title_label, input_box, self.download_button_main, exit_button], style=Pack(direction=COLUMN, padding=10))
+        self.main_screen_box = toga.Box(children=[title_label, input_box, self.download_button_main, batch_box, self.batch_status_label, exit_button], style=Pack(direction=COLUMN, padding=10))
 
         # --- شاشة التحميل ---
         self.thumbnail_image = toga.ImageView(style=Pack(width=320, height=180, margin_top=20, align_items=CENTER, background_color=BLACK))
@@ -130,12 +161,18 @@ class TogaDownloader(toga.App):
         
         # زر إلغاء التحميل
         self.cancel_button = toga.Button('Cancel Download', on_press=self.cancel_download, style=Pack(flex=1, padding=10, background_color=RED, color=WHITE, font_weight=BOLD, visibility='hidden'))
+        # زر الإيقاف المؤقت والاستئناف
+        self.pause_button = toga.Button('Pause', on_press=self.toggle_pause, style=Pack(flex=1, padding=10, visibility='hidden'))
         
         self.progress_container.add(self.percentage_label)
         self.progress_container.add(self.status_label)
         self.progress_container.add(self.speed_label)
+        self.progress_container.add(self.pause_button)
         self.progress_container.add(self.cancel_button)
         
+        # ملخص كل التحميلات النشطة (يُحدّث في دورة العرض)
+        self.activity_label = toga.Label("", style=Pack(padding=5, text_align=CENTER, color=LIGHTGRAY))
+        
         another_video_button = toga.Button('Download Another Video', on_press=self.go_to_main_screen, style=Pack(flex=1, padding=5))
         exit_button_download = toga.Button('Exit', on_press=self.exit_app, style=Pack(flex=1, padding=10, background_color='red', color=WHITE, font_weight=BOLD))
 
@@ -150,6 +187,7 @@ class TogaDownloader(toga.App):
                 self.title_result_label,
                 self.download_controls_box,
                 self.progress_container,
+                self.activity_label,
                 another_video_button,
                 exit_button_download
             ],
@@ -160,15 +198,61 @@ class TogaDownloader(toga.App):
         self.main_window.content = self.main_box
         self.go_to_main_screen()
         self.main_window.show()
+        startup_profiler.mark('window_shown')
+        # أول دورة للحلقة بعد رسم النافذة: نبدأ التسخين في الخلفية
+        AsyncRuntime.call_soon(self.on_first_frame)
 
         self.video_info = {}
         self.current_download_id = None
-        self.is_downloading = False
-        self.download_thread = None
-        self.progress_tracker = None
+        self.engine = DownloadEngine(DOWNLOADS_FOLDER, listener=AppDownloadListener(self))
+        # نفس أبعاد thumbnail_image حتى تُستخدم الصورة المجلوبة مسبقاً كما هي
+        self.prefetcher = Prefetcher(self.engine, thumbnail_size=(320, 180))
+        self.batch = None
         
         self.check_clipboard_for_url()
 
+    def on_first_frame(self):
+        startup_profiler.mark('first_frame')
+        AsyncRuntime.spawn(self.warm_up_in_background())
+        self.progress_tick()
+
+    def progress_tick(self):
+        """دورة عرض واحدة على خيط الواجهة لكل المهام النشطة بدلاً من استدعاء لكل تحديث"""
+        bus = self.engine.progress_bus
+        try:
+            for update in bus.drain():
+                if update['id'] == self.current_download_id:
+                    self.update_progress(*ProgressBus.format_update(update))
+            active = bus.active_count()
+            if active:
+                self.activity_label.text = f"{active} active - {format_bytes(bus.total_speed())}/s total"
+            elif self.activity_label.text:
+                self.activity_label.text = ""
+        except Exception as e:
+            logger.error(f"Failed to render progress: {e}")
+        # إبطاء الدورة عند عدم وجود تحميلات نشطة
+        delay = 1.0 / bus.fps if bus.active_count() else 1.0
+        self.event_loop().call_later(delay, self.progress_tick)
+
+    def event_loop(self):
+        return getattr(self, 'loop', None) or self._impl.loop
+
+    async def warm_up_in_background(self):
+        timings = await AsyncRuntime.run_blocking(warm_up)
+        startup_profiler.mark('warmed_up')
+        # السجل ومطابقة المكتبة (sqlite وفحص مجلد التحميلات) خارج خيط الواجهة وبعد أول إطار
+        try:
+            await AsyncRuntime.run_blocking(self.engine.resume_unfinished)
+        except Exception as e:
+            logger.error(f"Failed to resume unfinished downloads: {e}")
+        report = startup_profiler.save(os.path.join(CACHE_FOLDER, 'startup_report.json'), timings)
+        logger.info(f"Startup report: {report}")
+        # معطلة افتراضياً (METRICS_PORT و TRACE_FILE في engine.py)
+        try:
+            self.engine.start_metrics()
+        except OSError as e:
+            logger.error(f"Failed to start metrics: {e}")
+
     def switch_screen(self, new_screen_box):
         if self.main_box.children:
             self.main_box.remove(self.main_box.children[0])
@@ -178,32 +262,56 @@ class TogaDownloader(toga.App):
         self.url_input.value = ''
         self.switch_screen(self.main_screen_box)
 
-    def go_to_download_screen(self, widget):
+    async def go_to_download_screen(self, widget):
         url = self.url_input.value.strip()
         if not url:
             self.main_window.error_dialog("Input Error", "Please provide a link to download.")
             return
         
+        # أكثر من رابط = تحميل دفعي
+        if len(BatchIngestor.split_links(url)) > 1:
+            self.start_batch(url)
+            return
+        
         self.download_button_main.enabled = False
         self.download_button_main.text = 'Fetching Info...'
+        # الجلب المسبق لهذا الرابط (إن وجد) يكمل ويشترك معه الطلب الفعلي
+        self.prefetcher.cancel(keep=url)
         
-        threading.Thread(target=self.fetch_video_info, args=(url,), daemon=True).start()
+        await self.fetch_video_info(url)
 
-    def fetch_video_info(self, url):
+    def toggle_batch(self, widget):
+        if self.batch and not self.batch.enumeration_done:
+            self.batch.cancel()
+            self.batch_status_label.text = "Stopping batch..."
+            return
+        text = self.url_input.value.strip()
+        if not BatchIngestor.split_links(text):
+            self.main_window.error_dialog("Input Error", "Please provide a playlist, channel or list of links.")
+            return
+        self.start_batch(text)
+
+    def start_batch(self, text):
+        """تعداد الروابط وجدولة كل عنصر للتحميل فور حل معلوماته"""
+        listener = BatchDownloadListener(self)
+        self.batch_button.text = 'Stop Batch'
+        self.batch_status_label.text = "Listing entries..."
+        self.prefetcher.cancel()
+        self.batch = self.engine.start_batch(text, is_audio_only=self.batch_format.value == 'MP3', listener=listener,
+                                             on_update=lambda batch: listener.refresh())
+        listener.batch = self.batch
+        listener.refresh()
+        self.url_input.value = ''
+
+    async def fetch_video_info(self, url):
         try:
-            ydl_opts = {
-                'quiet': True, 
-                'no_warnings': True,
-                'socket_timeout': 30,
-                'extract_flat': False
-            }
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                self.video_info = ydl.extract_info(url, download=False)
-            self.main_thread_update(lambda: self.display_download_screen())
+            self.video_info = await self.engine.fetch_info_async(url)
         except Exception as e:
             error_msg = f"Failed to fetch info: {str(e)}"
             logger.error(error_msg)
-            self.main_thread_update(lambda: self.show_error(error_msg))
+            self.show_error(error_msg)
+            return
+        self.display_download_screen()
 
     def display_download_screen(self):
         """عرض شاشة التحميل"""
@@ -213,24 +321,22 @@ class TogaDownloader(toga.App):
         
         thumbnail_url = self.video_info.get('thumbnail')
         if thumbnail_url:
-            threading.Thread(target=self.load_thumbnail, args=(thumbnail_url,), daemon=True).start()
+            AsyncRuntime.spawn(self.load_thumbnail(thumbnail_url))
 
         self.select_format('mp4') # عرض جودات الفيديو افتراضياً
+        # التحميلات السابقة تكمل في الخلفية ولا تُعرض على هذه الشاشة
+        self.current_download_id = None
         self.reset_download_ui()
         self.switch_screen(self.download_screen_box)
         self.download_button_main.enabled = True
         self.download_button_main.text = 'Download'
 
-    def load_thumbnail(self, url):
+    async def load_thumbnail(self, url):
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            image_data = response.content
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-                tmp_file.write(image_data)
-                tmp_file.flush()
-                self.main_thread_update(lambda path=tmp_file.name: self.set_thumbnail_image(path))
+            path = await self.engine.fetch_thumbnail_async(url, size=self.prefetcher.thumbnail_size)
+            # المستخدم قد ينتقل لفيديو آخر قبل وصول الصورة
+            if path and self.video_info.get('thumbnail') == url:
+                self.set_thumbnail_image(path)
         except Exception as e:
             logger.error(f"Failed to load thumbnail: {e}")
 
@@ -240,10 +346,16 @@ class TogaDownloader(toga.App):
         except Exception as e:
             logger.error(f"Toga failed to display image: {e}")
 
+    def on_url_changed(self, widget):
+        # يصل قبل إنشاء المحرك عند ضبط القيمة أثناء startup
+        if getattr(self, 'prefetcher', None):
+            self.prefetcher.schedule(widget.value)
+
     def paste_from_clipboard(self, widget):
         try:
             if pyperclip:
                 self.url_input.value = pyperclip.paste()
+                self.prefetcher.schedule(self.url_input.value, delay=0)
             else:
                 self.main_window.info_dialog("Clipboard Error", "Pyperclip library not found. Please paste manually.")
         except Exception as e:
@@ -256,39 +368,12 @@ class TogaDownloader(toga.App):
                 clipboard_text = pyperclip.paste()
                 if clipboard_text and ('http://' in clipboard_text or 'https://' in clipboard_text or 'youtube.com' in clipboard_text or 'youtu.be' in clipboard_text):
                     self.url_input.value = clipboard_text
+                    self.prefetcher.schedule(clipboard_text, delay=0)
         except Exception as e:
             logger.error(f"Could not check clipboard: {e}")
 
     def select_format(self, format_type):
-        formats_list = []
-        
-        if format_type == 'mp4':
-            formats_list.append({'text': 'Best Quality (Video + Audio)', 'id': 'bestvideo+bestaudio'})
-            unique_heights = set()
-            for f in self.video_info.get('formats', []):
-                if f.get('vcodec') != 'none' and f.get('height', 0) > 0 and f['height'] not in unique_heights:
-                    unique_heights.add(f['height'])
-                    filesize = f.get('filesize') or f.get('filesize_approx') or 0
-                    label = f"{f['height']}p"
-                    if filesize > 0:
-                        label += f" ({(filesize / 1024**2):.1f} MB)"
-                    formats_list.append({'text': f"Video Only: {label}", 'id': f['format_id']})
-                        
-        elif format_type == 'mp3':
-            unique_abr = set()
-            for f in self.video_info.get('formats', []):
-                if f.get('acodec') != 'none' and f.get('vcodec') == 'none' and f.get('abr', 0) > 0 and f['abr'] not in unique_abr:
-                    unique_abr.add(f['abr'])
-                    filesize = f.get('filesize') or f.get('filesize_approx') or 0
-                    label = f"{f['abr']}kbps"
-                    if filesize > 0:
-                        label += f" ({(filesize / 1024**2):.1f} MB)"
-                    formats_list.append({'text': label, 'id': f['format_id']})
-            if not formats_list:
-                formats_list.append({'text': 'Best Audio', 'id': 'bestaudio'})
-        
-        if not formats_list:
-            formats_list.append({'text': 'Default Quality', 'id': 'best'})
+        formats_list = self.engine.format_options(self.video_info, format_type)
             
         self.quality_spinner.items = [f['text'] for f in formats_list]
         self.quality_spinner.format_map = {f['text']: f['id'] for f in formats_list}
@@ -310,149 +395,80 @@ class TogaDownloader(toga.App):
         self.download_controls_box.style.visibility = 'hidden'
         self.progress_container.style.visibility = 'visible'
         self.cancel_button.style.visibility = 'visible'
-        self.status_label.text = "Downloading..."
+        self.pause_button.style.visibility = 'visible'
+        self.pause_button.text = 'Pause'
         
         url = self.video_info.get('webpage_url')
         custom_filename = self.rename_input.value.strip()
+        # لقطة من حالة الشاشة لأن المهمة قد تبدأ بعد أن ينتقل المستخدم لفيديو آخر
+        title = self.video_info.get('title', 'download')
+        is_audio_only = format_id == 'bestaudio' or 'mp3' in selected_quality_text.lower()
         
+        # المعرف يُحدد قبل الجدولة حتى تصل أحداث المهمة الأولى إلى هذه الشاشة
         self.current_download_id = f"{url}_{format_id}_{time.time()}"
-        self.is_downloading = True
-        
-        # إنشاء متتبع التقدم
-        self.progress_tracker = ProgressTracker(self, self.current_download_id)
-        
-        self.download_thread = threading.Thread(
-            target=self.download_thread_target, 
-            args=(url, format_id, custom_filename, self.current_download_id),
-            daemon=False
-        )
+        try:
+            job = self.engine.submit_download(url, format_id, title, is_audio_only, custom_filename,
+                                              download_id=self.current_download_id)
+        except InsufficientDiskSpace as e:
+            # رفض فوري قبل تحميل أي بايت؛ يبقى المستخدم على نفس الشاشة ليختار جودة أصغر
+            self.current_download_id = None
+            self.reset_download_ui()
+            self.main_window.error_dialog("Not Enough Space", str(e))
+            return
         
-        DownloadManager.add_download(self.current_download_id, self.download_thread)
-        self.download_thread.start()
+        position = DownloadManager.queue_position(job.download_id)
+        if job.state == 'queued' and position is not None:
+            self.status_label.text = f"Queued ({position} ahead)..."
+        else:
+            self.status_label.text = "Downloading..."
 
     def cancel_download(self, widget):
         """إلغاء التحميل الحالي"""
-        if self.is_downloading and self.current_download_id:
-            DownloadManager.cancel_download(self.current_download_id)
+        if self.current_download_id and self.engine.cancel_download(self.current_download_id):
             self.status_label.text = "Cancelling download..."
             self.cancel_button.enabled = False
+            self.pause_button.enabled = False
+
+    def toggle_pause(self, widget):
+        """إيقاف مؤقت أو استئناف التحميل المعروض"""
+        job = DownloadManager.get_job(self.current_download_id) if self.current_download_id else None
+        if not job:
+            return
+        if job.state == 'paused':
+            DownloadManager.resume_download(job.download_id)
+            self.pause_button.text = 'Pause'
+            self.status_label.text = "Downloading..." if job.started_at else "Queued..."
+        else:
+            DownloadManager.pause_download(job.download_id)
+            self.pause_button.text = 'Resume'
+            self.status_label.text = "Paused"
 
     def update_progress(self, percent, speed, eta):
         """تحديث شريط التقدم مع النسبة المئوية"""
         self.percentage_label.text = percent
         self.speed_label.text = f"{speed} - ETA: {eta}"
         
-    def get_unique_filename(self, base_path, extension):
-        counter = 1
-        new_path = f"{base_path}.{extension}"
-        while os.path.exists(new_path):
-            new_path = f"{base_path} ({counter}).{extension}"
-            counter += 1
-        return new_path
-
-    def download_thread_target(self, url, format_id, custom_filename, download_id):
-        try:
-            os.makedirs(DOWNLOADS_FOLDER, exist_ok=True)
-            
-            base_name = custom_filename or re.sub(r'[<>:"/\\|?*]', '', self.video_info.get('title', 'download'))
-            
-            # تحديد نوع التحميل بناءً على format_id
-            is_audio_only = format_id == 'bestaudio' or 'mp3' in self.quality_spinner.value.lower()
-
-            if is_audio_only:
-                # خيارات تحميل الصوت فقط
-                extension = 'mp3'
-                final_path = self.get_unique_filename(os.path.join(DOWNLOADS_FOLDER, base_name), extension)
-                ydl_opts = {
-                    'format': format_id if format_id != 'bestaudio' else 'bestaudio/best',
-                    'outtmpl': final_path,
-                    'extractaudio': True,
-                    'audioformat': 'mp3',
-                    'ffmpeg_location': imageio_ffmpeg.get_ffmpeg_exe(),
-                    'noplaylist': True,
-                    'quiet': True,
-                    'no_warnings': True,
-                    'progress_hooks': [self.progress_tracker.hook],
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }]
-                }
-            else:
-                # خيارات تحميل الفيديو (مع دمج الصوت)
-                extension = 'mp4'
-                final_path = self.get_unique_filename(os.path.join(DOWNLOADS_FOLDER, base_name), extension)
-                
-                # استخدام format_id المحدد بدلاً من الخيار الافتراضي
-                if format_id == 'bestvideo+bestaudio':
-                    format_string = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-                else:
-                    format_string = format_id
-                
-                ydl_opts = {
-                    'format': format_string,
-                    'outtmpl': final_path,
-                    'merge_output_format': 'mp4',
-                    'ffmpeg_location': imageio_ffmpeg.get_ffmpeg_exe(),
-                    'noplaylist': True,
-                    'quiet': True,
-                    'no_warnings': True,
-                    'progress_hooks': [self.progress_tracker.hook],
-                }
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-                
-            # التحقق إذا كان التحميل ملغى
-            if DownloadManager.should_cancel(download_id):
-                # حذف الملف إذا كان التحميل ملغى
-                try:
-                    if os.path.exists(final_path):
-                        os.remove(final_path)
-                except:
-                    pass
-                self.main_thread_update(lambda: self.show_error("Download cancelled"))
-                return
-                
-            title = self.video_info.get('title', 'Download')
-            self.send_notification("Download Complete", f"'{title}' has been downloaded successfully")
-            
-            self.main_thread_update(lambda: self.show_success("Download Complete!"))
-
-        except Exception as e:
-            if "cancelled" in str(e).lower():
-                self.main_thread_update(lambda: self.show_error("Download cancelled"))
-            else:
-                error_msg = f"An error occurred:\n{str(e)}"
-                logger.error(error_msg)
-                self.main_thread_update(lambda: self.show_error(error_msg))
-        finally:
-            self.is_downloading = False
-            DownloadManager.remove_download(download_id)
-
     def send_notification(self, title, message):
         try:
             if PLYER_AVAILABLE:
                 notification.notify(title=title, message=message, timeout=10)
             else:
-                self.main_thread_update(lambda: self.main_window.info_dialog(title, message))
+                AsyncRuntime.call_soon(self.main_window.info_dialog, title, message)
         except Exception as e:
             logger.error(f"Failed to send notification: {e}")
 
     def show_error(self, message):
-        # استخدام الطريقة الآمنة لعرض الديالوج
+        # آمنة من أي خيط: العرض يتم على حلقة الواجهة
         def show_dialog():
             self.main_window.error_dialog("Error", str(message))
             self.reset_main_ui()
-        self.main_thread_update(show_dialog)
+        AsyncRuntime.call_soon(show_dialog)
 
     def show_success(self, message):
-        # استخدام الطريقة الآمنة لعرض الديالوج
         def show_dialog():
             self.main_window.info_dialog("Success", message)
             self.reset_download_ui()
-        self.main_thread_update(show_dialog)
+        AsyncRuntime.call_soon(show_dialog)
 
     def reset_main_ui(self):
         self.download_button_main.enabled = True
@@ -464,38 +480,21 @@ class TogaDownloader(toga.App):
         self.progress_container.style.visibility = 'hidden'
         self.cancel_button.style.visibility = 'hidden'
         self.cancel_button.enabled = True
+        self.pause_button.style.visibility = 'hidden'
+        self.pause_button.enabled = True
+        self.pause_button.text = 'Pause'
         self.percentage_label.text = "0%"
         self.status_label.text = ""
         self.speed_label.text = ""
-        self.is_downloading = False
         
-    def main_thread_update(self, func):
-        # استخدام الطريقة الآمنة لتحديث الواجهة
-        try:
-            self.main_window.app._impl.loop.call_soon_threadsafe(func)
-        except:
-            # بديل إذا فشلت الطريقة الأولى
-            try:
-                import asyncio
-                asyncio.get_event_loop().call_soon_threadsafe(func)
-            except:
-                # محاولة تنفيذ الدالة مباشرة
-                try:
-                    func()
-                except Exception as e:
-                    logger.error(f"Failed to update UI: {e}")
-
-    def exit_app(self, widget):
-        if self.is_downloading:
-            # استخدام الطريقة الآمنة لعرض الديالوج
-            def show_confirm():
-                result = self.main_window.confirm_dialog(
-                    "Download in Progress", 
-                    "A download is in progress. Closing the app will interrupt it. Are you sure you want to exit?"
-                )
-                if result:
-                    self.main_window.close()
-            self.main_thread_update(show_confirm)
+    async def exit_app(self, widget):
+        if self.engine.has_pending():
+            result = await self.main_window.confirm_dialog(
+                "Download in Progress", 
+                "Downloads are in progress. Closing the app will interrupt it. Are you sure you want to exit?"
+            )
+            if result:
+                self.main_window.close()
         else:
             self.main_window.close()
 
@@ -512,4 +511,10 @@ if __name__ == '__main__':
         active_downloads = DownloadManager.get_active_downloads()
         for download_id, thread in list(active_downloads.items()):
             if thread.is_alive():
-                thread.join(timeout=2)
\ No newline at end of file
+                thread.join(timeout=2)
+        # المهام غير المكتملة تبقى في السجل وتُستأنف في التشغيل التالي
+        if getattr(app, 'engine', None):
+            app.engine.transcoder.stop()
+            app.engine.journal.flush()
+        AsyncRuntime.shutdown()
+        YoutubeDLPool.close_all()
\ No newline at end of file
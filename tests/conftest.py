@@ -0,0 +1,98 @@
+# conftest.py - خادم HTTP محلي بدعم Range لاختبارات التحميل المقسم
+
+import os
+import random
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class RangeServer:
+    """يقدم ملفاً واحداً مع دعم Range ويسجل ترويسة Range لكل طلب.
+    ignore_ranges يجيب بـ 200 والملف كاملاً (بعد طلب الفحص إن كان probe_ok)،
+    truncate_next يقطع عدداً من الاستجابات في منتصفها مع Content-Length كامل"""
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+        self.ignore_ranges = False
+        self.probe_ok = False
+        self.truncate_next = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/file.bin"
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, handler):
+        range_header = handler.headers.get('Range')
+        with self._lock:
+            self.ranges.append(range_header)
+            truncate = False
+            if self.truncate_next and range_header != 'bytes=0-0':
+                self.truncate_next -= 1
+                truncate = True
+        data = self.data
+        start, end = 0, len(data) - 1
+        honour_range = not self.ignore_ranges or (self.probe_ok and range_header == 'bytes=0-0')
+        if range_header and range_header.startswith('bytes=') and honour_range:
+            first, _, last = range_header[6:].partition('-')
+            start = int(first)
+            end = min(int(last), end) if last else end
+            handler.send_response(206)
+            handler.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+        else:
+            handler.send_response(200)
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.send_header('Content-Length', str(end - start + 1))
+        if truncate:
+            handler.send_header('Connection', 'close')
+        handler.end_headers()
+        body = data[start:end + 1]
+        if truncate:
+            # نصف النطاق فقط ثم إغلاق الاتصال
+            handler.wfile.write(body[:len(body) // 2])
+            handler.wfile.flush()
+            handler.close_connection = True
+            return
+        handler.wfile.write(body)
+
+@pytest.fixture
+def payload():
+    return random.Random(6).randbytes(1024**2 + 12345)
+
+@pytest.fixture
+def range_server(payload):
+    server = RangeServer(payload).start()
+    yield server
+    server.stop()
@@ -0,0 +1,68 @@
+# test_disk_admission.py - حجز القرص عند الجدولة يطابق الصيغ التي سيحملها yt-dlp فعلاً
+
+import copy
+
+import pytest
+import yt_dlp
+
+import engine
+from engine import DiskPolicy, DownloadEngine, FormatIndex
+from benchmarks.fake_info import fake_info
+
+def processed_info(duration=600, formats=None):
+    """معلومات كما يخزنها fetch_info: بعد معالجة yt-dlp (صيغ مرتبة ومكتملة الحقول)"""
+    info = fake_info(duration=duration)
+    if formats:
+        info['formats'] = formats(info['formats'])
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+        return ydl.sanitize_info(ydl.process_ie_result(info, download=False))
+
+def requested_size(info, spec):
+    """مجموع filesize للصيغ التي يختارها yt-dlp نفسه بهذا المحدِّد"""
+    info = copy.deepcopy(info)
+    info.pop('requested_formats', None)
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'format': spec}) as ydl:
+        resolved = ydl.process_ie_result(info, download=False)
+    return sum(f['filesize'] for f in resolved.get('requested_formats') or [resolved])
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    # الجدولة فقط؛ لا تشغيل للتحميل نفسه
+    monkeypatch.setattr(engine.DownloadManager, 'submit', lambda *args, **kwargs: None)
+    monkeypatch.setattr(DiskPolicy, 'reserve_bytes', 0)
+    bench = DownloadEngine(str(tmp_path / 'downloads'), cache_folder=str(tmp_path / 'cache'),
+                           data_folder=str(tmp_path / 'data'))
+    yield bench
+    DiskPolicy.release('job')
+
+def test_best_quality_reserves_selected_formats(bench):
+    info = processed_info()
+    bench.metadata_cache.put(info['webpage_url'], info)
+    size = requested_size(info, FormatIndex.download_spec('bestvideo+bestaudio'))
+
+    assert bench.format_index(info).estimate_size('bestvideo+bestaudio') == size
+    bench.submit_download(info['webpage_url'], 'bestvideo+bestaudio', download_id='job')
+    # المدخلات المحملة + ناتج الدمج الذي يُكتب بجانبها
+    assert DiskPolicy.stats()['reserved_bytes'] == 2 * size
+
+def test_explicit_format_reserves_its_size(bench):
+    info = processed_info()
+    bench.metadata_cache.put(info['webpage_url'], info)
+    fmt = next(f for f in info['formats'] if f['vcodec'] != 'none' and f['ext'] == 'mp4')
+
+    bench.submit_download(info['webpage_url'], fmt['format_id'], download_id='job')
+    assert DiskPolicy.stats()['reserved_bytes'] == fmt['filesize']
+
+def test_unknown_info_reserves_nothing(bench):
+    bench.submit_download('https://media.invalid/watch/unknown', 'bestvideo+bestaudio', download_id='job')
+    assert DiskPolicy.stats()['reserved_bytes'] == 0
+
+def test_best_quality_without_merge_reserves_single_file(bench):
+    # بدون صيغ فيديو وصوت منفصلة يختار المحدِّد best[ext=mp4] فلا يوجد ناتج دمج
+    info = processed_info(formats=lambda formats: [dict(f, acodec='mp4a.40.2') for f in formats
+                                                   if f['vcodec'] != 'none' and f['ext'] == 'mp4'])
+    bench.metadata_cache.put(info['webpage_url'], info)
+    size = requested_size(info, FormatIndex.download_spec('bestvideo+bestaudio'))
+
+    bench.submit_download(info['webpage_url'], 'bestvideo+bestaudio', download_id='job')
+    assert DiskPolicy.stats()['reserved_bytes'] == size
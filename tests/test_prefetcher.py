@@ -0,0 +1,75 @@
+# test_prefetcher.py - Prefetcher على حلقة asyncio مربوطة بـ AsyncRuntime ومحرك وهمي بلا شبكة
+
+import asyncio
+
+import pytest
+
+from engine import AsyncRuntime, Prefetcher
+
+class FakeEngine:
+    """يسجل الروابط التي وصل استخراجها فعلاً"""
+    def __init__(self):
+        self.fetched = []
+
+    async def fetch_info_async(self, url):
+        self.fetched.append(url)
+        await asyncio.sleep(0)
+        return {'webpage_url': url}
+
+    def format_index(self, info):
+        return None
+
+    async def fetch_thumbnail_async(self, url, size=None):
+        return None
+
+@pytest.fixture
+def run_on_runtime():
+    def run(coro_func):
+        async def main():
+            AsyncRuntime.bind(asyncio.get_running_loop())
+            return await coro_func()
+        try:
+            return asyncio.run(main())
+        finally:
+            AsyncRuntime.shutdown()
+    return run
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+def test_cancel_before_first_step_frees_slot(run_on_runtime):
+    engine = FakeEngine()
+    prefetcher = Prefetcher(engine, max_active=2)
+
+    async def scenario():
+        # الإلغاء في نفس دورة الحلقة: الـ coroutine لا يبدأ أبداً
+        for url in ('https://example.com/a', 'https://example.com/b'):
+            prefetcher._start(url)
+            prefetcher.cancel()
+        await settle()
+        assert prefetcher._active == {}
+
+        prefetcher._start('https://example.com/c')
+        await settle()
+        assert prefetcher._active == {}
+        assert prefetcher._waiting is None
+
+    run_on_runtime(scenario)
+    assert engine.fetched == ['https://example.com/c']
+
+def test_waiting_link_starts_when_slot_frees(run_on_runtime):
+    engine = FakeEngine()
+    prefetcher = Prefetcher(engine, max_active=1)
+
+    async def scenario():
+        prefetcher._start('https://example.com/a')
+        # الأحدث يحل محل المنتظر
+        prefetcher._start('https://example.com/b')
+        prefetcher._start('https://example.com/c')
+        assert prefetcher._waiting == 'https://example.com/c'
+        await settle()
+        assert prefetcher._active == {}
+
+    run_on_runtime(scenario)
+    assert engine.fetched == ['https://example.com/a', 'https://example.com/c']
@@ -0,0 +1,167 @@
+# test_segmented_download.py - SegmentedDownloader مقابل خادم Range محلي (conftest.range_server)
+
+import os
+import threading
+
+import pytest
+import requests
+
+import engine
+from engine import DownloadEngine, ProgressTracker, SegmentedDownloader, SegmentedDownloadUnsupported
+
+MIN_SEGMENT = 128 * 1024
+
+def make_downloader(server, path, **kwargs):
+    return SegmentedDownloader(server.url, path, connections=4, min_segment=MIN_SEGMENT,
+                               session=requests.Session(), **kwargs)
+
+def requested_starts(server):
+    """بدايات النطاقات المطلوبة بعد طلب الفحص"""
+    return [int(r[6:].partition('-')[0]) for r in server.ranges if r and r != 'bytes=0-0']
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # إعادة المحاولة تنتظر ثواني بين المحاولات
+    monkeypatch.setattr(engine.time, 'sleep', lambda seconds: None)
+
+def test_full_download(range_server, payload, tmp_path):
+    path = str(tmp_path / 'out.bin')
+    progress = []
+    done = []
+    downloader = make_downloader(range_server, path, progress_hook=progress.append,
+                                 on_range_done=lambda start, end: done.append((start, end)))
+
+    assert downloader.download() == len(payload)
+    with open(path, 'rb') as f:
+        assert f.read() == payload
+    # عدة نطاقات تغطي الملف بلا فجوات
+    assert len(done) > 1
+    assert downloader._missing_ranges(len(payload)) == []
+    assert progress[-1]['status'] == 'finished'
+    assert progress[-1]['downloaded_bytes'] == len(payload)
+
+def test_resume_from_completed_ranges(range_server, payload, tmp_path):
+    path = str(tmp_path / 'out.bin')
+    split = len(payload) // 2
+    with open(path, 'wb') as f:
+        f.write(payload[:split] + b'\0' * (len(payload) - split))
+
+    downloader = make_downloader(range_server, path, completed_ranges=[[0, split - 1]])
+    downloader.download()
+
+    with open(path, 'rb') as f:
+        assert f.read() == payload
+    # لا يُطلب أي بايت من النطاق المكتمل
+    assert requested_starts(range_server)
+    assert min(requested_starts(range_server)) >= split
+
+def test_retry_after_truncated_response(range_server, payload, tmp_path):
+    path = str(tmp_path / 'out.bin')
+    range_server.truncate_next = 1
+    downloader = make_downloader(range_server, path)
+
+    downloader.download()
+
+    with open(path, 'rb') as f:
+        assert f.read() == payload
+    # النطاق المقطوع يُطلب مرة أخرى لنفس النهاية، من بدايته أو مما وصل منه
+    truncated = next(r for r in range_server.ranges if r != 'bytes=0-0')
+    start, _, end = truncated[6:].partition('-')
+    attempts = [r for r in range_server.ranges if r.endswith(f'-{end}')]
+    assert len(attempts) == 2
+    assert int(attempts[1][6:].partition('-')[0]) >= int(start)
+
+def test_truncated_responses_exhaust_retries(range_server, tmp_path):
+    range_server.truncate_next = 100
+    downloader = make_downloader(range_server, str(tmp_path / 'out.bin'), retries=2)
+
+    with pytest.raises(requests.exceptions.RequestException):
+        downloader.download()
+
+def test_server_ignoring_range_is_unsupported(range_server, tmp_path):
+    range_server.ignore_ranges = True
+    downloader = make_downloader(range_server, str(tmp_path / 'out.bin'))
+
+    with pytest.raises(SegmentedDownloadUnsupported):
+        downloader.download()
+
+def test_range_answered_with_200_after_probe(range_server, tmp_path):
+    # الفحص ينجح لكن نطاقات التحميل تعود بالملف كاملاً؛ الكتابة كانت ستفسد الملف
+    range_server.ignore_ranges = True
+    range_server.probe_ok = True
+    downloader = make_downloader(range_server, str(tmp_path / 'out.bin'))
+
+    with pytest.raises(SegmentedDownloadUnsupported):
+        downloader.download()
+
+def test_engine_falls_back_when_ranges_unsupported(range_server, tmp_path):
+    range_server.ignore_ranges = True
+    range_server.probe_ok = True
+    bench = DownloadEngine(str(tmp_path / 'downloads'), cache_folder=str(tmp_path / 'cache'),
+                           data_folder=str(tmp_path / 'data'))
+    part_path = str(tmp_path / 'video.mp4')
+    fmt = {'format_id': '18', 'protocol': 'http', 'url': range_server.url}
+
+    assert bench.download_segmented(fmt, part_path, 'job', ProgressTracker('job')) is False
+    # ملف المقاطع الجزئي يُحذف حتى يبدأ yt-dlp من الصفر
+    assert not os.path.exists(part_path + '.segments.part')
+    assert not os.path.exists(part_path)
+
+@pytest.mark.parametrize('damage', ['delete', 'truncate'])
+def test_completed_ranges_without_matching_file_restart(range_server, payload, tmp_path, damage):
+    path = str(tmp_path / 'out.bin')
+    first = make_downloader(range_server, path)
+    first.download()
+    # السجل يبقى لكن الملف الجزئي اختفى أو قُص بين التشغيلين
+    if damage == 'delete':
+        os.remove(path)
+    else:
+        os.truncate(path, len(payload) // 3)
+    range_server.ranges.clear()
+
+    downloader = make_downloader(range_server, path, completed_ranges=first.completed_ranges)
+    downloader.download()
+
+    with open(path, 'rb') as f:
+        assert f.read() == payload
+    assert min(requested_starts(range_server)) == 0
+    assert downloader._missing_ranges(len(payload)) == []
+
+def test_paused_download_releases_connection_slots(range_server, payload, tmp_path, monkeypatch):
+    monkeypatch.setattr(SegmentedDownloader, '_connection_slots', threading.BoundedSemaphore(1))
+    resume = threading.Event()
+    resume.set()
+    blocked = threading.Event()
+    calls = []
+
+    def hook(d):
+        # كالخطاف الحقيقي: الإيقاف يُطلب من الخارج بعد أول قطعة، والانتظار داخل الخطاف
+        calls.append(d['status'])
+        if len(calls) == 1:
+            resume.clear()
+        elif not resume.is_set():
+            blocked.set()
+            resume.wait()
+
+    paused_path = str(tmp_path / 'paused.bin')
+    paused = SegmentedDownloader(range_server.url, paused_path, connections=1, min_segment=MIN_SEGMENT,
+                                 chunk_size=16 * 1024, session=requests.Session(), progress_hook=hook,
+                                 is_paused=lambda: not resume.is_set())
+    worker = threading.Thread(target=paused.download)
+    worker.start()
+    assert blocked.wait(10)
+
+    # المهمة الموقوفة لا تحجز الفتحة الوحيدة
+    other_path = str(tmp_path / 'other.bin')
+    other = threading.Thread(target=make_downloader(range_server, other_path).download)
+    other.start()
+    other.join(10)
+    assert not other.is_alive()
+
+    resume.set()
+    worker.join(10)
+    assert not worker.is_alive()
+    for path in (paused_path, other_path):
+        with open(path, 'rb') as f:
+            assert f.read() == payload
+    assert paused.downloaded_bytes == len(payload)